@@ -0,0 +1,220 @@
+"""Cache Datasette's JSON responses until the database is written to.
+
+Table and canned query pages rerun their SQL on every request, while the
+data only changes when ``rb process-links`` (or the write API) commits. This
+plugin keeps finished ``.json`` responses in a bounded LRU keyed on the
+request path, query string and the caller's credentials - which together
+determine the SQL and its parameters - plus the database file's
+``PRAGMA data_version``. SQLite bumps that counter whenever another
+connection commits, so the first request after a write misses and reruns the
+query; nothing needs to be invalidated by hand.
+
+Every cached response carries a strong ETag over its body and
+``Cache-Control: no-cache``, so browsers and ``static/repo-plot.js``
+revalidate with ``If-None-Match`` and get an empty 304 while the data is
+unchanged.
+
+Configure it in ``datasette.yaml``::
+
+    plugins:
+      response_cache:
+        max_bytes: 67108864
+        max_entries: 1024
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from datasette import hookimpl
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_ENTRIES = 1024
+# Headers that decide who the request runs as and so what it may see
+VARY_HEADERS = (b"authorization", b"cookie")
+
+
+class ResponseCache:
+    """A thread-safe LRU of finished responses, bounded by entries and bytes."""
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = len(entry["body"])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old["body"])
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted["body"])
+
+
+class DataVersions:
+    """Report a fingerprint that changes whenever a database file is written.
+
+    ``PRAGMA data_version`` only moves for commits made by *other*
+    connections, so each file gets its own read-only connection that never
+    writes. The inode catches the file being replaced outright.
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def fingerprint(self, path: str):
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            return None
+        with self.lock:
+            conn_inode, conn = self.connections.get(path, (None, None))
+            if conn is None or conn_inode != inode:
+                if conn is not None:
+                    conn.close()
+                conn = sqlite3.connect(
+                    f"file:{path}?mode=ro", uri=True, check_same_thread=False
+                )
+                self.connections[path] = (inode, conn)
+            (version,) = conn.execute("PRAGMA data_version").fetchone()
+        return inode, version
+
+
+def cache_key(scope, fingerprint):
+    headers = dict(
+        (name, value) for name, value in scope["headers"] if name in VARY_HEADERS
+    )
+    return (
+        scope["path"],
+        scope.get("query_string", b""),
+        tuple(sorted(headers.items())),
+        fingerprint,
+    )
+
+
+def etag_matches(scope, etag: str) -> bool:
+    for name, value in scope["headers"]:
+        if name == b"if-none-match":
+            tags = [tag.strip() for tag in value.decode("latin-1").split(",")]
+            return etag in tags or "*" in tags
+    return False
+
+
+async def send_cached(scope, send, entry, status_header):
+    if etag_matches(scope, entry["etag"]):
+        status, body = 304, b""
+        headers = [h for h in entry["headers"] if h[0] != b"content-length"]
+    else:
+        status, body, headers = entry["status"], entry["body"], entry["headers"]
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers + [status_header],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def database_path(datasette, scope):
+    """Return the file behind a ``/<database>/...json`` GET, if it's cacheable."""
+    if scope["type"] != "http" or scope["method"] != "GET":
+        return None
+    path = scope["path"]
+    if not path.endswith(".json"):
+        return None
+    route = path.lstrip("/").split("/", 1)[0].removesuffix(".json")
+    try:
+        db = datasette.get_database(route=route)
+    except KeyError:
+        return None
+    if db.is_memory or not db.path:
+        return None
+    return db.path
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    config = datasette.plugin_config("response_cache") or {}
+    cache = ResponseCache(
+        int(config.get("max_bytes", DEFAULT_MAX_BYTES)),
+        int(config.get("max_entries", DEFAULT_MAX_ENTRIES)),
+    )
+    versions = DataVersions()
+
+    def wrap(app):
+        async def response_cache(scope, receive, send):
+            path = database_path(datasette, scope)
+            fingerprint = path and versions.fingerprint(path)
+            if not fingerprint:
+                await app(scope, receive, send)
+                return
+            key = cache_key(scope, fingerprint)
+            entry = cache.get(key)
+            if entry is not None:
+                await send_cached(scope, send, entry, (b"x-rb-cache", b"hit"))
+                return
+
+            # Buffer the response; only complete 200s are stored
+            start = None
+            chunks = []
+
+            async def capture(message):
+                nonlocal start
+                if message["type"] == "http.response.start":
+                    start = message
+                elif message["type"] == "http.response.body":
+                    chunks.append(message.get("body", b""))
+                    if not message.get("more_body"):
+                        await finish()
+
+            async def finish():
+                body = b"".join(chunks)
+                if start["status"] != 200:
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                headers = [
+                    (name, value)
+                    for name, value in start.get("headers", [])
+                    if name.lower() not in (b"etag", b"cache-control")
+                ]
+                etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+                headers += [
+                    (b"etag", etag.encode()),
+                    (b"cache-control", b"no-cache"),
+                ]
+                entry = {
+                    "status": 200,
+                    "headers": headers,
+                    "body": body,
+                    "etag": etag,
+                }
+                # Only cache if nothing was written while the query ran
+                if versions.fingerprint(path) == fingerprint:
+                    cache.put(key, entry)
+                await send_cached(scope, send, entry, (b"x-rb-cache", b"miss"))
+
+            await app(scope, receive, capture)
+
+        return response_cache
+
+    return wrap
@@ -1,17 +1,254 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import fcntl
+import functools
+import hashlib
+import itertools
 import json
+import math
 import os
+import queue
 import re
+import shutil
+import sqlite3
 import subprocess
+import sys
 import tempfile
-from typing import Optional
+import threading
+import time
+import urllib.parse
+from typing import TYPE_CHECKING, Callable, Iterator, NamedTuple, Optional
 
 import click
-import requests
+
+if TYPE_CHECKING:
+    import requests
+    import sqlite_utils
+
+GITHUB_API_URL = "https://api.github.com"
+
+
+class DurationParamType(click.ParamType):
+    """A duration in seconds, optionally written with an s/m/h/d suffix."""
+
+    name = "duration"
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return float(value)
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*", value)
+        if not match:
+            self.fail(
+                f"{value!r} is not a duration like 90, 30m, 12h or 7d", param, ctx
+            )
+        number, unit = match.groups()
+        return float(number) * self.units[unit or "s"]
+
+
+DURATION = DurationParamType()
+
+
+class SizeParamType(click.ParamType):
+    """A size in bytes, optionally written with a K/M/G suffix."""
+
+    name = "size"
+    units = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*", value.lower())
+        if not match:
+            self.fail(f"{value!r} is not a size like 4096, 500K, 64M or 1G", param, ctx)
+        number, unit = match.groups()
+        return int(float(number) * self.units[unit])
+
+
+SIZE = SizeParamType()
+
+
+class Tracer:
+    """Timed spans and counters for one rb run, written to a JSONL file.
+
+    Each span is a line recording its stage, start offset and duration in
+    milliseconds, thread, error if any, and attributes such as the item it
+    worked on. Counters (bytes, rows, retries) accumulate totals. close()
+    appends the counters and a per-stage summary and returns the summary.
+
+    With profile_stage, spans of that stage also run under cProfile and the
+    combined stats are written next to the trace as <path>.prof. Only one
+    span is profiled at a time, and the profile covers every thread while it
+    runs.
+    """
+
+    def __init__(self, path: str, profile_stage: Optional[str] = None):
+        self.path = path
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.durations = collections.defaultdict(list)
+        self.counters = collections.Counter()
+        self.profile_stage = profile_stage
+        self.profile_lock = threading.Lock()
+        self.profile = None
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **attrs):
+        profiler = None
+        if stage == self.profile_stage and self.profile_lock.acquire(blocking=False):
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            end = time.perf_counter()
+            if profiler:
+                profiler.disable()
+                self._add_profile(profiler)
+                self.profile_lock.release()
+            self._record(stage, start, end, attrs, error)
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _record(self, stage, start, end, attrs, error):
+        record = {
+            "type": "span",
+            "stage": stage,
+            "start_ms": round((start - self.start) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+            "thread": threading.current_thread().name,
+            **attrs,
+        }
+        if error:
+            record["error"] = error
+        with self.lock:
+            self.durations[stage].append(end - start)
+            self.file.write(json.dumps(record, default=str) + "\n")
+
+    def _add_profile(self, profiler):
+        import pstats
+
+        if self.profile is None:
+            self.profile = pstats.Stats(profiler)
+        else:
+            self.profile.add(profiler)
+
+    def summary(self) -> list[dict]:
+        """Per-stage span counts and total/p50/p95/p99/max milliseconds."""
+        rows = []
+        for stage, durations in self.durations.items():
+            ms = [d * 1000 for d in durations]
+            rows.append(
+                {
+                    "stage": stage,
+                    "count": len(ms),
+                    "total_ms": round(sum(ms), 3),
+                    **{f"p{q}_ms": round(percentile(ms, q), 3) for q in (50, 95, 99)},
+                    "max_ms": round(max(ms), 3),
+                }
+            )
+        return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+    def close(self) -> list[dict]:
+        summary = self.summary()
+        with self.lock:
+            counters = {"type": "counters", **self.counters}
+            self.file.write(json.dumps(counters) + "\n")
+            for row in summary:
+                self.file.write(json.dumps({"type": "summary", **row}) + "\n")
+            self.file.close()
+        if self.profile is not None:
+            self.profile.dump_stats(f"{self.path}.prof")
+        return summary
+
+
+_tracer: Optional[Tracer] = None
+
+
+def trace_span(stage: str, **attrs):
+    """Time a stage of work as a span when tracing is on; a no-op otherwise."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(stage, **attrs)
+
+
+def trace_count(name: str, n: int = 1):
+    """Add n to a trace counter, such as bytes received, when tracing is on."""
+    if _tracer is not None:
+        _tracer.count(name, n)
+
+
+def report_trace(tracer: Tracer):
+    """Close a trace and echo its per-stage summary and counters to stderr."""
+    summary = tracer.close()
+    spans = sum(row["count"] for row in summary)
+    click.echo(f"Trace: {spans} spans written to {tracer.path}", err=True)
+    if summary:
+        click.echo(
+            f"{'stage':<24} {'count':>7} {'total':>10} {'p50':>9} {'p95':>9} "
+            f"{'p99':>9} {'max':>9}",
+            err=True,
+        )
+    for row in summary:
+        click.echo(
+            f"{row['stage']:<24} {row['count']:>7} {row['total_ms']:>8.1f}ms "
+            + " ".join(
+                f"{row[key]:>7.1f}ms"
+                for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")
+            ),
+            err=True,
+        )
+    if tracer.counters:
+        counters = ", ".join(f"{k}={v}" for k, v in sorted(tracer.counters.items()))
+        click.echo(f"Counters: {counters}", err=True)
+    if tracer.profile is not None:
+        click.echo(
+            f"Profile of {tracer.profile_stage} written to {tracer.path}.prof",
+            err=True,
+        )
 
 
 @click.group()
-def cli():
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False),
+    envvar="RB_TRACE",
+    help="Write timed spans for each stage and item to this JSONL file and "
+    "print a per-stage summary at the end.",
+)
+@click.option(
+    "--trace-profile",
+    metavar="STAGE",
+    envvar="RB_TRACE_PROFILE",
+    help="Also cProfile the spans of this stage into the trace path + .prof.",
+)
+@click.pass_context
+def cli(ctx: click.Context, trace: Optional[str], trace_profile: Optional[str]):
     """Repository benchmarking tool to analyze and compare code repositories."""
+    global _tracer
+    if trace_profile and not trace:
+        raise click.UsageError("--trace-profile needs --trace")
+    if trace:
+        tracer = _tracer = Tracer(trace, trace_profile)
+
+        def finish():
+            global _tracer
+            _tracer = None
+            report_trace(tracer)
+
+        ctx.call_on_close(finish)
 
 
 @cli.group()
@@ -31,38 +268,865 @@ def datasette():
     help="The secret to use for the token.",
     default=os.getenv("DATASETTE_SECRET"),
 )
-def get_auth_token(username: str, secret: str):
-    """Get a Datasette auth token."""
-    result = subprocess.run(
-        ["uv", "run", "datasette", "create-token", username, "--secret", secret],
-        check=True,
+@click.option(
+    "--expires-after",
+    type=DURATION,
+    help="Make the token expire after this long, e.g. 3600, 30m or 1d.",
+)
+@click.option(
+    "alls",
+    "--all",
+    multiple=True,
+    metavar="ACTION",
+    help="Restrict the token to this action on everything.",
+)
+@click.option(
+    "databases",
+    "--database",
+    type=(str, str),
+    multiple=True,
+    metavar="DB ACTION",
+    help="Restrict the token to this action on a database.",
+)
+@click.option(
+    "resources",
+    "--resource",
+    type=(str, str, str),
+    multiple=True,
+    metavar="DB RESOURCE ACTION",
+    help="Restrict the token to this action on a table or query.",
+)
+@click.option(
+    "--token-cache",
+    type=click.Path(dir_okay=False),
+    default=lambda: os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "rb",
+        "tokens.json",
+    ),
+    show_default="~/.cache/rb/tokens.json",
+    envvar="RB_TOKEN_CACHE",
+    help="File of recently minted tokens to reuse.",
+)
+@click.option("--no-cache", is_flag=True, help="Always mint a new token.")
+def get_auth_token(
+    username: str,
+    secret: str,
+    expires_after: Optional[float],
+    alls: tuple[str, ...],
+    databases: tuple[tuple[str, str], ...],
+    resources: tuple[tuple[str, str, str], ...],
+    token_cache: str,
+    no_cache: bool,
+):
+    """Get a Datasette auth token.
+
+    The token is signed here, exactly as `datasette create-token` would sign
+    it, so no Datasette process is started. Tokens are reused from
+    --token-cache until they near expiry.
+    """
+    if not username or not secret:
+        raise click.ClickException(
+            "Set --username and --secret (or DATASETTE_USERNAME/DATASETTE_SECRET)"
+        )
+    restrict_database = {}
+    for database, action in databases:
+        restrict_database.setdefault(database, []).append(action)
+    restrict_resource = {}
+    for database, resource, action in resources:
+        restrict_resource.setdefault(database, {}).setdefault(resource, []).append(
+            action
+        )
+    claims = datasette_token_claims(
+        username,
+        expires_after=int(expires_after) if expires_after else None,
+        restrict_all=alls,
+        restrict_database=restrict_database,
+        restrict_resource=restrict_resource,
     )
-    click.echo(result.stdout)
+    if no_cache:
+        token = sign_datasette_token(secret, claims)
+    else:
+        token = cached_datasette_token(token_cache, secret, claims)
+    click.echo(token)
+
+
+# Datasette stores restricted actions in tokens by these abbreviations
+DATASETTE_ACTION_ABBREVIATIONS = {
+    "view-instance": "vi",
+    "view-database": "vd",
+    "view-database-download": "vdd",
+    "view-table": "vt",
+    "view-query": "vq",
+    "execute-sql": "es",
+    "permissions-debug": "pd",
+    "debug-menu": "dm",
+    "insert-row": "ir",
+    "delete-row": "dr",
+    "update-row": "ur",
+    "create-table": "ct",
+    "alter-table": "at",
+    "drop-table": "dt",
+}
+# Tokens without an expiry are still only reused for this long
+TOKEN_CACHE_TTL = 3600
+
+
+def datasette_token_claims(
+    actor_id: str,
+    expires_after: Optional[int] = None,
+    restrict_all=(),
+    restrict_database: Optional[dict] = None,
+    restrict_resource: Optional[dict] = None,
+) -> dict:
+    """Build the payload of a Datasette API token, minus its timestamp.
+
+    Mirrors Datasette.create_token: "d" is the lifetime in seconds and "_r"
+    holds abbreviated action restrictions overall, per database and per
+    database resource.
+    """
+
+    def abbreviate(actions):
+        return [DATASETTE_ACTION_ABBREVIATIONS.get(a, a) for a in actions]
+
+    claims = {"a": actor_id}
+    if expires_after:
+        claims["d"] = expires_after
+    restrictions = {}
+    if restrict_all:
+        restrictions["a"] = abbreviate(restrict_all)
+    if restrict_database:
+        restrictions["d"] = {
+            database: abbreviate(actions)
+            for database, actions in restrict_database.items()
+        }
+    if restrict_resource:
+        restrictions["r"] = {
+            database: {
+                resource: abbreviate(actions) for resource, actions in items.items()
+            }
+            for database, items in restrict_resource.items()
+        }
+    if restrictions:
+        claims["_r"] = restrictions
+    return claims
+
+
+def sign_datasette_token(secret: str, claims: dict, now: Optional[int] = None) -> str:
+    """Sign claims as a dstok_ token that a Datasette with `secret` accepts."""
+    from itsdangerous import URLSafeSerializer
+
+    token = {"a": claims["a"], "t": int(time.time() if now is None else now)}
+    token.update((k, v) for k, v in claims.items() if k != "a")
+    return "dstok_" + URLSafeSerializer(secret, "token").dumps(token)
+
+
+def cached_datasette_token(path: str, secret: str, claims: dict) -> str:
+    """Return a cached token for these claims, minting one when none is fresh.
+
+    A token is reused until it has 10% of its lifetime (and at least a
+    minute) left, or for TOKEN_CACHE_TTL if it never expires. Entries are
+    keyed on a hash of the secret and claims, so the secret isn't stored.
+    """
+    key = hashlib.sha256(
+        json.dumps([secret, claims], sort_keys=True).encode()
+    ).hexdigest()
+    now = time.time()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache = {k: v for k, v in cache.items() if v["refresh_at"] > now}
+    if key in cache:
+        return cache[key]["token"]
+
+    token = sign_datasette_token(secret, claims, now)
+    lifetime = claims.get("d")
+    if lifetime:
+        refresh_at = now + lifetime - max(60, lifetime / 10)
+    else:
+        refresh_at = now + TOKEN_CACHE_TTL
+    if refresh_at > now:
+        cache[key] = {"token": token, "refresh_at": refresh_at}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+    return token
 
 
 def datasette_post(url: str, token: str, payload: dict):
     """Helper function to make POST requests to Datasette."""
+    import requests
+
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {token}",
     }
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        with trace_span("datasette.post", url=url):
+            response = requests.post(url, headers=headers, json=payload)
+        trace_count("bytes_in", len(response.content))
         response.raise_for_status()
         click.echo(json.dumps(response.json(), indent=2))
     except requests.exceptions.HTTPError as e:
-        error_message = f"Error: {e.response.status_code} {e.response.reason}"
-        try:
-            error_details = e.response.json()
-            if "errors" in error_details:
-                error_message += "\\n" + "\\n".join(error_details["errors"])
-        except json.JSONDecodeError:
-            pass
-        raise click.ClickException(error_message) from e
+        raise click.ClickException(datasette_error_message(e.response)) from e
     except requests.exceptions.RequestException as e:
         raise click.ClickException(f"Request failed: {e}") from e
 
 
+def datasette_error_message(response) -> str:
+    """Describe a failed Datasette API response, including its errors list.
+
+    Works with both requests and httpx responses.
+    """
+    reason = getattr(response, "reason", None) or response.reason_phrase
+    error_message = f"Error: {response.status_code} {reason}"
+    try:
+        error_details = response.json()
+        if "errors" in error_details:
+            error_message += "\\n" + "\\n".join(error_details["errors"])
+    except json.JSONDecodeError:
+        pass
+    return error_message
+
+
+class _JSONStream:
+    """Incrementally decode JSON values from a text file.
+
+    Only a window of the file is held in memory at once, so arrays of any
+    length can be iterated while using memory proportional to the largest
+    single element.
+    """
+
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting {char!r}", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self._fill():
+                    raise
+                continue
+            # A number at the end of the window may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self) -> Iterator:
+        """Yield the elements of the array starting at the next character."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("]")
+                return
+
+    def iter_object(self) -> Iterator[str]:
+        """Yield the keys of the object starting at the next character.
+
+        The caller must consume each key's value before asking for the next.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+
+_decoder = json.JSONDecoder()
+
+
+def read_rows_payload(f, payload_format: str = "auto") -> tuple[dict, Iterator[dict]]:
+    """Open a rows payload file for streaming.
+
+    Accepts JSONL (one row per line), a JSON array of rows, or a JSON object
+    with a "rows" array plus other keys such as "pk" or "alter".
+
+    Returns:
+        The payload's keys other than "rows", and an iterator over the rows
+    """
+    if payload_format == "auto":
+        name = getattr(f, "name", "")
+        is_jsonl = str(name).endswith((".jsonl", ".ndjson"))
+        payload_format = "jsonl" if is_jsonl else "json"
+    if payload_format == "jsonl":
+        return {}, (json.loads(line) for line in f if line.strip())
+    stream = _JSONStream(f)
+    if stream.peek() == "[":
+        return {}, stream.iter_array()
+    if not f.seekable():
+        raise click.ClickException(
+            "Streaming a JSON object payload needs a regular file; "
+            "use JSONL or a JSON array of rows instead"
+        )
+    # The other keys may come after "rows", so find them in a first pass
+    f.seek(0)
+    extras = {}
+    stream = _JSONStream(f)
+    for key in stream.iter_object():
+        if key == "rows":
+            for _ in stream.iter_array():
+                pass
+        else:
+            extras[key] = stream.value()
+    f.seek(0)
+    return extras, _object_rows(f)
+
+
+def _object_rows(f) -> Iterator[dict]:
+    stream = _JSONStream(f)
+    for key in stream.iter_object():
+        if key == "rows":
+            yield from stream.iter_array()
+        else:
+            stream.value()
+
+
+class DatasetteClient:
+    """POSTs payloads to Datasette's JSON write API over one keep-alive session.
+
+    Connection errors, 429s and 5xx responses are retried with exponential
+    backoff. Posts that aren't idempotent, like inserts, are only retried
+    when they can't have been applied: on a 429 or 503, or when the
+    connection failed before the request was sent. The session may be shared
+    between threads.
+    """
+
+    def __init__(self, token: str, pool_size: int = 1, retries: int = 3):
+        import requests
+
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+        )
+
+    def post(self, url: str, payload: dict, idempotent: bool = True) -> dict:
+        import requests
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                trace_count("retries")
+            try:
+                with trace_span("datasette.post", url=url, attempt=attempt):
+                    response = self.session.post(url, json=payload, timeout=60)
+            except requests.exceptions.RequestException as e:
+                retryable = idempotent or _request_not_sent(e)
+                if not retryable or attempt == self.retries:
+                    raise click.ClickException(f"Request failed: {e}") from e
+            else:
+                trace_count("bytes_in", len(response.content))
+                status = response.status_code
+                if idempotent:
+                    retryable = status == 429 or status >= 500
+                else:
+                    retryable = status in (429, 503)
+                if not retryable or attempt == self.retries:
+                    if not response.ok:
+                        raise click.ClickException(datasette_error_message(response))
+                    return response.json()
+            time.sleep(0.5 * 2**attempt)
+
+    def close(self):
+        self.session.close()
+
+
+def _request_not_sent(exc: requests.RequestException) -> bool:
+    """Whether a request failed before any of it reached the server."""
+    import requests
+    import urllib3
+
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def stream_rows(
+    write_batch: Callable[[dict], dict],
+    rows: Iterator[dict],
+    extras: dict,
+    batch_size: int = 100,
+    pipeline: int = 1,
+    return_flag: bool = False,
+) -> int:
+    """Write rows in batches, each as its own insert or upsert payload.
+
+    write_batch receives a payload made of `extras` plus a "rows" list and
+    returns the API response. With pipeline > 1 up to that many batches are
+    in flight at once; at most pipeline batches are held in memory
+    regardless of the input size.
+
+    Returns:
+        The number of rows written
+    """
+    import concurrent.futures
+
+    sent = 0
+    start = time.monotonic()
+    in_flight = collections.deque()
+
+    def finish_oldest():
+        nonlocal sent
+        batch_length, future = in_flight.popleft()
+        result = future.result()
+        sent += batch_length
+        for row in result.get("rows", []) if return_flag else []:
+            click.echo(json.dumps(row))
+        elapsed = time.monotonic() - start
+        rate = sent / elapsed if elapsed > 0 else 0.0
+        click.echo(f"Sent {sent} rows ({rate:.0f} rows/sec)", err=True)
+
+    def submit(executor, payload: dict) -> concurrent.futures.Future:
+        if pipeline > 1:
+            return executor.submit(write_batch, payload)
+        # Without pipelining, write inline so that writers bound to this
+        # thread, such as a SQLite connection, can be used
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(write_batch(payload))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=pipeline) as executor:
+            for batch in itertools.batched(rows, batch_size):
+                if len(in_flight) >= pipeline:
+                    finish_oldest()
+                payload = {**extras, "rows": list(batch)}
+                if return_flag:
+                    payload["return"] = True
+                in_flight.append((len(batch), submit(executor, payload)))
+            while in_flight:
+                finish_oldest()
+    except click.ClickException as e:
+        e.message = f"{e.message}\nStopped after {sent} rows"
+        raise
+    except json.JSONDecodeError as e:
+        raise click.ClickException(
+            f"Invalid JSON in payload file after {sent} rows: {e}"
+        ) from e
+    elapsed = time.monotonic() - start
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    click.echo(f"Wrote {sent} rows in {elapsed:.1f}s ({rate:.0f} rows/sec)", err=True)
+    return sent
+
+
+def stream_options(f):
+    """Options shared by the commands that can stream rows in batches."""
+    f = click.option(
+        "--retries",
+        default=3,
+        show_default=True,
+        type=click.IntRange(min=0),
+        help="Retries per batch after a connection error, 429 or 5xx. Inserts "
+        "aren't idempotent, so they are only retried on a 429, a 503 or a "
+        "connection that failed before the batch was sent.",
+    )(f)
+    f = click.option(
+        "--pipeline",
+        default=1,
+        show_default=True,
+        type=click.IntRange(min=1),
+        help="Batches to keep in flight at once when streaming.",
+    )(f)
+    f = click.option(
+        "--format",
+        "payload_format",
+        type=click.Choice(["auto", "json", "jsonl"]),
+        default="auto",
+        show_default=True,
+        help="Payload format; auto treats .jsonl and .ndjson files as JSONL.",
+    )(f)
+    f = click.option(
+        "--batch-size",
+        type=click.IntRange(min=1),
+        help="Stream the payload in batches of this many rows (default 100 for JSONL).",
+    )(f)
+    return f
+
+
+direct_option = click.option(
+    "--direct",
+    "direct_path",
+    type=click.Path(dir_okay=False),
+    help="Apply the change straight to this SQLite file instead of "
+    "through Datasette's API.",
+)
+
+
+def send_rows(
+    operation: str,
+    base_url: str,
+    database: str,
+    table: str,
+    payload_file,
+    return_flag: bool,
+    direct_path: Optional[str],
+    batch_size: Optional[int],
+    payload_format: str,
+    pipeline: int,
+    retries: int,
+):
+    """Insert or upsert a rows payload, in one go or streamed in batches.
+
+    operation is "insert" or "upsert". Rows go to Datasette's API, or
+    straight into the SQLite file at direct_path when that is set.
+    """
+    if direct_path:
+        writer = DirectBackend(direct_path)
+        write_batch = functools.partial(getattr(writer, operation), table)
+        # A single writer with big transactions is fastest for SQLite
+        pipeline = 1
+        default_batch_size = 10_000
+    else:
+        token = os.getenv("DATASETTE_AUTH_TOKEN")
+        if not token:
+            raise click.ClickException(
+                "DATASETTE_AUTH_TOKEN environment variable not set"
+            )
+        url = f"{base_url}/{database}/{table}/-/{operation}"
+        writer = DatasetteClient(token, pool_size=pipeline, retries=retries)
+        write_batch = functools.partial(
+            writer.post, url, idempotent=operation != "insert"
+        )
+        default_batch_size = 100
+
+    is_jsonl = payload_format == "jsonl" or (
+        payload_format == "auto"
+        and str(getattr(payload_file, "name", "")).endswith((".jsonl", ".ndjson"))
+    )
+    try:
+        if batch_size is None and not is_jsonl:
+            try:
+                payload = json.load(payload_file)
+            except json.JSONDecodeError as e:
+                raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
+            if return_flag:
+                payload["return"] = True
+            click.echo(json.dumps(write_batch(payload), indent=2))
+            return
+        try:
+            extras, rows = read_rows_payload(payload_file, payload_format)
+        except json.JSONDecodeError as e:
+            raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
+        stream_rows(
+            write_batch,
+            rows,
+            extras,
+            batch_size=batch_size or default_batch_size,
+            pipeline=pipeline,
+            return_flag=return_flag,
+        )
+    finally:
+        writer.close()
+
+
+_TILDE_SAFE = frozenset(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
+)
+
+
+def tilde_encode(value: str) -> str:
+    """Tilde-encode a path component the way Datasette does."""
+    return "".join(
+        chr(b) if b in _TILDE_SAFE else "+" if b == 32 else f"~{b:02X}"
+        for b in value.encode("utf-8")
+    )
+
+
+def tilde_decode(value: str) -> str:
+    """Decode a Datasette tilde-encoded path component."""
+    # Matches datasette.utils.tilde_decode: protect literal %, then unquote
+    return urllib.parse.unquote_plus(value.replace("%", "~25").replace("~", "%"))
+
+
+def pks_path(pks) -> str:
+    """Primary key path segment for pks given as a string, number or list.
+
+    Strings are used as-is, like the --pks option; list items are each
+    tilde-encoded and joined with commas.
+    """
+    if isinstance(pks, list):
+        return ",".join(tilde_encode(str(value)) for value in pks)
+    return str(pks)
+
+
+class DirectBackend:
+    """Apply Datasette JSON write API payloads straight to a SQLite file.
+
+    Mirrors the payloads, validation and responses of the insert, upsert,
+    update, delete, create and drop endpoints, minus HTTP, auth and
+    Datasette's write queue. The database runs in WAL mode, each payload is
+    a single transaction and rows are written with executemany.
+    """
+
+    column_types = {"text": str, "integer": int, "float": float, "blob": bytes}
+
+    def __init__(self, path: str):
+        import sqlite_utils
+
+        self.path = path
+        self.db = sqlite_utils.Database(path)
+        self.db.enable_wal()
+        self.db.execute("PRAGMA synchronous = NORMAL")
+
+    def _table(self, name: str) -> sqlite_utils.db.Table:
+        table = self.db.table(name)
+        if not table.exists():
+            raise click.ClickException(f"Error: 404 Table not found: {name}")
+        return table
+
+    def _check_columns(self, table, rows: list[dict], alter: bool):
+        columns = set(table.columns_dict) | ({"rowid"} if table.use_rowid else set())
+        for i, row in enumerate(rows):
+            invalid = [key for key in row if key not in columns]
+            if invalid and not alter:
+                raise click.ClickException(
+                    f"Error: 400 Row {i} has invalid columns: {', '.join(invalid)}"
+                )
+
+    def _pk_values(self, table, pks: str) -> list:
+        values = [tilde_decode(value) for value in pks.split(",")]
+        if len(values) != len(table.pks):
+            raise click.ClickException(
+                f"Error: 400 Expected {len(table.pks)} primary key values"
+            )
+        return values
+
+    def _rows_since(self, table, rowid: int) -> list[dict]:
+        select = "rowid, *" if table.use_rowid else "*"
+        return list(
+            self.db.query(
+                f"SELECT {select} FROM [{table.name}] WHERE rowid > ? ORDER BY rowid",
+                [rowid],
+            )
+        )
+
+    def _rows_by_pk(self, table, rows: list[dict]) -> list[dict]:
+        where = " AND ".join(f"[{pk}] = ?" for pk in table.pks)
+        sql = f"SELECT * FROM [{table.name}] WHERE {where}"
+        return [next(self.db.query(sql, [row[pk] for pk in table.pks])) for row in rows]
+
+    def insert(self, table_name: str, payload: dict) -> dict:
+        rows = payload.get("rows") or ([payload["row"]] if "row" in payload else [])
+        if payload.get("ignore") and payload.get("replace"):
+            raise click.ClickException(
+                'Error: 400 Cannot use "ignore" and "replace" at the same time'
+            )
+        mode = "insert"
+        if payload.get("ignore"):
+            mode = "ignore"
+        elif payload.get("replace"):
+            mode = "replace"
+        table = self._table(table_name)
+        self._check_columns(table, rows, payload.get("alter", False))
+        try:
+            with self.db.conn:
+                last_rowid = self.db.execute(
+                    f"SELECT coalesce(max(rowid), 0) FROM [{table_name}]"
+                ).fetchone()[0]
+                _write_rows(self.db, table_name, rows, pk=table.pks, mode=mode)
+        except sqlite3.Error as e:
+            raise click.ClickException(f"Error: 400 {e}") from e
+        result = {"ok": True}
+        if payload.get("return"):
+            has_pks = not table.use_rowid and all(
+                pk in row for row in rows for pk in table.pks
+            )
+            if has_pks:
+                result["rows"] = self._rows_by_pk(table, rows)
+            else:
+                result["rows"] = self._rows_since(table, last_rowid)
+        return result
+
+    def upsert(self, table_name: str, payload: dict) -> dict:
+        rows = payload.get("rows") or ([payload["row"]] if "row" in payload else [])
+        table = self._table(table_name)
+        if table.use_rowid:
+            raise click.ClickException(
+                "Error: 400 Upsert needs a table with a primary key"
+            )
+        for i, row in enumerate(rows):
+            missing = [pk for pk in table.pks if pk not in row]
+            if missing:
+                raise click.ClickException(
+                    f"Error: 400 Row {i} is missing primary key column(s): "
+                    + ", ".join(missing)
+                )
+        self._check_columns(table, rows, payload.get("alter", False))
+        try:
+            with self.db.conn:
+                _write_rows(self.db, table_name, rows, pk=table.pks, mode="upsert")
+        except sqlite3.Error as e:
+            raise click.ClickException(f"Error: 400 {e}") from e
+        result = {"ok": True}
+        if payload.get("return"):
+            result["rows"] = self._rows_by_pk(table, rows)
+        return result
+
+    def update(self, table_name: str, pks: str, payload: dict) -> dict:
+        from sqlite_utils.db import jsonify_if_needed
+
+        table = self._table(table_name)
+        update = payload.get("update")
+        if not isinstance(update, dict) or not update:
+            raise click.ClickException('Error: 400 JSON must contain "update" key')
+        self._check_columns(table, [update], payload.get("alter", False))
+        values = self._pk_values(table, pks)
+        where = " AND ".join(f"[{pk}] = ?" for pk in table.pks)
+        try:
+            with self.db.conn:
+                table.add_missing_columns([update])
+                assignments = ", ".join(f"[{key}] = ?" for key in update)
+                cursor = self.db.execute(
+                    f"UPDATE [{table_name}] SET {assignments} WHERE {where}",
+                    [jsonify_if_needed(value) for value in update.values()] + values,
+                )
+        except sqlite3.Error as e:
+            raise click.ClickException(f"Error: 400 {e}") from e
+        if cursor.rowcount == 0:
+            raise click.ClickException("Error: 404 Row not found")
+        result = {"ok": True}
+        if payload.get("return"):
+            select = "rowid, *" if table.use_rowid else "*"
+            result["row"] = next(
+                self.db.query(
+                    f"SELECT {select} FROM [{table_name}] WHERE {where}", values
+                )
+            )
+        return result
+
+    def delete(self, table_name: str, pks: str) -> dict:
+        table = self._table(table_name)
+        where = " AND ".join(f"[{pk}] = ?" for pk in table.pks)
+        with self.db.conn:
+            cursor = self.db.execute(
+                f"DELETE FROM [{table_name}] WHERE {where}",
+                self._pk_values(table, pks),
+            )
+        if cursor.rowcount == 0:
+            raise click.ClickException("Error: 404 Row not found")
+        return {"ok": True}
+
+    def create(self, payload: dict) -> dict:
+        table_name = payload.get("table")
+        if not table_name:
+            raise click.ClickException('Error: 400 "table" is required')
+        rows = payload.get("rows") or ([payload["row"]] if "row" in payload else [])
+        columns = payload.get("columns")
+        if not rows and not columns:
+            raise click.ClickException(
+                'Error: 400 JSON must contain "columns" or "rows" or "row"'
+            )
+        pk = payload.get("pks") or payload.get("pk")
+        table = self.db.table(table_name)
+        if table.exists() and not rows:
+            raise click.ClickException("Error: 400 Table already exists")
+        try:
+            with self.db.conn:
+                if columns:
+                    if not table.exists():
+                        table.create(
+                            {
+                                column["name"]: self.column_types[
+                                    column.get("type", "text")
+                                ]
+                                for column in columns
+                            },
+                            pk=pk,
+                        )
+                if rows:
+                    mode = "insert"
+                    if payload.get("ignore"):
+                        mode = "ignore"
+                    elif payload.get("replace"):
+                        mode = "replace"
+                    _write_rows(self.db, table_name, rows, pk=pk, mode=mode)
+        except (KeyError, sqlite3.Error) as e:
+            raise click.ClickException(f"Error: 400 {e}") from e
+        result = {
+            "ok": True,
+            "database": os.path.splitext(os.path.basename(self.path))[0],
+            "table": table_name,
+            "schema": table.schema,
+        }
+        if rows:
+            result["row_count"] = len(rows)
+        return result
+
+    def drop(self, table_name: str, confirm: bool) -> dict:
+        table = self._table(table_name)
+        if not confirm:
+            return {
+                "ok": True,
+                "table": table_name,
+                "row_count": table.count,
+                "message": 'Pass "confirm": true to confirm',
+            }
+        with self.db.conn:
+            table.drop()
+        return {"ok": True}
+
+    def close(self):
+        self.db.close()
+
+
 @datasette.command(name="insert-rows")
 @click.option("--database", required=True, help="Name of the database.")
 @click.option("--table", required=True, help="Name of the table.")
@@ -79,14 +1143,34 @@ def datasette_post(url: str, token: str, payload: dict):
     help="Datasette base URL",
 )
 @click.option("--return", "return_flag", is_flag=True, help="Return the inserted rows.")
+@direct_option
+@stream_options
 def insert_rows(
-    database: str, table: str, payload_file, base_url: str, return_flag: bool
+    database: str,
+    table: str,
+    payload_file,
+    base_url: str,
+    return_flag: bool,
+    direct_path: Optional[str],
+    batch_size: Optional[int],
+    payload_format: str,
+    pipeline: int,
+    retries: int,
 ):
     """Insert rows into a table from a JSON file.
 
     PAYLOAD_FILE: Path to a JSON file containing an object with a "rows" key,
     which is a list of objects to insert.
 
+    With --batch-size, or for a JSONL file, the payload is streamed and
+    sent in batches rather than loaded into memory at once. Streaming also
+    accepts a plain JSON array of rows. Progress and the final rows/sec are
+    reported on stderr, and --return prints the returned rows as JSON lines.
+
+    With --direct PATH the rows are written straight into that SQLite file,
+    with the same payload semantics, in large executemany transactions. Use
+    it when the loader runs on the same machine as the database.
+
     Example:
     {
         "rows": [
@@ -97,17 +1181,19 @@ def insert_rows(
 
     See: https://docs.datasette.io/en/latest/json_api.html#inserting-rows
     """
-    token = os.getenv("DATASETTE_AUTH_TOKEN")
-    if not token:
-        raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
-    url = f"{base_url}/{database}/{table}/-/insert"
-    try:
-        payload = json.load(payload_file)
-    except json.JSONDecodeError as e:
-        raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
-    if return_flag:
-        payload["return"] = True
-    datasette_post(url, token, payload)
+    send_rows(
+        "insert",
+        base_url,
+        database,
+        table,
+        payload_file,
+        return_flag,
+        direct_path,
+        batch_size,
+        payload_format,
+        pipeline,
+        retries,
+    )
 
 
 @datasette.command(name="upsert-rows")
@@ -126,14 +1212,30 @@ def insert_rows(
     help="Datasette base URL",
 )
 @click.option("--return", "return_flag", is_flag=True, help="Return the upserted rows.")
+@direct_option
+@stream_options
 def upsert_rows(
-    database: str, table: str, payload_file, base_url: str, return_flag: bool
+    database: str,
+    table: str,
+    payload_file,
+    base_url: str,
+    return_flag: bool,
+    direct_path: Optional[str],
+    batch_size: Optional[int],
+    payload_format: str,
+    pipeline: int,
+    retries: int,
 ):
     """Upsert rows into a table from a JSON file.
 
     PAYLOAD_FILE: Path to a JSON file for upserting rows. Must include "rows"
     and "pk" keys.
 
+    With --batch-size, or for a JSONL file, the payload is streamed and
+    sent in batches rather than loaded into memory at once; see insert-rows.
+
+    With --direct PATH the rows are upserted straight into that SQLite file.
+
     Example:
     {
         "rows": [
@@ -145,17 +1247,19 @@ def upsert_rows(
 
     See: https://docs.datasette.io/en/latest/json_api.html#upserting-rows
     """
-    token = os.getenv("DATASETTE_AUTH_TOKEN")
-    if not token:
-        raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
-    url = f"{base_url}/{database}/{table}/-/upsert"
-    try:
-        payload = json.load(payload_file)
-    except json.JSONDecodeError as e:
-        raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
-    if return_flag:
-        payload["return"] = True
-    datasette_post(url, token, payload)
+    send_rows(
+        "upsert",
+        base_url,
+        database,
+        table,
+        payload_file,
+        return_flag,
+        direct_path,
+        batch_size,
+        payload_format,
+        pipeline,
+        retries,
+    )
 
 
 @datasette.command(name="update-row")
@@ -175,8 +1279,15 @@ def upsert_rows(
     help="Datasette base URL",
 )
 @click.option("--return", "return_flag", is_flag=True, help="Return the updated row.")
+@direct_option
 def update_row(
-    database: str, table: str, pks: str, payload_file, base_url: str, return_flag: bool
+    database: str,
+    table: str,
+    pks: str,
+    payload_file,
+    base_url: str,
+    return_flag: bool,
+    direct_path: Optional[str],
 ):
     """Update a row in a table.
 
@@ -194,16 +1305,20 @@ def update_row(
 
     See: https://docs.datasette.io/en/latest/json_api.html#updating-a-row
     """
-    token = os.getenv("DATASETTE_AUTH_TOKEN")
-    if not token:
-        raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
-    url = f"{base_url}/{database}/{table}/{pks}/-/update"
     try:
         payload = json.load(payload_file)
     except json.JSONDecodeError as e:
         raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
     if return_flag:
         payload["return"] = True
+    if direct_path:
+        result = DirectBackend(direct_path).update(table, pks, payload)
+        click.echo(json.dumps(result, indent=2))
+        return
+    token = os.getenv("DATASETTE_AUTH_TOKEN")
+    if not token:
+        raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
+    url = f"{base_url}/{database}/{table}/{pks}/-/update"
     datasette_post(url, token, payload)
 
 
@@ -216,8 +1331,15 @@ def update_row(
     default=os.getenv("DATASETTE_ENDPOINT", "http://127.0.0.1:8001"),
     help="Datasette base URL",
 )
-def delete_row(database: str, table: str, pks: str, base_url: str):
+@direct_option
+def delete_row(
+    database: str, table: str, pks: str, base_url: str, direct_path: Optional[str]
+):
     """Delete a row from a table."""
+    if direct_path:
+        result = DirectBackend(direct_path).delete(table, pks)
+        click.echo(json.dumps(result, indent=2))
+        return
     token = os.getenv("DATASETTE_AUTH_TOKEN")
     if not token:
         raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
@@ -225,24 +1347,338 @@ def delete_row(database: str, table: str, pks: str, base_url: str):
     datasette_post(url, token, {})
 
 
-@datasette.command(name="create-table")
-@click.option("--database", required=True, help="Name of the database.")
-@click.option(
-    "--payload-file",
-    "payload_file",
-    required=True,
-    type=click.File("r"),
-    help="Path to the JSON payload file.",
-)
-@click.option(
-    "--base-url",
-    default=os.getenv("DATASETTE_ENDPOINT", "http://127.0.0.1:8001"),
-    help="Datasette base URL",
-)
-def create_table(database: str, payload_file, base_url: str):
-    """Create a table.
+class ItemResult(NamedTuple):
+    """The outcome of one request in a batch."""
 
-    PAYLOAD_FILE: Path to a JSON file describing the table to create.
+    key: str
+    ok: bool
+    latency: float
+    response: Optional[dict]
+    error: Optional[str]
+
+
+async def post_many(
+    token: str,
+    items: Iterator[tuple[str, str, dict]],
+    concurrency: int = 10,
+    retries: int = 3,
+) -> list[ItemResult]:
+    """POST many (key, url, payload) items to Datasette concurrently.
+
+    `concurrency` workers share one httpx connection pool, so at most that
+    many requests are in flight and connections are reused between them.
+    Connection errors, 429s and 5xx responses are retried with exponential
+    backoff. Failures are collected per item rather than raised.
+    """
+    import asyncio
+
+    import httpx
+
+    results = []
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as client:
+
+        async def post(key: str, url: str, payload: dict) -> ItemResult:
+            start = time.monotonic()
+            for attempt in range(retries + 1):
+                if attempt:
+                    trace_count("retries")
+                    await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                try:
+                    with trace_span("datasette.post", item=key, attempt=attempt):
+                        response = await client.post(url, json=payload)
+                    trace_count("bytes_in", len(response.content))
+                except httpx.HTTPError as e:
+                    error = f"Request failed: {e}"
+                    continue
+                retryable = response.status_code == 429 or response.status_code >= 500
+                if retryable and attempt < retries:
+                    error = datasette_error_message(response)
+                    continue
+                latency = time.monotonic() - start
+                if response.is_success:
+                    return ItemResult(key, True, latency, response.json(), None)
+                return ItemResult(
+                    key, False, latency, None, datasette_error_message(response)
+                )
+            return ItemResult(key, False, time.monotonic() - start, None, error)
+
+        async def worker():
+            for key, url, payload in items:
+                results.append(await post(key, url, payload))
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+def percentile(values: list[float], q: float) -> float:
+    """The q-th percentile (0-100) of values, by the nearest-rank method."""
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def report_batch(results: list[ItemResult], elapsed: float, verb: str):
+    """Echo failures and a summary of a batch of row mutations.
+
+    Raises:
+        click.ClickException: If any item failed
+    """
+    failures = [result for result in results if not result.ok]
+    for result in failures:
+        click.echo(f"✗ {result.key}: {result.error}", err=True)
+    succeeded = len(results) - len(failures)
+    rate = len(results) / elapsed if elapsed > 0 else 0.0
+    summary = (
+        f"{verb} {succeeded} rows, {len(failures)} failed in {elapsed:.1f}s "
+        f"({rate:.0f} rows/sec)"
+    )
+    if results:
+        latencies = [result.latency * 1000 for result in results]
+        summary += "; latency " + ", ".join(
+            f"p{q} {percentile(latencies, q):.0f}ms" for q in (50, 95, 99)
+        )
+    click.echo(summary, err=True)
+    if failures:
+        raise click.ClickException(f"{len(failures)} of {len(results)} rows failed")
+
+
+def run_batch(
+    token: Optional[str],
+    items: Iterator[tuple[str, str, dict]],
+    concurrency: int,
+    retries: int,
+    direct_call: Optional[Callable[[str, dict], dict]] = None,
+) -> list[ItemResult]:
+    """Run (key, url, payload) items over HTTP, or through direct_call."""
+    import asyncio
+
+    if direct_call is None:
+        if not token:
+            raise click.ClickException(
+                "DATASETTE_AUTH_TOKEN environment variable not set"
+            )
+        return asyncio.run(post_many(token, items, concurrency, retries))
+    results = []
+    for key, _, payload in items:
+        start = time.monotonic()
+        try:
+            response = direct_call(key, payload)
+        except click.ClickException as e:
+            results.append(
+                ItemResult(key, False, time.monotonic() - start, None, e.message)
+            )
+        else:
+            results.append(
+                ItemResult(key, True, time.monotonic() - start, response, None)
+            )
+    return results
+
+
+def read_update_pairs(f) -> Iterator[tuple[str, dict]]:
+    """Yield (pks, payload) pairs from an update-rows payload file.
+
+    JSONL files hold one {"pks": ..., "update": {...}} object per line; JSON
+    files hold either a list of those objects or a {pks: update} object.
+    """
+    if str(getattr(f, "name", "")).endswith((".jsonl", ".ndjson")):
+        items = (json.loads(line) for line in f if line.strip())
+    else:
+        data = json.load(f)
+        if isinstance(data, dict):
+            items = ({"pks": pks, "update": update} for pks, update in data.items())
+        else:
+            items = iter(data)
+    for item in items:
+        if not isinstance(item, dict) or "pks" not in item or "update" not in item:
+            raise click.ClickException(
+                f'Each item needs "pks" and "update" keys, got: {item!r}'
+            )
+        payload = {key: value for key, value in item.items() if key != "pks"}
+        yield pks_path(item["pks"]), payload
+
+
+def read_pks(f) -> Iterator[str]:
+    """Yield pks from a JSON array, or from a text file with one per line."""
+    if str(getattr(f, "name", "")).endswith(".json"):
+        for pks in json.load(f):
+            yield pks_path(pks)
+    else:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+@datasette.command(name="update-rows")
+@click.option("--database", required=True, help="Name of the database.")
+@click.option("--table", required=True, help="Name of the table.")
+@click.option(
+    "--payload-file",
+    "payload_file",
+    required=True,
+    type=click.File("r"),
+    help="Path to a JSON or JSONL file of primary keys and updates.",
+)
+@click.option(
+    "--base-url",
+    default=os.getenv("DATASETTE_ENDPOINT", "http://127.0.0.1:8001"),
+    help="Datasette base URL",
+)
+@click.option("--return", "return_flag", is_flag=True, help="Return the updated rows.")
+@click.option(
+    "--concurrency",
+    default=10,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Maximum number of requests in flight.",
+)
+@click.option(
+    "--retries",
+    default=3,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Retries per row after a connection error, 429 or 5xx.",
+)
+@direct_option
+def update_rows(
+    database: str,
+    table: str,
+    payload_file,
+    base_url: str,
+    return_flag: bool,
+    concurrency: int,
+    retries: int,
+    direct_path: Optional[str],
+):
+    """Update many rows in a table, concurrently.
+
+    PAYLOAD_FILE: Path to a file pairing primary keys with updates, either
+    JSONL with one object per line or a JSON list of the same objects:
+
+    {"pks": "1", "update": {"text_column": "New text string"}}
+
+    or a JSON object keyed by primary key:
+
+    {"1": {"text_column": "New text string"}, "2": {"integer_column": 3}}
+
+    Failed rows are reported individually, followed by a summary with
+    latency percentiles. --return prints the updated rows as JSON lines.
+    """
+    try:
+        pairs = list(read_update_pairs(payload_file))
+    except json.JSONDecodeError as e:
+        raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
+    if return_flag:
+        for _, payload in pairs:
+            payload["return"] = True
+    items = (
+        (pks, f"{base_url}/{database}/{table}/{pks}/-/update", payload)
+        for pks, payload in pairs
+    )
+    direct_call = None
+    if direct_path:
+        backend = DirectBackend(direct_path)
+        direct_call = functools.partial(backend.update, table)
+    start = time.monotonic()
+    results = run_batch(
+        os.getenv("DATASETTE_AUTH_TOKEN"), items, concurrency, retries, direct_call
+    )
+    if return_flag:
+        for result in results:
+            if result.ok:
+                click.echo(json.dumps(result.response["row"]))
+    report_batch(results, time.monotonic() - start, "Updated")
+
+
+@datasette.command(name="delete-rows")
+@click.option("--database", required=True, help="Name of the database.")
+@click.option("--table", required=True, help="Name of the table.")
+@click.option(
+    "--pks-file",
+    "pks_file",
+    required=True,
+    type=click.File("r"),
+    help="Path to a file of primary keys, one per line, or a JSON array.",
+)
+@click.option(
+    "--base-url",
+    default=os.getenv("DATASETTE_ENDPOINT", "http://127.0.0.1:8001"),
+    help="Datasette base URL",
+)
+@click.option(
+    "--concurrency",
+    default=10,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Maximum number of requests in flight.",
+)
+@click.option(
+    "--retries",
+    default=3,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Retries per row after a connection error, 429 or 5xx.",
+)
+@direct_option
+def delete_rows(
+    database: str,
+    table: str,
+    pks_file,
+    base_url: str,
+    concurrency: int,
+    retries: int,
+    direct_path: Optional[str],
+):
+    """Delete many rows from a table, concurrently.
+
+    PKS_FILE: Path to a text file with one primary key per line, in the
+    same form as --pks for delete-row, or a .json file holding an array of
+    primary keys (use a list for compound keys).
+    """
+    try:
+        keys = list(read_pks(pks_file))
+    except json.JSONDecodeError as e:
+        raise click.ClickException(f"Invalid JSON in pks file: {e}") from e
+    items = ((pks, f"{base_url}/{database}/{table}/{pks}/-/delete", {}) for pks in keys)
+    direct_call = None
+    if direct_path:
+        backend = DirectBackend(direct_path)
+
+        def direct_call(pks, payload):
+            return backend.delete(table, pks)
+
+    start = time.monotonic()
+    results = run_batch(
+        os.getenv("DATASETTE_AUTH_TOKEN"), items, concurrency, retries, direct_call
+    )
+    report_batch(results, time.monotonic() - start, "Deleted")
+
+
+@datasette.command(name="create-table")
+@click.option("--database", required=True, help="Name of the database.")
+@click.option(
+    "--payload-file",
+    "payload_file",
+    required=True,
+    type=click.File("r"),
+    help="Path to the JSON payload file.",
+)
+@click.option(
+    "--base-url",
+    default=os.getenv("DATASETTE_ENDPOINT", "http://127.0.0.1:8001"),
+    help="Datasette base URL",
+)
+@direct_option
+def create_table(
+    database: str, payload_file, base_url: str, direct_path: Optional[str]
+):
+    """Create a table.
+
+    PAYLOAD_FILE: Path to a JSON file describing the table to create.
     It should contain "table", and either "columns" or "rows".
 
     Example with columns:
@@ -267,14 +1703,18 @@ def create_table(database: str, payload_file, base_url: str):
 
     See: https://docs.datasette.io/en/latest/json_api.html#creating-a-table
     """
-    token = os.getenv("DATASETTE_AUTH_TOKEN")
-    if not token:
-        raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
-    url = f"{base_url}/{database}/-/create"
     try:
         payload = json.load(payload_file)
     except json.JSONDecodeError as e:
         raise click.ClickException(f"Invalid JSON in payload file: {e}") from e
+    if direct_path:
+        result = DirectBackend(direct_path).create(payload)
+        click.echo(json.dumps(result, indent=2))
+        return
+    token = os.getenv("DATASETTE_AUTH_TOKEN")
+    if not token:
+        raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
+    url = f"{base_url}/{database}/-/create"
     datasette_post(url, token, payload)
 
 
@@ -287,11 +1727,22 @@ def create_table(database: str, payload_file, base_url: str):
     default=os.getenv("DATASETTE_ENDPOINT", "http://127.0.0.1:8001"),
     help="Datasette base URL",
 )
-def drop_table(database: str, table: str, confirm: bool, base_url: str):
+@direct_option
+def drop_table(
+    database: str,
+    table: str,
+    confirm: bool,
+    base_url: str,
+    direct_path: Optional[str],
+):
     """Drop a table.
 
     Use the --confirm flag to finalize the deletion.
     """
+    if direct_path:
+        result = DirectBackend(direct_path).drop(table, confirm)
+        click.echo(json.dumps(result, indent=2))
+        return
     token = os.getenv("DATASETTE_AUTH_TOKEN")
     if not token:
         raise click.ClickException("DATASETTE_AUTH_TOKEN environment variable not set")
@@ -302,187 +1753,4177 @@ def drop_table(database: str, table: str, confirm: bool, base_url: str):
     datasette_post(url, token, payload)
 
 
+def cache_options(f):
+    """Options shared by the commands that clone repos and cache their results."""
+    f = click.option(
+        "--clone-cache-size",
+        type=SIZE,
+        default="5G",
+        show_default=True,
+        envvar="RB_CLONE_CACHE_SIZE",
+        help="Evict least recently used clones beyond this much disk.",
+    )(f)
+    f = click.option(
+        "--clone-cache",
+        type=click.Path(file_okay=False),
+        default=lambda: os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+            "rb",
+            "clones",
+        ),
+        show_default="~/.cache/rb/clones",
+        envvar="RB_CLONE_CACHE",
+        help="Directory of bare clones reused between runs.",
+    )(f)
+    f = click.option(
+        "--cache-size",
+        type=SIZE,
+        default="256M",
+        show_default=True,
+        envvar="RB_CACHE_SIZE",
+        help="Evict least recently used cached results beyond this size.",
+    )(f)
+    f = click.option(
+        "--no-cache",
+        is_flag=True,
+        help="Ignore cached results and redo the work.",
+    )(f)
+    return f
+
+
 @cli.command()
 @click.option(
     "--repo-path",
     required=True,
     help="Add a new repository to the benchmark database. REPO_PATH can be a GitHub URL or local path",
 )
-def survey(repo_path: str):
-    """Survey a repository."""
-    if repo_path.startswith("http"):
-        click.echo(f"Surveying remote repository: {repo_path}")
-        with tempfile.TemporaryDirectory(prefix="tmp_repo_") as tmp_dir:
-            try:
-                click.echo(f"Cloning repository to {tmp_dir}...")
-                subprocess.run(
-                    ["git", "clone", "--depth=1", repo_path, tmp_dir],
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                )
-                click.echo("Repository cloned successfully")
-                # TODO: Analyze the cloned repository
-            except subprocess.CalledProcessError as e:
-                raise click.ClickException(f"Failed to clone repository: {e.stderr}")
-    else:
-        if not os.path.exists(repo_path):
-            raise click.BadParameter(f"Local path does not exist: {repo_path}")
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Processes to analyze files with (default: one per CPU).",
+)
+@click.option(
+    "--history/--no-history",
+    default=True,
+    show_default=True,
+    help="Also record weekly commit activity from the git history.",
+)
+@cache_options
+def survey(
+    repo_path: str,
+    db: str,
+    workers: Optional[int],
+    history: bool,
+    no_cache: bool,
+    cache_size: int,
+    clone_cache: str,
+    clone_cache_size: int,
+):
+    """Survey a repository.
 
-    # Now we'll pipe this into llm and simon's github plugin.
-    click.secho(f"Surveying repository: {repo_path}")
-    # TODO: Implement local repo analysis
+    Walks the working tree, skipping .gitignored and binary files, and
+    records per-language file and line counts, the test file ratio, which
+    docs are present and the dependency manifests found. The result is
+    saved to the surveys table and printed as JSON.
 
+    Remote repos are kept as bare clones that later runs fetch into, and
+    surveys are cached by the commit they were taken at, so a repo whose
+    HEAD hasn't moved is not fetched again.
 
-@cli.command()
-@click.option("--filter", help="Filter repositories by keyword")
-def list_repos(filter_term: Optional[str]):
-    """List all repositories in the benchmark database."""
-    click.echo("Listing repositories...")
-    if filter_term:
-        click.echo(f"Applying filter: {filter_term}")
-    # TODO: Implement repository listing logic
+    With --history, commits are read from `git log` into weekly per-author
+    activity. Only commits since the last analyzed one are read.
+    """
+    import sqlite_utils
 
+    if is_remote(repo_path):
+        click.echo(f"Surveying remote repository: {repo_path}", err=True)
+        cache = ResultCache(state_path(db), max_bytes=cache_size)
 
-@cli.command()
-@click.option("--repo-name", required=True, help="Name of the repository to inspect.")
-@click.option("--stats", is_flag=True, help="Show detailed statistics")
-@click.option("--embeddings", is_flag=True, help="Show repository embeddings")
-def inspect(repo_name: str, stats: bool, embeddings: bool):
-    """View detailed information about a specific repository."""
-    click.echo(f"Inspecting repository: {repo_name}")
+        def compute(tmp_dir):
+            result = survey_tree(tmp_dir, workers=workers)
+            match = re.search(r"github\.com/([^/]+/[^/]+?)(?:\.git)?/?$", repo_path)
+            result["repo"] = match.group(1) if match else repo_path
+            return result
 
-    if stats:
-        click.echo("Showing detailed statistics:")
-        # TODO: Implement statistics display
-        click.echo("- Code quality metrics")
-        click.echo("- Documentation coverage")
-        click.echo("- Test coverage")
-        click.echo("- Dependency health")
+        clones = CloneCache(clone_cache, max_bytes=clone_cache_size)
+        result = cached_clone_result(
+            cache, clones, "survey", repo_path, compute, no_cache
+        )
+        if history:
+            database = sqlite_utils.Database(db)
+            if history_head(database, result["repo"]) == clones.head(repo_path):
+                result["history"] = history_summary(database, result["repo"])
+            else:
+                with clones.repository(repo_path) as (git_dir, _):
+                    result["history"] = update_history(
+                        database, result["repo"], git_dir
+                    )
+    else:
+        if not os.path.exists(repo_path):
+            raise click.BadParameter(f"Local path does not exist: {repo_path}")
+        click.echo(f"Surveying repository: {repo_path}", err=True)
+        with trace_span("survey", repo=repo_path):
+            result = survey_tree(repo_path, workers=workers)
+        result["repo"] = os.path.abspath(repo_path)
+        if history and git_head(repo_path):
+            result["history"] = update_history(
+                sqlite_utils.Database(db), result["repo"], repo_path
+            )
 
-    if embeddings:
-        click.echo("Showing repository embeddings:")
-        # TODO: Implement embeddings display
+    with trace_span("db.save", table="surveys"):
+        save_survey(sqlite_utils.Database(db), result)
+    click.echo(json.dumps(result, indent=2))
 
 
-@cli.command()
-@click.option(
-    "--repo-path",
-    required=True,
-    help="Path to the repository to extract links from. Can be a GitHub URL or local path",
-)
-def extract_links(repo_path: str):
-    """Extract all links from the repository's README file."""
-    if repo_path.startswith("http"):
-        with tempfile.TemporaryDirectory(prefix="tmp_repo_") as tmp_dir:
-            subprocess.run(
-                ["git", "clone", "--depth=1", repo_path, tmp_dir],
+def is_remote(repo_path: str) -> bool:
+    """Whether repo_path is a URL git should clone rather than a local path."""
+    return bool(re.match(r"(https?|git|ssh|file)://|[\w.-]+@[\w.-]+:", repo_path))
+
+
+def remote_head(url: str) -> Optional[str]:
+    """Resolve the commit a remote's HEAD points at without cloning it."""
+    try:
+        with trace_span("git.ls-remote", url=url):
+            result = subprocess.run(
+                ["git", "ls-remote", url, "HEAD"],
                 check=True,
                 capture_output=True,
                 text=True,
+                timeout=60,
             )
-            links = parse_repo(tmp_dir)
-    else:
-        if not os.path.exists(repo_path):
-            raise click.BadParameter(f"Local path does not exist: {repo_path}")
-        links = parse_repo(repo_path)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
+    line = result.stdout.split("\n", 1)[0]
+    return line.split("\t", 1)[0] or None
 
-    click.secho(json.dumps(links, indent=2))
 
+class CloneCache:
+    """Blob-less bare clones of remote repos, kept on disk between runs.
 
-def parse_repo(repo_path: str) -> list[str]:
-    """Parse a repository and extract all links from its README file.
+    Each remote gets one bare partial clone (--filter=blob:none) that later
+    runs bring up to date with an incremental fetch. Checkouts are
+    worktrees of that clone, so only the blobs of the checked out files are
+    downloaded, and a sparse checkout downloads just the files it names.
+    Clones beyond max_bytes are evicted least recently used first.
+    """
 
-    Args:
-        repo_path: Path to the local repository
+    def __init__(self, root: str, max_bytes: int = 5 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        # Remote HEADs resolved, and remotes fetched, by this instance, so
+        # one command asks the remote about each URL only once
+        self.heads = {}
+        self.fetched = set()
 
-    Returns:
-        List of unique URLs found in the README
+    def head(self, url: str) -> Optional[str]:
+        """The commit the remote's HEAD points at, or the one fetched from it."""
+        if url not in self.heads:
+            self.heads[url] = remote_head(url)
+        return self.heads[url]
 
-    Raises:
-        click.ClickException: If no README is found
-    """
-    readme_path = find_readme(repo_path)
-    if not readme_path:
-        raise click.ClickException("No README file found in the repository")
+    def path(self, url: str) -> str:
+        name = re.sub(r"^[a-z]+://|\.git$", "", url.rstrip("/"))
+        name = re.sub(r"[^\w.-]+", "_", name)[-80:]
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:10]
+        return os.path.join(self.root, f"{name}-{digest}.git")
 
-    return extract_links_from_readme(readme_path)
+    @contextlib.contextmanager
+    def checkout(self, url: str, sparse: Optional[list[str]] = None):
+        """Check out the remote's HEAD, yielding (work tree path, commit SHA).
 
+        sparse limits the checkout to files matching those gitignore-style
+        patterns.
+        """
+        mirror = self.path(url)
+        with open(f"{mirror}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._update(url, mirror)
+            os.utime(mirror)
+            with tempfile.TemporaryDirectory(prefix="tmp_repo_") as tmp_dir:
+                work_tree = os.path.join(tmp_dir, "checkout")
+                _git(
+                    "-C",
+                    mirror,
+                    "worktree",
+                    "add",
+                    "--detach",
+                    "--no-checkout",
+                    work_tree,
+                    "HEAD",
+                )
+                try:
+                    if sparse:
+                        _git(
+                            "-C",
+                            work_tree,
+                            "sparse-checkout",
+                            "set",
+                            "--no-cone",
+                            *sparse,
+                        )
+                    _git("-C", work_tree, "checkout", "--quiet")
+                    yield work_tree, git_head(work_tree)
+                finally:
+                    _git("-C", mirror, "worktree", "remove", "--force", work_tree)
+        self.evict(keep=mirror)
 
-def find_readme(repo_path: str) -> Optional[str]:
-    """Find the README file in the repository."""
-    readme_variants = ["README.md", "README.MD", "Readme.md", "readme.md"]
-    for variant in readme_variants:
-        path = os.path.join(repo_path, variant)
-        if os.path.exists(path):
-            return path
-    return None
+    @contextlib.contextmanager
+    def repository(self, url: str):
+        """Bring the remote's clone up to date, yielding (git dir, HEAD SHA).
 
+        Nothing is checked out, so reading history this way downloads no
+        file contents beyond those git needs for diffs. A clone this
+        instance already fetched, for a checkout say, isn't fetched again.
+        """
+        mirror = self.path(url)
+        with open(f"{mirror}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._update(url, mirror)
+            os.utime(mirror)
+            yield mirror, git_head(mirror)
+        self.evict(keep=mirror)
 
-def extract_links_from_readme(readme_path: str) -> list[str]:
-    """Extract all markdown and regular URLs from the README file."""
+    def _update(self, url: str, mirror: str):
+        if url in self.fetched and os.path.isdir(mirror):
+            return
+        if os.path.isdir(mirror):
+            click.echo(f"Fetching {url} into the clone cache...", err=True)
+            _git("-C", mirror, "worktree", "prune")
+            _git(
+                "-C",
+                mirror,
+                "fetch",
+                "--quiet",
+                "--filter=blob:none",
+                "--force",
+                "origin",
+                "HEAD",
+            )
+            _git("-C", mirror, "update-ref", "HEAD", "FETCH_HEAD")
+        else:
+            click.echo(f"Cloning {url} into the clone cache...", err=True)
+            partial = f"{mirror}.partial"
+            if os.path.isdir(partial):
+                shutil.rmtree(partial)
+            _git("clone", "--quiet", "--bare", "--filter=blob:none", url, partial)
+            os.rename(partial, mirror)
+        self.fetched.add(url)
+        self.heads[url] = git_head(mirror)
 
-    with open(readme_path, "r", encoding="utf-8") as f:
-        content = f.read()
+    def evict(self, keep: Optional[str] = None):
+        """Remove least recently used clones until the cache fits max_bytes."""
+        mirrors = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".git") and entry.is_dir():
+                mirrors.append(
+                    (entry.stat().st_mtime, entry.path, _disk_usage(entry.path))
+                )
+        total = sum(size for _, _, size in mirrors)
+        for _, path, size in sorted(mirrors):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            with open(f"{path}.lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+            os.remove(f"{path}.lock")
+            total -= size
 
-    # Only include github.com URLs that follow the pattern username/repo without additional paths
-    # example repo: https://github.com/skydoves/landscapist
-    repo_pattern = r"https:\/\/github\.com\/[^\/]+\/[^\/\s\n)]+"
-    links = []
 
-    # Extract bare URLs from the cleaned content
-    bare_urls = re.findall(repo_pattern, content)
-    links.extend(url.rstrip("/") for url in bare_urls)
+def _git(*args: str, input: Optional[str] = None) -> str:
+    # Name the span after the subcommand, skipping -C <path> and -c <config>
+    i = 0
+    while args[i] in ("-C", "-c"):
+        i += 2
+    command = args[i]
+    try:
+        with trace_span(f"git.{command}", args=" ".join(args)):
+            result = subprocess.run(
+                ["git", *args], check=True, capture_output=True, text=True, input=input
+            )
+    except subprocess.CalledProcessError as e:
+        raise click.ClickException(f"git {' '.join(args)} failed: {e.stderr}")
+    return result.stdout
 
-    return list(set(links))  # Remove duplicates
 
+def _disk_usage(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
 
-@cli.command()
-@click.option(
-    "--json-path",
-    required=True,
-    help="Path to a JSON file containing GitHub repository links.",
+
+def cached_clone_result(
+    cache: "ResultCache",
+    clones: CloneCache,
+    command: str,
+    url: str,
+    compute: Callable[[str], object],
+    no_cache: bool = False,
+    sparse: Optional[list[str]] = None,
+):
+    """Return compute(checkout of url), reusing the cached result for its HEAD.
+
+    The remote HEAD is resolved with git ls-remote first; when a result for
+    that commit is cached it is returned without touching the clone. Otherwise
+    the clone is updated, compute runs on a checkout and its result is cached.
+    """
+    sha = clones.head(url)
+    if sha and not no_cache:
+        cached = cache.get(command, url, sha)
+        trace_count("cache_hits" if cached is not None else "cache_misses")
+        if cached is not None:
+            click.echo(f"Using cached {command} of {url} at {sha[:12]}", err=True)
+            return cached
+    # Clone and fetch time shows up in the git.* spans
+    with clones.checkout(url, sparse=sparse) as (work_tree, sha):
+        with trace_span(command, url=url):
+            result = compute(work_tree)
+    if sha:
+        cache.put(command, url, sha, result)
+    return result
+
+
+LANGUAGES = {
+    ".c": "C",
+    ".h": "C",
+    ".cc": "C++",
+    ".cpp": "C++",
+    ".cxx": "C++",
+    ".hpp": "C++",
+    ".cs": "C#",
+    ".clj": "Clojure",
+    ".css": "CSS",
+    ".dart": "Dart",
+    ".ex": "Elixir",
+    ".exs": "Elixir",
+    ".erl": "Erlang",
+    ".go": "Go",
+    ".hs": "Haskell",
+    ".html": "HTML",
+    ".java": "Java",
+    ".js": "JavaScript",
+    ".jsx": "JavaScript",
+    ".mjs": "JavaScript",
+    ".cjs": "JavaScript",
+    ".jl": "Julia",
+    ".kt": "Kotlin",
+    ".kts": "Kotlin",
+    ".lua": "Lua",
+    ".md": "Markdown",
+    ".rst": "reStructuredText",
+    ".m": "Objective-C",
+    ".ml": "OCaml",
+    ".php": "PHP",
+    ".pl": "Perl",
+    ".py": "Python",
+    ".pyi": "Python",
+    ".r": "R",
+    ".rb": "Ruby",
+    ".rs": "Rust",
+    ".scala": "Scala",
+    ".scss": "SCSS",
+    ".sh": "Shell",
+    ".bash": "Shell",
+    ".sql": "SQL",
+    ".swift": "Swift",
+    ".ts": "TypeScript",
+    ".tsx": "TypeScript",
+    ".vue": "Vue",
+    ".zig": "Zig",
+    ".json": "JSON",
+    ".toml": "TOML",
+    ".yaml": "YAML",
+    ".yml": "YAML",
+}
+
+# Languages that are not code, so they stay out of the test ratio
+MARKUP_LANGUAGES = {
+    "CSS",
+    "HTML",
+    "JSON",
+    "Markdown",
+    "reStructuredText",
+    "SCSS",
+    "TOML",
+    "YAML",
+}
+
+MANIFESTS = {
+    "pyproject.toml",
+    "setup.py",
+    "setup.cfg",
+    "requirements.txt",
+    "Pipfile",
+    "environment.yml",
+    "package.json",
+    "Cargo.toml",
+    "go.mod",
+    "Gemfile",
+    "pom.xml",
+    "build.gradle",
+    "build.gradle.kts",
+    "composer.json",
+    "mix.exs",
+    "Package.swift",
+    "pubspec.yaml",
+    "CMakeLists.txt",
+    "deno.json",
+}
+
+TEST_FILE_PATTERN = re.compile(
+    r"(^|/)(tests?|__tests__|spec)/"
+    r"|(^|/)test_[^/]+\.py$"
+    r"|_test\.(py|go|rb|exs?)$"
+    r"|\.(test|spec)\.[jt]sx?$"
+    r"|Tests?\.(java|kt|cs|swift)$"
 )
-@click.option("--db", default="github.db", help="Path to SQLite database")
-def process_links(json_path: str, db: str):
-    """Process a JSON file containing GitHub repository links.
 
-    Each URL will be processed using github-to-sqlite and have it's result
-    written to the SQLite database.
 
+def survey_tree(
+    root: str, workers: Optional[int] = None, chunk_size: int = 512
+) -> dict:
+    """Analyze the files of a working tree.
+
+    The file list is split into chunks that are analyzed in parallel on a
+    process pool; small trees are analyzed in this process instead.
     """
-    if not os.path.exists(json_path):
-        raise click.BadParameter(f"JSON file does not exist: {json_path}")
+    import concurrent.futures
+
+    paths = list_repo_files(root)
+    chunks = [paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if workers == 1 or len(chunks) < 4:
+        partials = [_survey_chunk(root, chunk) for chunk in chunks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            partials = list(executor.map(_survey_chunk, itertools.repeat(root), chunks))
+
+    languages = {}
+    totals = collections.Counter()
+    for partial in partials:
+        for language, (files, lines) in partial.pop("languages").items():
+            counts = languages.setdefault(language, [0, 0])
+            counts[0] += files
+            counts[1] += lines
+        totals.update(partial)
 
+    names = {path.rsplit("/", 1)[-1] for path in paths}
+    lower_paths = {path.lower() for path in paths}
+    return {
+        "file_count": totals["files"],
+        "binary_file_count": totals["binary_files"],
+        "unreadable_file_count": totals["unreadable_files"],
+        "line_count": totals["lines"],
+        "code_file_count": totals["code_files"],
+        "test_file_count": totals["test_files"],
+        "test_ratio": (
+            round(totals["test_files"] / totals["code_files"], 4)
+            if totals["code_files"]
+            else 0.0
+        ),
+        "languages": {
+            language: {"files": files, "lines": lines}
+            for language, (files, lines) in sorted(
+                languages.items(), key=lambda item: -item[1][1]
+            )
+        },
+        "has_readme": any(name.lower().startswith("readme") for name in names),
+        "has_docs": any(
+            path.startswith(("docs/", "doc/", "documentation/")) for path in lower_paths
+        ),
+        "has_license": any(
+            name.lower().startswith(("license", "licence", "copying")) for name in names
+        ),
+        "has_contributing": any(
+            name.lower().startswith("contributing") for name in names
+        ),
+        "has_changelog": any(
+            name.lower().startswith(("changelog", "changes", "history"))
+            for name in names
+        ),
+        "manifests": sorted(
+            path
+            for path in paths
+            if path.rsplit("/", 1)[-1] in MANIFESTS
+            or re.search(r"(^|/)requirements[^/]*\.txt$", path)
+        ),
+        "head_sha": git_head(root),
+        "surveyed_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def git_head(root: str) -> Optional[str]:
+    """Return the commit checked out in a work tree, or None if it isn't one."""
     try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            links = json.load(f)
-    except json.JSONDecodeError as exc:
-        raise click.ClickException("Invalid JSON file") from exc
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=root,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
 
-    if not isinstance(links, list):
-        raise click.ClickException("JSON file must contain a list of URLs")
 
-    repo_pattern = r"github\.com\/([^/]+/[^/]+)"
+def list_repo_files(root: str) -> list[str]:
+    """List the files of a tree that are not ignored, as relative / paths.
 
-    for link in links:
-        match = re.search(repo_pattern, link)
-        if match:
-            repo = match.group(1)
-            # Remove any trailing parts like /tree/main or .git
-            repo = repo.split("/tree/")[0].split(".git")[0]
+    Inside a git work tree this asks git, which applies every .gitignore
+    rule exactly; otherwise the tree is walked honouring .gitignore files.
+    """
+    if os.path.isdir(os.path.join(root, ".git")):
+        try:
+            result = subprocess.run(
+                ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+                cwd=root,
+                check=True,
+                capture_output=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        else:
+            paths = result.stdout.decode("utf-8", "surrogateescape").split("\0")
+            return [
+                path
+                for path in paths
+                if path and os.path.isfile(os.path.join(root, path))
+            ]
+    return list(_walk_unignored(root, "", []))
 
-            click.echo(f"Processing: {repo}")
-            try:
-                subprocess.run(
-                    ["uv", "run", "github-to-sqlite", "repos", db, "-r", repo],
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                )
-                click.echo(f"✓ Processed: {repo}")
-            except subprocess.CalledProcessError as e:
-                click.echo(f"✗ Error processing {repo}: {e.stderr}", err=True)
+
+def _walk_unignored(root: str, relative: str, rules: list) -> Iterator[str]:
+    directory = os.path.join(root, relative)
+    gitignore = os.path.join(directory, ".gitignore")
+    if os.path.isfile(gitignore):
+        with open(gitignore, encoding="utf-8", errors="replace") as f:
+            rules = rules + _gitignore_rules(f, relative)
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name == ".git":
+            continue
+        path = f"{relative}{entry.name}"
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if _is_ignored(path, is_dir, rules):
+            continue
+        if is_dir:
+            yield from _walk_unignored(root, f"{path}/", rules)
+        elif entry.is_file(follow_symlinks=False):
+            yield path
+
+
+def _gitignore_rules(lines, base: str) -> list[tuple]:
+    """Translate .gitignore lines into (regex, negated, directory_only) rules."""
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        line = line.removeprefix("!")
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        anchored = "/" in line
+        line = line.lstrip("/")
+        pattern = ""
+        i = 0
+        while i < len(line):
+            if line.startswith("**/", i):
+                pattern += "(?:.*/)?"
+                i += 3
+            elif line.startswith("**", i):
+                pattern += ".*"
+                i += 2
+            elif line[i] == "*":
+                pattern += "[^/]*"
+                i += 1
+            elif line[i] == "?":
+                pattern += "[^/]"
+                i += 1
+            else:
+                pattern += re.escape(line[i])
+                i += 1
+        prefix = re.escape(base) if anchored else re.escape(base) + "(?:.*/)?"
+        rules.append((re.compile(f"{prefix}{pattern}"), negated, directory_only))
+    return rules
+
+
+def _is_ignored(path: str, is_dir: bool, rules: list[tuple]) -> bool:
+    ignored = False
+    for regex, negated, directory_only in rules:
+        if directory_only and not is_dir:
+            continue
+        if regex.fullmatch(path):
+            ignored = not negated
+    return ignored
+
+
+def _survey_chunk(root: str, paths: list[str]) -> dict:
+    """Count files and lines per language for some of a tree's files."""
+    languages = {}
+    totals = collections.Counter(
+        files=0, binary_files=0, unreadable_files=0, lines=0, code_files=0, test_files=0
+    )
+    for path in paths:
+        try:
+            lines = _count_lines(os.path.join(root, path))
+        except OSError as e:
+            click.echo(f"✗ Skipping unreadable {path}: {e.strerror}", err=True)
+            totals["unreadable_files"] += 1
+            continue
+        if lines is None:
+            totals["binary_files"] += 1
+            continue
+        totals["files"] += 1
+        totals["lines"] += lines
+        name = path.rsplit("/", 1)[-1]
+        language = LANGUAGES.get(os.path.splitext(name)[1].lower())
+        if language is None and name in ("Dockerfile", "Makefile"):
+            language = name
+        if language is None:
+            continue
+        counts = languages.setdefault(language, [0, 0])
+        counts[0] += 1
+        counts[1] += lines
+        if language not in MARKUP_LANGUAGES:
+            totals["code_files"] += 1
+            if TEST_FILE_PATTERN.search(path):
+                totals["test_files"] += 1
+    return {"languages": languages, **totals}
+
+
+def _count_lines(path: str, block_size: int = 1 << 20) -> Optional[int]:
+    """Count a file's lines a block at a time, or return None if it's binary.
+
+    Raises OSError if the file can't be read.
+    """
+    with open(path, "rb") as f:
+        block = f.read(8192)
+        if b"\0" in block:
+            return None
+        lines = 0
+        last = b""
+        while block:
+            lines += block.count(b"\n")
+            last = block
+            block = f.read(block_size)
+    if last and not last.endswith(b"\n"):
+        lines += 1
+    return lines
+
+
+def save_survey(db: sqlite_utils.Database, result: dict):
+    """Save a survey to the surveys table, replacing any earlier one."""
+    db["surveys"].insert(
+        result, pk="repo", replace=True, alter=True, columns={"languages": str}
+    )
+    if db["repo_scores_state"].exists():
+        # The surveys triggers may only just have been created
+        ensure_repo_scores(db)
+        with db.conn:
+            db.execute("UPDATE repo_scores_state SET dirty = 1")
+
+
+class Commit(NamedTuple):
+    sha: str
+    author: str
+    timestamp: int
+    additions: int
+    deletions: int
+
+
+def iter_git_log(git_dir: str, revisions: list[str]) -> Iterator[Commit]:
+    """Stream commits, newest first, from `git log --numstat`.
+
+    Output is parsed line by line as git writes it, so memory stays flat
+    however long the history is. Authors are identified by lower-cased
+    (mailmapped) email, and binary files add no lines.
+    """
+    commit = None
+    for line in _git_lines(
+        "-C",
+        git_dir,
+        "log",
+        "--numstat",
+        "--no-renames",
+        "--format=%x1e%H%x09%at%x09%aE",
+        *revisions,
+        "--",
+    ):
+        if line.startswith("\x1e"):
+            if commit:
+                yield Commit(*commit)
+            sha, timestamp, email = line[1:].rstrip("\n").split("\t", 2)
+            commit = [sha, email.lower(), int(timestamp), 0, 0]
+        elif commit and line.strip():
+            added, deleted, _ = line.split("\t", 2)
+            if added != "-":
+                commit[3] += int(added)
+                commit[4] += int(deleted)
+    if commit:
+        yield Commit(*commit)
+
+
+def prefetch_diff_blobs(git_dir: str, revisions: list[str]) -> int:
+    """Download the blobs `git log --numstat` will diff over revisions at once.
+
+    In a blob-less clone git fetches missing blobs lazily as git log reaches
+    them, about one round trip per commit. Instead the blobs are listed from
+    `git log --raw`, which only reads trees, those rev-list reports as
+    already present are dropped, and the rest come from the promisor remote
+    in a single fetch. Returns how many blobs were requested.
+    """
+    remote = _promisor_remote(git_dir)
+    if remote is None:
+        return 0
+    wanted = set()
+    for line in _git_lines(
+        "-C",
+        git_dir,
+        "log",
+        "--raw",
+        "--no-abbrev",
+        "--no-renames",
+        "--format=",
+        *revisions,
+        "--",
+    ):
+        # :<old mode> <new mode> <old blob> <new blob> <status>\t<path>
+        if line.startswith(":"):
+            wanted.update(oid for oid in line.split(" ", 4)[2:4] if oid.strip("0"))
+    # Blobs outside the revisions, from the first commit's parent, stay wanted
+    for line in _git_lines(
+        "-C",
+        git_dir,
+        "rev-list",
+        "--objects",
+        "--no-object-names",
+        "--missing=print",
+        *revisions,
+    ):
+        if not line.startswith("?"):
+            wanted.discard(line.rstrip("\n"))
+    if wanted:
+        _git(
+            "-c",
+            "fetch.negotiationAlgorithm=noop",
+            "-C",
+            git_dir,
+            "fetch",
+            "--quiet",
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--recurse-submodules=no",
+            "--filter=blob:none",
+            remote,
+            "--stdin",
+            input="\n".join(sorted(wanted)) + "\n",
+        )
+    return len(wanted)
+
+
+def _promisor_remote(git_dir: str) -> Optional[str]:
+    """The remote a partial clone fetches missing objects from, if it is one."""
+    result = subprocess.run(
+        ["git", "-C", git_dir, "config", "--get-regexp"]
+        + [r"^remote\..*\.promisor$|^extensions\.partialclone$"],
+        capture_output=True,
+        text=True,
+    )
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition(" ")
+        if key == "extensions.partialclone":
+            return value
+        if value == "true":
+            return key.removeprefix("remote.").removesuffix(".promisor")
+    return None
+
+
+def _git_lines(*args: str) -> Iterator[str]:
+    """Stream a git command's output line by line as git writes it."""
+    process = subprocess.Popen(
+        ["git", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+    )
+    try:
+        yield from process.stdout
+        if process.wait():
+            raise click.ClickException(
+                f"git {' '.join(args)} failed: {process.stderr.read()}"
+            )
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def ensure_history_tables(db: sqlite_utils.Database):
+    """Create the git history tables and the repo_activity view.
+
+    repo_weekly_authors keeps commits and changed lines per repo, week
+    (the Monday it starts on, UTC) and author, which is what lets new
+    commits be added without re-reading old ones while weekly contributor
+    counts stay distinct. repo_activity rolls it up per week, and
+    repo_history remembers the last analyzed commit.
+    """
+    db.executescript(
+        """CREATE TABLE IF NOT EXISTS repo_weekly_authors (
+            repo TEXT NOT NULL,
+            week TEXT NOT NULL,
+            author TEXT NOT NULL,
+            commits INTEGER NOT NULL,
+            additions INTEGER NOT NULL,
+            deletions INTEGER NOT NULL,
+            PRIMARY KEY (repo, week, author)
+        );
+        CREATE TABLE IF NOT EXISTS repo_history (
+            repo TEXT PRIMARY KEY,
+            last_sha TEXT NOT NULL,
+            first_commit_at TEXT,
+            last_commit_at TEXT,
+            analyzed_at TEXT NOT NULL
+        );
+        CREATE VIEW IF NOT EXISTS repo_activity AS
+            SELECT
+                repo,
+                week,
+                sum(commits) AS commits,
+                count(*) AS contributors,
+                sum(additions) AS additions,
+                sum(deletions) AS deletions
+            FROM repo_weekly_authors
+            GROUP BY repo, week;"""
+    )
+
+
+def history_head(db: sqlite_utils.Database, repo: str) -> Optional[str]:
+    """The last commit whose history has been analyzed for repo, if any."""
+    if not db["repo_history"].exists():
+        return None
+    row = db.execute(
+        "SELECT last_sha FROM repo_history WHERE repo = ?", [repo]
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _is_ancestor(git_dir: str, ancestor: str, commit: str) -> bool:
+    result = subprocess.run(
+        ["git", "-C", git_dir, "merge-base", "--is-ancestor", ancestor, commit],
+        capture_output=True,
+    )
+    return result.returncode == 0
+
+
+def update_history(db: sqlite_utils.Database, repo: str, git_dir: str) -> dict:
+    """Add commits made since the last analysis of repo and summarize it.
+
+    Only last_sha..HEAD is read. If HEAD no longer descends from the last
+    analyzed commit (history was rewritten) the repo is analyzed afresh.
+    """
+    import datetime
+
+    ensure_history_tables(db)
+    head = git_head(git_dir)
+    last = history_head(db, repo)
+    if head is None or head == last:
+        return history_summary(db, repo)
+    revisions = [head]
+    if last and _is_ancestor(git_dir, last, head):
+        revisions = [f"{last}..{head}"]
+    elif last:
+        with db.conn:
+            db.execute("DELETE FROM repo_weekly_authors WHERE repo = ?", [repo])
+            db.execute("DELETE FROM repo_history WHERE repo = ?", [repo])
+
+    blobs = prefetch_diff_blobs(git_dir, revisions)
+    weekly = collections.defaultdict(lambda: [0, 0, 0])
+    first_at = last_at = None
+    with trace_span("history.log", repo=repo, revisions=revisions[0], blobs=blobs):
+        for commit in iter_git_log(git_dir, revisions):
+            day = datetime.datetime.fromtimestamp(commit.timestamp, datetime.UTC)
+            week = (day.date() - datetime.timedelta(days=day.weekday())).isoformat()
+            totals = weekly[week, commit.author]
+            totals[0] += 1
+            totals[1] += commit.additions
+            totals[2] += commit.deletions
+            first_at = min(first_at or day, day)
+            last_at = max(last_at or day, day)
+    with db.conn:
+        db.conn.executemany(
+            """INSERT INTO repo_weekly_authors
+                (repo, week, author, commits, additions, deletions)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (repo, week, author) DO UPDATE SET
+                commits = commits + excluded.commits,
+                additions = additions + excluded.additions,
+                deletions = deletions + excluded.deletions""",
+            [(repo, *key, *totals) for key, totals in weekly.items()],
+        )
+        db.execute(
+            """INSERT INTO repo_history
+                (repo, last_sha, first_commit_at, last_commit_at, analyzed_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (repo) DO UPDATE SET
+                last_sha = excluded.last_sha,
+                first_commit_at = coalesce(
+                    min(first_commit_at, excluded.first_commit_at),
+                    first_commit_at, excluded.first_commit_at
+                ),
+                last_commit_at = coalesce(
+                    max(last_commit_at, excluded.last_commit_at),
+                    last_commit_at, excluded.last_commit_at
+                ),
+                analyzed_at = excluded.analyzed_at""",
+            [
+                repo,
+                head,
+                first_at and first_at.isoformat(),
+                last_at and last_at.isoformat(),
+                datetime.datetime.now(datetime.UTC).isoformat(),
+            ],
+        )
+    summary = history_summary(db, repo)
+    summary["new_commits"] = sum(totals[0] for totals in weekly.values())
+    return summary
+
+
+def history_summary(db: sqlite_utils.Database, repo: str) -> dict:
+    """Commit cadence, contributors and recency for an analyzed repo."""
+    import datetime
+
+    if not db["repo_history"].exists():
+        return {}
+    row = db.execute(
+        """SELECT last_sha, first_commit_at, last_commit_at FROM repo_history
+        WHERE repo = ?""",
+        [repo],
+    ).fetchone()
+    if row is None:
+        return {}
+    last_sha, first_commit_at, last_commit_at = row
+    commits, contributors = db.execute(
+        """SELECT coalesce(sum(commits), 0), count(DISTINCT author)
+        FROM repo_weekly_authors WHERE repo = ?""",
+        [repo],
+    ).fetchone()
+    now = datetime.datetime.now(datetime.UTC)
+    year_ago = (now - datetime.timedelta(weeks=52)).date().isoformat()
+    active_weeks, recent_commits, recent_contributors = db.execute(
+        """SELECT count(DISTINCT week), coalesce(sum(commits), 0),
+            count(DISTINCT author)
+        FROM repo_weekly_authors WHERE repo = ? AND week >= ?""",
+        [repo, year_ago],
+    ).fetchone()
+    summary = {
+        "last_sha": last_sha,
+        "commits": commits,
+        "contributors": contributors,
+        "first_commit_at": first_commit_at,
+        "last_commit_at": last_commit_at,
+        "active_weeks_last_year": active_weeks,
+        "commits_last_year": recent_commits,
+        "contributors_last_year": recent_contributors,
+    }
+    if last_commit_at:
+        age = now - datetime.datetime.fromisoformat(last_commit_at)
+        summary["days_since_last_commit"] = age.days
+    return summary
+
+
+REPO_LIST_SORTS = {
+    # sort: (ORDER BY, keyset columns compared against the cursor)
+    # Names sort case-insensitively, matching the index lookups use
+    "name": ("full_name COLLATE NOCASE", "full_name COLLATE NOCASE > ?"),
+    # Missing star counts sort, and are written in cursors, as 0
+    "stars": (
+        "coalesce(stargazers_count, 0) DESC, id",
+        "(coalesce(stargazers_count, 0) < ? "
+        "OR (coalesce(stargazers_count, 0) = ? AND id > ?))",
+    ),
+}
+
+
+@cli.command()
+@click.option(
+    "--filter", "filter_term", help="Full-text search of name, description and topics"
+)
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--sort",
+    type=click.Choice(list(REPO_LIST_SORTS)),
+    default="name",
+    show_default=True,
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    default=50,
+    show_default=True,
+    help="Repositories per page.",
+)
+@click.option(
+    "--after",
+    help="Cursor printed at the end of the previous page.",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["table", "jsonl"]),
+    default="table",
+    show_default=True,
+)
+def list_repos(
+    filter_term: Optional[str],
+    db: str,
+    sort: str,
+    limit: int,
+    after: Optional[str],
+    output_format: str,
+):
+    """List all repositories in the benchmark database.
+
+    --filter searches an FTS5 index of repo names, descriptions and topics.
+    Pages are fetched by keyset pagination: pass the cursor printed after a
+    page as --after to get the next one, which costs the same however deep
+    into the list it is.
+    """
+    import sqlite_utils
+
+    database = sqlite_utils.Database(db)
+    if not database["repos"].exists():
+        raise click.ClickException("No repos table: run rb process-links first")
+    ensure_repo_search(database)
+    order_by, keyset = REPO_LIST_SORTS[sort]
+    where = []
+    params = []
+    if filter_term:
+        where.append("id IN (SELECT rowid FROM repos_fts WHERE repos_fts MATCH ?)")
+        params.append(database.quote_fts(filter_term))
+    if after:
+        if sort == "stars":
+            try:
+                stars, repo_id = (int(part) for part in after.split(":"))
+            except ValueError:
+                raise click.BadParameter(
+                    "Expected a cursor like 120:456", param_hint="--after"
+                )
+            params += [stars, stars, repo_id]
+        else:
+            params.append(after)
+        where.append(keyset)
+    sql = (
+        "SELECT id, full_name, stargazers_count, language, description FROM repos"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + f" ORDER BY {order_by} LIMIT ?"
+    )
+    last = None
+    count = 0
+    for repo_id, full_name, stars, language, description in database.execute(
+        sql, params + [limit]
+    ):
+        count += 1
+        last = (repo_id, full_name, stars)
+        if output_format == "jsonl":
+            click.echo(
+                json.dumps(
+                    {
+                        "full_name": full_name,
+                        "stargazers_count": stars,
+                        "language": language,
+                        "description": description,
+                    }
+                )
+            )
+        else:
+            description = (description or "").replace("\n", " ")
+            if len(description) > 60:
+                description = description[:59] + "…"
+            click.echo(
+                f"{full_name:<40} {stars or 0:>7} {language or '':<12} {description}"
+            )
+    if count == limit and last:
+        cursor = last[1] if sort == "name" else f"{last[2] or 0}:{last[0]}"
+        click.echo(f"Next page: --after {cursor}", err=True)
+
+
+@cli.command()
+@click.option("--repo-name", required=True, help="Name of the repository to inspect.")
+@click.option("--stats", is_flag=True, help="Show detailed statistics")
+@click.option("--embeddings", is_flag=True, help="Show repository embeddings")
+@click.option("--db", default="github.db", help="Path to SQLite database")
+def inspect(repo_name: str, stats: bool, embeddings: bool, db: str):
+    """View detailed information about a specific repository."""
+    import sqlite_utils
+
+    click.echo(f"Inspecting repository: {repo_name}")
+
+    if stats:
+        click.echo("Showing detailed statistics:")
+        database = sqlite_utils.Database(db)
+        if not database["repos"].exists():
+            raise click.ClickException("No repos table: run rb process-links first")
+        update_repo_scores(database)
+        scores = next(
+            database["repo_scores"].rows_where(
+                "full_name = ? COLLATE NOCASE", [repo_name]
+            ),
+            None,
+        )
+        if scores is None:
+            raise click.ClickException(f"{repo_name} is not in the repos table")
+        language = scores["language"] or "no language"
+        click.echo(
+            f"- Overall: {_format_percentile(scores['score'])} percentile, "
+            f"{_format_percentile(scores['language_score'])} among "
+            f"{scores['peers']} {language} repos"
+        )
+        for metric in SCORE_METRICS:
+            click.echo(
+                f"- {metric}: {_format_value(metric, scores[metric])} "
+                f"({_format_percentile(scores[f'{metric}_percentile'])} percentile, "
+                f"{_format_percentile(scores[f'{metric}_language_percentile'])} "
+                f"in {language})"
+            )
+
+    if embeddings:
+        click.echo("Showing repository embeddings:")
+        database = sqlite_utils.Database(db)
+        if not database["repo_embeddings"].exists():
+            raise click.ClickException("No embeddings have been stored yet")
+        rows = database.execute(
+            "SELECT model, dims, embedding, updated_at FROM repo_embeddings "
+            "WHERE repo = ? ORDER BY model",
+            [repo_name],
+        ).fetchall()
+        if not rows:
+            click.echo("- No embeddings for this repository")
+        for model, dims, blob, updated_at in rows:
+            vector = decode_embedding(blob)
+            preview = ", ".join(f"{value:.4f}" for value in vector[:8])
+            click.echo(f"- {model}: {dims} dims, updated {updated_at}")
+            click.echo(f"  [{preview}{', ...' if dims > 8 else ''}]")
+
+
+# Metrics repos are ranked on, as SQL over repos r LEFT JOIN surveys s
+SCORE_METRICS = {
+    "stars": "r.stargazers_count",
+    "forks": "r.forks_count",
+    "size": "r.size",
+    "activity": "CAST(strftime('%s', r.pushed_at) AS INTEGER)",
+    "test_ratio": "s.test_ratio",
+}
+
+
+def _format_percentile(value: Optional[float]) -> str:
+    return "n/a" if value is None else f"{value:.0f}th"
+
+
+def _format_value(metric: str, value) -> str:
+    if value is None:
+        return "n/a"
+    if metric == "activity":
+        return "last push " + time.strftime("%Y-%m-%d", time.gmtime(value))
+    if float(value).is_integer():
+        return str(int(value))
+    return f"{value:.3g}"
+
+
+def percentile_ranks(values):
+    """Percentile of each value within values, ignoring NaNs.
+
+    Ties share the midpoint of their ranks, so every copy of the same value
+    gets the same percentile.
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(values.shape, np.nan)
+    valid = ~np.isnan(values)
+    present = np.sort(values[valid])
+    if len(present):
+        below = np.searchsorted(present, values[valid], side="left")
+        at_or_below = np.searchsorted(present, values[valid], side="right")
+        result[valid] = (below + at_or_below) / (2 * len(present)) * 100
+    return result
+
+
+def ensure_repo_scores(db: sqlite_utils.Database):
+    """Create repo_scores and the triggers that mark it stale.
+
+    Any insert, delete or change to a ranked column of repos or surveys
+    sets the dirty flag in repo_scores_state, so scores are only recomputed
+    when something they depend on has changed.
+    """
+    metric_columns = ", ".join(
+        f"{metric} REAL, {metric}_percentile REAL, {metric}_language_percentile REAL"
+        for metric in SCORE_METRICS
+    )
+    db.executescript(
+        f"""CREATE TABLE IF NOT EXISTS repo_scores (
+            repo_id INTEGER PRIMARY KEY,
+            full_name TEXT,
+            language TEXT,
+            peers INTEGER,
+            score REAL,
+            language_score REAL,
+            {metric_columns}
+        );
+        CREATE INDEX IF NOT EXISTS repo_scores_full_name
+            ON repo_scores (full_name COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS repo_scores_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            dirty INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO repo_scores_state (id, dirty) VALUES (1, 1);"""
+    )
+    watched = {
+        "repos": "stargazers_count, forks_count, size, pushed_at, language, full_name",
+        "surveys": "test_ratio, repo",
+    }
+    for table, columns in watched.items():
+        if not db[table].exists():
+            continue
+        for event in ("INSERT", "DELETE", f"UPDATE OF {columns}"):
+            name = f"{table}_scores_{event.split()[0].lower()}"
+            db.execute(
+                f"CREATE TRIGGER IF NOT EXISTS [{name}] AFTER {event} ON [{table}] "
+                "BEGIN UPDATE repo_scores_state SET dirty = 1; END"
+            )
+
+
+def update_repo_scores(db: sqlite_utils.Database, force: bool = False) -> int:
+    """Recompute repo_scores if repos or surveys changed since the last run.
+
+    Every metric is loaded into one array, ranked overall and within each
+    language with vectorized percentile_ranks, and only rows whose scores
+    changed are written back. Returns the number of rows written.
+    """
+    import numpy as np
+
+    ensure_repo_scores(db)
+    dirty = db.execute("SELECT dirty FROM repo_scores_state").fetchone()[0]
+    if not dirty and not force:
+        return 0
+    has_surveys = db["surveys"].exists() and "test_ratio" in db["surveys"].columns_dict
+    expressions = ", ".join(
+        expression if has_surveys or not expression.startswith("s.") else "NULL"
+        for expression in SCORE_METRICS.values()
+    )
+    join = (
+        "LEFT JOIN surveys s ON s.repo = r.full_name COLLATE NOCASE"
+        if has_surveys
+        else ""
+    )
+    rows = db.execute(
+        f"SELECT r.id, r.full_name, r.language, {expressions} FROM repos r {join} "
+        "GROUP BY r.id ORDER BY r.id"
+    ).fetchall()
+    ids = [row[0] for row in rows]
+    names = [row[1] for row in rows]
+    languages = np.array([row[2] or "" for row in rows], dtype=object)
+    values = np.array(
+        [[np.nan if v is None else v for v in row[3:]] for row in rows],
+        dtype=np.float64,
+    ).reshape(len(rows), len(SCORE_METRICS))
+
+    overall = np.column_stack(
+        [percentile_ranks(values[:, i]) for i in range(len(SCORE_METRICS))]
+    ).reshape(values.shape)
+    by_language = np.full(values.shape, np.nan)
+    peers = np.zeros(len(rows), dtype=np.int64)
+    for language in np.unique(languages):
+        mask = languages == language
+        peers[mask] = mask.sum()
+        for i in range(len(SCORE_METRICS)):
+            by_language[mask, i] = percentile_ranks(values[mask, i])
+
+    def mean(percentiles):
+        counts = (~np.isnan(percentiles)).sum(axis=1)
+        totals = np.nansum(percentiles, axis=1)
+        return np.where(counts > 0, totals / np.maximum(counts, 1), np.nan)
+
+    score = mean(overall)
+    language_score = mean(by_language)
+
+    def clean(value):
+        return None if np.isnan(value) else round(float(value), 4)
+
+    new_rows = {}
+    for i, repo_id in enumerate(ids):
+        new_rows[repo_id] = (
+            repo_id,
+            names[i],
+            languages[i] or None,
+            int(peers[i]),
+            clean(score[i]),
+            clean(language_score[i]),
+            *(
+                value
+                for j in range(len(SCORE_METRICS))
+                for value in (
+                    rows[i][3 + j],
+                    clean(overall[i, j]),
+                    clean(by_language[i, j]),
+                )
+            ),
+        )
+    existing = {row[0]: row for row in db.execute("SELECT * FROM repo_scores")}
+    changed = [row for repo_id, row in new_rows.items() if existing.get(repo_id) != row]
+    gone = [(repo_id,) for repo_id in existing if repo_id not in new_rows]
+    placeholders = ", ".join("?" for _ in range(6 + 3 * len(SCORE_METRICS)))
+    with db.conn:
+        db.conn.executemany(
+            f"INSERT OR REPLACE INTO repo_scores VALUES ({placeholders})", changed
+        )
+        db.conn.executemany("DELETE FROM repo_scores WHERE repo_id = ?", gone)
+        db.execute("UPDATE repo_scores_state SET dirty = 0")
+    return len(changed) + len(gone)
+
+
+@cli.command(name="inspect-user")
+@click.option("--login", required=True, help="GitHub user or organization login.")
+@click.option("--db", default="github.db", help="Path to SQLite database")
+def inspect_user(login: str, db: str):
+    """Show how an owner's repositories compare with other owners'."""
+    import sqlite_utils
+
+    database = sqlite_utils.Database(db)
+    if not database["repos"].exists():
+        raise click.ClickException("No repos table: run rb process-links first")
+    if not database["owner_stats"].exists():
+        refresh_owner_stats(database)
+    stats = next(
+        database["owner_stats"].rows_where("login = ? COLLATE NOCASE", [login]),
+        None,
+    )
+    if stats is None:
+        raise click.ClickException(f"No repos owned by {login} in {db}")
+    owners = database["owner_stats"].count
+    click.echo(f"Inspecting user: {stats['login']}")
+    for column, label in (
+        ("total_stars", "Total stars"),
+        ("median_stars", "Median stars"),
+        ("repo_count", "Repositories"),
+    ):
+        # Owners ahead of this one, counted through the column's index
+        ahead = database.execute(
+            f"SELECT COUNT(*) FROM owner_stats WHERE {column} > ?", [stats[column]]
+        ).fetchone()[0]
+        click.echo(
+            f"- {label}: {_format_value(column, stats[column])} "
+            f"(#{ahead + 1} of {owners} owners)"
+        )
+    languages = json.loads(stats["languages"] or "{}")
+    mix = ", ".join(f"{language} {count}" for language, count in languages.items())
+    click.echo(f"- Languages: {mix or 'none'}")
+    click.echo(
+        f"- Last push: {stats['last_pushed_at'] or 'never'}, "
+        f"{stats['active_repos']} repos pushed to in the last 90 days"
+    )
+
+
+OWNER_STATS_INDEXES = ("total_stars", "median_stars", "repo_count")
+
+
+def ensure_owner_stats(db: sqlite_utils.Database):
+    index_sql = "\n".join(
+        f"CREATE INDEX IF NOT EXISTS owner_stats_{column} "
+        f"ON owner_stats ({column} DESC);"
+        for column in OWNER_STATS_INDEXES
+    )
+    db.executescript(
+        f"""CREATE TABLE IF NOT EXISTS owner_stats (
+            owner_id INTEGER PRIMARY KEY REFERENCES users(id),
+            login TEXT,
+            repo_count INTEGER,
+            total_stars INTEGER,
+            median_stars REAL,
+            total_forks INTEGER,
+            languages TEXT,
+            top_language TEXT,
+            last_pushed_at TEXT,
+            active_repos INTEGER,
+            updated_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS owner_stats_login
+            ON owner_stats (login COLLATE NOCASE);
+        {index_sql}"""
+    )
+
+
+def refresh_owner_stats(
+    db: sqlite_utils.Database, owner_ids: Optional[list[int]] = None
+) -> int:
+    """Recompute the owner_stats rows of owner_ids, or of every owner.
+
+    Ingestion passes just the owners of the repos it wrote, so the rollup
+    costs a few indexed lookups per batch rather than a scan of repos.
+    Returns the number of owners refreshed.
+    """
+    ensure_owner_stats(db)
+    where = ""
+    params = []
+    if owner_ids is not None:
+        if not owner_ids:
+            return 0
+        where = "WHERE r.owner IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(owner_ids)))
+    now = time.time()
+    active_since = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - 90 * 86400))
+    owners = {}
+    for owner, login, stars, forks, language, pushed_at in db.execute(
+        "SELECT r.owner, u.login, r.stargazers_count, r.forks_count, r.language, "
+        f"r.pushed_at FROM repos r LEFT JOIN users u ON u.id = r.owner {where} "
+        "ORDER BY r.owner, r.stargazers_count",
+        params,
+    ):
+        if owner is None:
+            continue
+        stats = owners.setdefault(
+            owner,
+            {
+                "login": login,
+                "stars": [],
+                "forks": 0,
+                "languages": collections.Counter(),
+                "last_pushed_at": None,
+                "active": 0,
+            },
+        )
+        stats["stars"].append(stars or 0)
+        stats["forks"] += forks or 0
+        if language:
+            stats["languages"][language] += 1
+        if pushed_at:
+            if stats["last_pushed_at"] is None or pushed_at > stats["last_pushed_at"]:
+                stats["last_pushed_at"] = pushed_at
+            if pushed_at >= active_since:
+                stats["active"] += 1
+    updated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+    rows = []
+    for owner, stats in owners.items():
+        # Stars arrive sorted, so the median is the middle of the list
+        stars = stats["stars"]
+        middle = len(stars) // 2
+        median = (
+            stars[middle] if len(stars) % 2 else (stars[middle - 1] + stars[middle]) / 2
+        )
+        languages = dict(stats["languages"].most_common())
+        rows.append(
+            (
+                owner,
+                stats["login"],
+                len(stars),
+                sum(stars),
+                median,
+                stats["forks"],
+                json.dumps(languages),
+                next(iter(languages), None),
+                stats["last_pushed_at"],
+                stats["active"],
+                updated_at,
+            )
+        )
+    with db.conn:
+        if owner_ids is None:
+            db.execute("DELETE FROM owner_stats")
+        else:
+            gone = set(owner_ids) - set(owners)
+            db.conn.executemany(
+                "DELETE FROM owner_stats WHERE owner_id = ?", [(o,) for o in gone]
+            )
+        db.conn.executemany(
+            "INSERT OR REPLACE INTO owner_stats VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    return len(rows)
+
+
+@cli.command()
+@click.option(
+    "--repo-name",
+    "repo_names",
+    required=True,
+    multiple=True,
+    help="Repository to find neighbours of. Repeat to query several at once.",
+)
+@click.option("-k", "k", type=click.IntRange(min=1), default=10, show_default=True)
+@click.option(
+    "--model",
+    help="Embedding model to compare with (default: the only one stored).",
+)
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--nprobe",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Index lists to search: higher is slower but finds more true neighbours.",
+)
+@click.option(
+    "--exact",
+    is_flag=True,
+    help="Compare against every embedding even if an ANN index exists.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Output JSON.")
+def similar(
+    repo_names: tuple[str, ...],
+    k: int,
+    model: Optional[str],
+    db: str,
+    nprobe: int,
+    exact: bool,
+    as_json: bool,
+):
+    """Find the repositories most similar to REPO_NAME by cosine similarity.
+
+    Uses the model's ANN index when one has been built with `rb ann build`,
+    otherwise compares against every stored embedding.
+    """
+    import sqlite_utils
+
+    database = sqlite_utils.Database(db)
+    model = resolve_embedding_model(database, model)
+    index_path = ann_index_path(db, model)
+    if not exact and AnnIndex.exists(index_path):
+        queries = load_embeddings(database, model, repo_names)
+        missing = [name for name in repo_names if name not in queries]
+        if missing:
+            raise click.ClickException(
+                f"No {model} embedding for: {', '.join(missing)}"
+            )
+        index = AnnIndex(index_path)
+        results = index.search(
+            [queries[name] for name in repo_names], k + 1, nprobe=nprobe
+        )
+        results = [
+            [match for match in matches if match[0] != name][:k]
+            for name, matches in zip(repo_names, results)
+        ]
+    else:
+        store = EmbeddingMatrix.load(database, model)
+        missing = [name for name in repo_names if name not in store.index]
+        if missing:
+            raise click.ClickException(
+                f"No {model} embedding for: {', '.join(missing)}"
+            )
+        queries = [store.index[name] for name in repo_names]
+        results = store.top_k(store.vectors[queries], k, exclude=queries)
+    output = {
+        name: [{"repo": repo, "score": round(score, 6)} for repo, score in matches]
+        for name, matches in zip(repo_names, results)
+    }
+    if as_json:
+        click.echo(json.dumps(output, indent=2))
+        return
+    for name, matches in output.items():
+        if len(repo_names) > 1:
+            click.echo(f"{name}:")
+        for match in matches:
+            click.echo(f"{match['score']:.4f}  {match['repo']}")
+
+
+@cli.group()
+def ann():
+    """Approximate nearest neighbour index over repository embeddings."""
+
+
+@ann.command(name="build")
+@click.option("--model", help="Embedding model to index (default: the only one).")
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--lists",
+    type=click.IntRange(min=1),
+    help="Number of IVF lists (default: sqrt(number of embeddings)).",
+)
+@click.option("--iterations", type=click.IntRange(min=1), default=10, show_default=True)
+def ann_build(model: Optional[str], db: str, lists: Optional[int], iterations: int):
+    """Build the ANN index for a model from its stored embeddings."""
+    import sqlite_utils
+
+    database = sqlite_utils.Database(db)
+    model = resolve_embedding_model(database, model)
+    start = time.perf_counter()
+    store = EmbeddingMatrix.load(database, model)
+    path = ann_index_path(db, model)
+    index = AnnIndex.build(
+        path, store.names, store.vectors, lists=lists, iterations=iterations
+    )
+    click.echo(
+        f"Indexed {index.count} {model} embeddings into {index.lists} lists "
+        f"at {path} in {time.perf_counter() - start:.1f}s"
+    )
+
+
+@ann.command(name="bench")
+@click.option("--model", help="Embedding model to benchmark (default: the only one).")
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option("-k", "k", type=click.IntRange(min=1), default=10, show_default=True)
+@click.option(
+    "--queries",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Number of stored embeddings to use as queries.",
+)
+@click.option(
+    "--nprobe",
+    "nprobes",
+    default="1,2,4,8,16,32",
+    show_default=True,
+    help="Comma separated nprobe values to try.",
+)
+def ann_bench(model: Optional[str], db: str, k: int, queries: int, nprobes: str):
+    """Report the index's recall@k and latency against exact search."""
+    import numpy as np
+    import sqlite_utils
+
+    database = sqlite_utils.Database(db)
+    model = resolve_embedding_model(database, model)
+    path = ann_index_path(db, model)
+    if not AnnIndex.exists(path):
+        raise click.ClickException(f"No ANN index for {model}: run rb ann build")
+    store = EmbeddingMatrix.load(database, model)
+    index = AnnIndex(path)
+    rows = np.random.default_rng(0).choice(
+        len(store.names), size=min(queries, len(store.names)), replace=False
+    )
+    start = time.perf_counter()
+    exact = store.top_k(store.vectors[rows], k, exclude=list(rows))
+    exact_ms = (time.perf_counter() - start) * 1000 / len(rows)
+    click.echo(f"exact: {exact_ms:.2f}ms/query over {len(store.names)} embeddings")
+    for nprobe in [int(value) for value in nprobes.split(",")]:
+        latencies = []
+        hits = 0
+        for row, truth in zip(rows, exact):
+            start = time.perf_counter()
+            (matches,) = index.search(store.vectors[[row]], k + 1, nprobe=nprobe)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found = {name for name, _ in matches if name != store.names[row]}
+            hits += len(found & {name for name, _ in truth})
+        recall = hits / sum(len(truth) for truth in exact)
+        click.echo(
+            f"nprobe={nprobe}: recall@{k} {recall:.3f}, "
+            f"p50 {percentile(latencies, 50):.2f}ms, "
+            f"p95 {percentile(latencies, 95):.2f}ms"
+        )
+
+
+@cli.command()
+@click.option(
+    "-m",
+    "--model",
+    required=True,
+    help="llm embedding model ID, or rb-hash for the built-in local model.",
+)
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=32,
+    show_default=True,
+    help="Texts per embed_multi batch.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="READMEs to fetch concurrently.",
+)
+@click.option(
+    "--queue-size",
+    type=click.IntRange(min=1),
+    default=256,
+    show_default=True,
+    help="Texts waiting to be embedded before fetching pauses.",
+)
+@click.option(
+    "--readme/--no-readme",
+    default=True,
+    show_default=True,
+    help="Include each repo's README, fetched from the GitHub API.",
+)
+@click.option(
+    "--max-chars",
+    type=click.IntRange(min=1),
+    default=8000,
+    show_default=True,
+    help="Truncate each text to this many characters.",
+)
+@click.option(
+    "--api-url",
+    default=GITHUB_API_URL,
+    envvar="GITHUB_API_URL",
+    show_default=True,
+    help="Base URL of the GitHub API.",
+)
+@click.option(
+    "--token",
+    "tokens",
+    multiple=True,
+    help="GitHub token. Repeat to rotate between several.",
+)
+def embed(
+    model: str,
+    db: str,
+    batch_size: int,
+    workers: int,
+    queue_size: int,
+    readme: bool,
+    max_chars: int,
+    api_url: str,
+    tokens: tuple[str, ...],
+):
+    """Embed every repository in the repos table with an llm embedding model.
+
+    Each repo's text is built from its name, description, topics and README
+    and hashed. Repos whose text already has a vector for the model are
+    skipped (or reuse it, if the same text belongs to another repo) and the
+    rest are sent to the model in batches through llm's embed_multi. README
+    fetches run on a thread pool that feeds a bounded queue, so fetching
+    overlaps with embedding without piling up texts in memory.
+    """
+    import sqlite_utils
+
+    database = sqlite_utils.Database(db)
+    if not database["repos"].exists():
+        raise click.ClickException("No repos table: run rb process-links first")
+    embedding_model = get_embedding_model(model)
+    repos = [
+        dict(zip(("full_name", "description", "topics"), row))
+        for row in database.execute(
+            "SELECT full_name, description, topics FROM repos ORDER BY full_name"
+        )
+    ]
+    client = None
+    if readme:
+        client = GitHubClient(
+            tokens=tokens or github_tokens_from_env(),
+            api_url=api_url,
+            pool_size=workers,
+        )
+    start = time.monotonic()
+    try:
+        stats = embed_repos(
+            database,
+            repos,
+            embedding_model,
+            model,
+            client=client,
+            batch_size=batch_size,
+            workers=workers,
+            queue_size=queue_size,
+            max_chars=max_chars,
+        )
+    finally:
+        if client is not None:
+            client.close()
+    elapsed = time.monotonic() - start
+    click.echo(
+        f"Embedded {stats['embedded']} repos in {elapsed:.1f}s: "
+        f"{stats['unchanged']} unchanged, {stats['reused']} reused, "
+        f"{stats['failed']} failures"
+    )
+
+
+def get_embedding_model(model_id: str):
+    """Look up an llm embedding model, including the built-in rb-hash model."""
+    if model_id == HashEmbeddingModel.model_id:
+        return HashEmbeddingModel()
+    import llm
+
+    try:
+        return llm.get_embedding_model(model_id)
+    except llm.UnknownModelError as exc:
+        raise click.ClickException(str(exc))
+
+
+class HashEmbeddingModel:
+    """A deterministic local embedding model using the hashing trick.
+
+    Each lower-cased word is hashed to one of `dims` signed buckets, so
+    texts sharing words get similar vectors. It needs no network access or
+    API key, which makes it useful for tests and trying rb out. It follows
+    llm's EmbeddingModel interface.
+    """
+
+    model_id = "rb-hash"
+    batch_size = 100
+    dims = 256
+
+    def embed_batch(self, items) -> Iterator[list[float]]:
+        for item in items:
+            vector = [0.0] * self.dims
+            for word in re.findall(r"\w+", item.lower()):
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                vector[value % self.dims] += 1.0 if value >> 63 else -1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            yield [v / norm for v in vector]
+
+    def embed_multi(self, items, batch_size: Optional[int] = None):
+        items = iter(items)
+        while batch := list(itertools.islice(items, batch_size or self.batch_size)):
+            yield from self.embed_batch(batch)
+
+
+def repo_text(repo: dict, readme: Optional[str], max_chars: int) -> str:
+    """The text a repository is embedded from.
+
+    The name is left out unless there is nothing else, so forks and mirrors
+    with the same content share a vector.
+    """
+    parts = []
+    if repo.get("description"):
+        parts.append(repo["description"])
+    topics = repo.get("topics")
+    if isinstance(topics, str):
+        topics = json.loads(topics or "[]")
+    if topics:
+        parts.append("Topics: " + ", ".join(topics))
+    if readme:
+        parts.append(readme)
+    return "\n\n".join(parts or [repo["full_name"]])[:max_chars]
+
+
+def fetch_readme(client: "GitHubClient", full_name: str) -> Optional[str]:
+    """Fetch a repository's README as raw text, or None if it has none."""
+    import requests
+
+    try:
+        response = client.get(
+            f"/repos/{full_name}/readme",
+            headers={"Accept": "application/vnd.github.raw+json"},
+        )
+    except requests.HTTPError as exc:
+        if exc.response is not None and exc.response.status_code == 404:
+            return None
+        raise
+    return response.text
+
+
+def embed_repos(
+    db: sqlite_utils.Database,
+    repos: list[dict],
+    embedding_model,
+    model: str,
+    client: Optional["GitHubClient"] = None,
+    batch_size: int = 32,
+    workers: int = 8,
+    queue_size: int = 256,
+    max_chars: int = 8000,
+) -> collections.Counter:
+    """Embed repos whose text has changed, returning counts of what happened.
+
+    Worker threads fetch READMEs and put (full_name, text, hash) on a
+    bounded queue; this thread takes batches off it, embeds them and is the
+    only one that writes to the database.
+    """
+    import requests
+
+    ensure_embeddings_table(db)
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS repo_embeddings_content_hash "
+        "ON repo_embeddings (model, content_hash)"
+    )
+    current = dict(
+        db.execute(
+            "SELECT repo, content_hash FROM repo_embeddings WHERE model = ?",
+            [model],
+        ).fetchall()
+    )
+    stats = collections.Counter(embedded=0, unchanged=0, reused=0, failed=0)
+    pending = queue.Queue(maxsize=queue_size)
+    done = object()
+    remaining = iter(repos)
+    lock = threading.Lock()
+    # Unexpected worker errors are re-raised here once every worker stops
+    errors = []
+    stop = threading.Event()
+
+    def worker():
+        try:
+            while not stop.is_set():
+                with lock:
+                    repo = next(remaining, None)
+                if repo is None:
+                    return
+                try:
+                    readme = fetch_readme(client, repo["full_name"]) if client else None
+                except requests.RequestException as exc:
+                    pending.put((repo["full_name"], exc, None))
+                    continue
+                text = repo_text(repo, readme, max_chars)
+                content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                pending.put((repo["full_name"], text, content_hash))
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+        finally:
+            pending.put(done)
+
+    threads = [
+        threading.Thread(target=worker, daemon=True)
+        for _ in range(min(workers, len(repos)) or 1)
+    ]
+    for thread in threads:
+        thread.start()
+
+    def flush(batch):
+        # Identical texts in a batch, or already stored for another repo,
+        # are embedded at most once
+        known = dict(
+            db.execute(
+                "SELECT content_hash, embedding FROM repo_embeddings "
+                "WHERE model = ? AND content_hash IN "
+                "(SELECT value FROM json_each(?))",
+                [model, json.dumps([h for _, _, h in batch])],
+            ).fetchall()
+        )
+        texts = {h: text for _, text, h in batch if h not in known}
+        with trace_span("embed.batch", texts=len(texts)):
+            vectors = embedding_model.embed_multi(list(texts.values()), batch_size)
+            known.update(zip(texts, vectors))
+        rows = []
+        for full_name, _, content_hash in batch:
+            vector = known[content_hash]
+            if isinstance(vector, bytes):
+                vector = decode_embedding(vector)
+                stats["reused"] += 1
+            else:
+                stats["embedded"] += 1
+            rows.append((full_name, vector, content_hash))
+        with trace_span("db.save", table="repo_embeddings", rows=len(rows)):
+            save_embeddings(db, model, rows)
+        trace_count("rows", len(rows))
+        click.echo(f"Embedded {stats['embedded']} repos...", err=True)
+
+    batch = []
+    finished = 0
+    while finished < len(threads):
+        item = pending.get()
+        if item is done:
+            finished += 1
+            continue
+        if stop.is_set():
+            # A worker failed: drain the queue so the others can finish
+            continue
+        full_name, text, content_hash = item
+        if isinstance(text, Exception):
+            stats["failed"] += 1
+            click.echo(f"✗ Error fetching {full_name}: {text}", err=True)
+        elif current.get(full_name) == content_hash:
+            stats["unchanged"] += 1
+        else:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+    if errors:
+        raise errors[0]
+    if batch:
+        flush(batch)
+    return stats
+
+
+def encode_embedding(vector) -> bytes:
+    """Pack a vector as contiguous little-endian float32 values."""
+    import numpy as np
+
+    return np.asarray(vector, dtype="<f4").tobytes()
+
+
+def decode_embedding(blob: bytes):
+    import numpy as np
+
+    return np.frombuffer(blob, dtype="<f4")
+
+
+def ensure_embeddings_table(db: sqlite_utils.Database):
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS repo_embeddings (
+            repo TEXT NOT NULL,
+            model TEXT NOT NULL,
+            dims INTEGER NOT NULL,
+            embedding BLOB NOT NULL,
+            content_hash TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (repo, model)
+        )"""
+    )
+
+
+def save_embeddings(
+    db: sqlite_utils.Database,
+    model: str,
+    embeddings: list[tuple[str, object, Optional[str]]],
+):
+    """Store (repo, vector, content_hash) embeddings for a model."""
+    ensure_embeddings_table(db)
+    updated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    rows = []
+    for repo, vector, content_hash in embeddings:
+        blob = encode_embedding(vector)
+        rows.append((repo, model, len(blob) // 4, blob, content_hash, updated_at))
+    with db.conn:
+        db.conn.executemany(
+            "INSERT OR REPLACE INTO repo_embeddings "
+            "(repo, model, dims, embedding, content_hash, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    # Keep an existing ANN index current without rebuilding it
+    db_file = db.execute("PRAGMA database_list").fetchone()[2]
+    index_path = ann_index_path(db_file, model) if db_file else None
+    if rows and index_path and AnnIndex.exists(index_path):
+        AnnIndex(index_path).add(
+            [row[0] for row in rows], [decode_embedding(row[3]) for row in rows]
+        )
+
+
+def load_embeddings(
+    db: sqlite_utils.Database, model: str, repos: list[str]
+) -> dict[str, object]:
+    """Return {repo: vector} for the repos that have an embedding."""
+    return {
+        repo: decode_embedding(blob)
+        for repo, blob in db.execute(
+            "SELECT repo, embedding FROM repo_embeddings WHERE model = ? "
+            "AND repo IN (SELECT value FROM json_each(?))",
+            [model, json.dumps(list(repos))],
+        )
+    }
+
+
+def resolve_embedding_model(db: sqlite_utils.Database, model: Optional[str]) -> str:
+    if not db["repo_embeddings"].exists():
+        raise click.ClickException("No embeddings have been stored yet")
+    models = [
+        row[0] for row in db.execute("SELECT DISTINCT model FROM repo_embeddings")
+    ]
+    if model is None:
+        if len(models) != 1:
+            raise click.ClickException(
+                f"Pick one of the stored models with --model: {', '.join(models)}"
+            )
+        return models[0]
+    if model not in models:
+        raise click.ClickException(f"No embeddings stored for model {model}")
+    return model
+
+
+class EmbeddingMatrix:
+    """Every embedding of one model as a single L2-normalized float32 matrix."""
+
+    def __init__(self, names: list[str], vectors):
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.vectors = vectors
+
+    @classmethod
+    def load(cls, db: sqlite_utils.Database, model: str) -> "EmbeddingMatrix":
+        import numpy as np
+
+        names = []
+        blobs = []
+        dims = None
+        for repo, row_dims, blob in db.execute(
+            "SELECT repo, dims, embedding FROM repo_embeddings WHERE model = ? "
+            "ORDER BY repo",
+            [model],
+        ):
+            if dims is None:
+                dims = row_dims
+            elif row_dims != dims:
+                raise click.ClickException(
+                    f"{repo} has {row_dims} dims but other {model} embeddings "
+                    f"have {dims}"
+                )
+            names.append(repo)
+            blobs.append(blob)
+        # One frombuffer over the joined blobs avoids a copy per row
+        vectors = np.frombuffer(b"".join(blobs), dtype="<f4").reshape(
+            len(names), dims or 0
+        )
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return cls(names, (vectors / norms).astype(np.float32, copy=False))
+
+    def top_k(
+        self, queries, k: int, exclude: Optional[list[int]] = None, block: int = 65536
+    ) -> list[list[tuple[str, float]]]:
+        """The k nearest rows to each query row, best first.
+
+        Scores are computed a block of rows at a time with one matrix product
+        per block; argpartition keeps the best k of each block.
+        """
+        import numpy as np
+
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+        k = min(k, len(self.names))
+        if k == 0:
+            return [[] for _ in queries]
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.names), block):
+            scores = queries @ self.vectors[start : start + block].T
+            if exclude is not None:
+                for q, row in enumerate(exclude):
+                    if start <= row < start + block:
+                        scores[q, row - start] = -np.inf
+            take = min(k, scores.shape[1])
+            part = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+            best_scores = np.concatenate(
+                [best_scores, np.take_along_axis(scores, part, axis=1)], axis=1
+            )
+            best_rows = np.concatenate([best_rows, part + start], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [
+            [
+                (self.names[row], float(score))
+                for row, score in zip(rows, scores)
+                if score != -np.inf
+            ]
+            for rows, scores in zip(best_rows, best_scores)
+        ]
+
+
+def ann_index_path(db_path: str, model: str) -> str:
+    """Directory holding the ANN index of a model's embeddings in db_path."""
+    root, _ = os.path.splitext(db_path)
+    return os.path.join(f"{root}.ann", re.sub(r"[^\w.-]+", "_", model))
+
+
+def _normalize(vectors):
+    import numpy as np
+
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class AnnIndex:
+    """Inverted file (IVF) index of normalized embeddings, kept on disk.
+
+    The vectors are clustered around lists centroids and stored sorted by
+    cluster in vectors.npy, so each list is a contiguous slice. Queries
+    memory-map the files and score only the nprobe lists whose centroids
+    are nearest, which means only those pages are read from disk. Vectors
+    added after the build are appended to a small delta segment that is
+    searched exhaustively, then folded into the lists once it grows.
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.names = np.load(os.path.join(path, "names.npy"), mmap_mode="r")
+        self.delta_names = []
+        delta_names_path = os.path.join(path, "delta_names.txt")
+        if os.path.exists(delta_names_path):
+            with open(delta_names_path, encoding="utf-8") as f:
+                self.delta_names = f.read().splitlines()
+        delta_path = os.path.join(path, "delta.f32")
+        dims = self.meta["dims"]
+        if self.delta_names:
+            self.delta = np.memmap(
+                delta_path,
+                dtype="<f4",
+                mode="r",
+                shape=(len(self.delta_names), dims),
+            )
+        else:
+            self.delta = np.empty((0, dims), dtype=np.float32)
+
+    @property
+    def count(self) -> int:
+        return len(self.names)
+
+    @property
+    def lists(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        names: list[str],
+        vectors,
+        lists: Optional[int] = None,
+        iterations: int = 10,
+        centroids=None,
+    ) -> "AnnIndex":
+        """Cluster vectors into lists and write a fresh index to path."""
+        import numpy as np
+
+        vectors = _normalize(vectors)
+        if not len(names):
+            raise click.ClickException("There are no embeddings to index")
+        if centroids is None:
+            lists = min(lists or max(1, int(math.sqrt(len(names)))), len(names))
+            centroids = _kmeans(vectors, lists, iterations)
+        assignment = _nearest_centroid(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=len(centroids)))
+        encoded = np.array([name.encode("utf-8") for name in names])
+
+        # Write next to the old index and swap, so readers never see half of it
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "centroids.npy"), centroids)
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, "vectors.npy"), vectors[order])
+        np.save(os.path.join(tmp_path, "names.npy"), encoded[order])
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "dims": int(vectors.shape[1]),
+                    "count": len(names),
+                    "lists": len(centroids),
+                    "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                },
+                f,
+            )
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return cls(path)
+
+    def add(self, names: list[str], vectors):
+        """Append vectors to the delta segment, folding it in once it's large.
+
+        A name that is already indexed is superseded by its new vector.
+        """
+        vectors = _normalize(vectors)
+        if vectors.shape[1] != self.meta["dims"]:
+            raise click.ClickException(
+                f"Index has {self.meta['dims']} dims, got {vectors.shape[1]}"
+            )
+        with open(os.path.join(self.path, "delta.f32"), "ab") as f:
+            f.write(vectors.astype("<f4").tobytes())
+        with open(os.path.join(self.path, "delta_names.txt"), "a") as f:
+            f.writelines(f"{name}\n" for name in names)
+        delta_count = len(self.delta_names) + len(names)
+        if delta_count > max(1024, self.count // 10):
+            self.compact()
+        else:
+            self.__init__(self.path)
+
+    def compact(self):
+        """Rebuild the lists with the delta folded in, keeping the centroids."""
+        import numpy as np
+
+        self.__init__(self.path)
+        latest = {}
+        for i, name in enumerate(self.delta_names):
+            latest[name] = i
+        keep = [
+            i for i, name in enumerate(self.names) if name.decode("utf-8") not in latest
+        ]
+        names = [self.names[i].decode("utf-8") for i in keep] + list(latest)
+        vectors = np.concatenate(
+            [self.vectors[keep], self.delta[list(latest.values())]]
+        )
+        centroids = np.array(self.centroids)
+        del self.vectors, self.delta
+        AnnIndex.build(self.path, names, vectors, centroids=centroids)
+        self.__init__(self.path)
+
+    def search(self, queries, k: int, nprobe: int = 8) -> list[list[tuple[str, float]]]:
+        """The approximate k nearest neighbours of each query, best first."""
+        import numpy as np
+
+        queries = _normalize(queries)
+        nprobe = min(nprobe, self.lists)
+        latest = {name: i for i, name in enumerate(self.delta_names)}
+        delta_rows = list(latest.values())
+        results = []
+        for query in queries:
+            centroid_scores = self.centroids @ query
+            probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            rows = np.concatenate(
+                [
+                    np.arange(self.offsets[i], self.offsets[i + 1])
+                    for i in np.sort(probe)
+                ]
+            )
+            scores = self.vectors[rows] @ query
+            # Over-fetch so superseded rows can be dropped and still leave k
+            take = min(k + len(latest), len(rows))
+            matches = []
+            if take:
+                best = np.argpartition(-scores, take - 1)[:take]
+                for i in best:
+                    name = self.names[rows[i]].decode("utf-8")
+                    if name not in latest:
+                        matches.append((name, float(scores[i])))
+            if delta_rows:
+                delta_scores = self.delta[delta_rows] @ query
+                matches.extend(
+                    (self.delta_names[row], float(score))
+                    for row, score in zip(delta_rows, delta_scores)
+                )
+            matches.sort(key=lambda match: -match[1])
+            results.append(matches[:k])
+        return results
+
+
+def _kmeans(vectors, lists: int, iterations: int, seed: int = 0):
+    """Spherical k-means centroids, trained on a sample of the vectors."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    if len(vectors) > lists * 64:
+        sample = vectors[rng.choice(len(vectors), lists * 64, replace=False)]
+    else:
+        sample = vectors
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest_centroid(sample, centroids)
+        sums = np.zeros(centroids.shape, dtype=centroids.dtype)
+        np.add.at(sums, assignment, sample)
+        # Duplicate vectors leave clusters empty; keep their old centroids
+        empty = np.bincount(assignment, minlength=lists) == 0
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _nearest_centroid(vectors, centroids, block: int = 65536):
+    import numpy as np
+
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + block] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), block)
+        ]
+    )
+
+
+@cli.command()
+@click.option(
+    "--repo-path",
+    required=True,
+    help="Path to the repository to extract links from. Can be a GitHub URL or local path",
+)
+@click.option(
+    "--db",
+    default="github.db",
+    help="Database whose state file holds the result cache.",
+)
+@cache_options
+def extract_links(
+    repo_path: str,
+    db: str,
+    no_cache: bool,
+    cache_size: int,
+    clone_cache: str,
+    clone_cache_size: int,
+):
+    """Extract all links from the repository's README file."""
+    if is_remote(repo_path):
+        cache = ResultCache(state_path(db), max_bytes=cache_size)
+        clones = CloneCache(clone_cache, max_bytes=clone_cache_size)
+        # Only the README is checked out, so no other blobs are downloaded
+        links = cached_clone_result(
+            cache,
+            clones,
+            "extract-links",
+            repo_path,
+            parse_repo,
+            no_cache,
+            sparse=[f"/{variant}" for variant in README_VARIANTS],
+        )
+    else:
+        if not os.path.exists(repo_path):
+            raise click.BadParameter(f"Local path does not exist: {repo_path}")
+        links = parse_repo(repo_path)
+
+    click.secho(json.dumps(links, indent=2))
+
+
+@cli.command(name="cache-stats")
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option("--clear", is_flag=True, help="Empty the cache after reporting.")
+def cache_stats(db: str, clear: bool):
+    """Show how the survey and extract-links result cache is doing."""
+    cache = ResultCache(state_path(db))
+    stats = cache.stats()
+    if clear:
+        cache.clear()
+        stats["cleared"] = True
+    click.echo(json.dumps(stats, indent=2))
+
+
+@cli.group()
+def debug():
+    """Diagnostics for rb itself."""
+
+
+@debug.command(
+    name="import-time",
+    context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False},
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.option("--top", default=20, show_default=True, help="Number of modules to list.")
+def import_time(args: tuple[str, ...], top: int):
+    """Show what a cold `rb ARGS...` spends importing.
+
+    \b
+        rb debug import-time --top 10 list-repos --help
+
+    Runs the command (default `--help`) in a fresh interpreter with
+    `python -X importtime` and lists the slowest imports by cumulative time,
+    indented by import depth. Heavy dependencies should only show up for the
+    commands that use them.
+    """
+    args = args or ("--help",)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import rb; rb.cli()", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    imports = parse_import_times(result.stderr)
+    total = sum(self_us for _, self_us, _, _ in imports)
+    click.echo(
+        f"rb {' '.join(args)}: {wall * 1000:.0f} ms wall, "
+        f"{len(imports)} modules imported in {total / 1000:.0f} ms"
+    )
+    click.echo(f"{'cumulative':>12} {'self':>10}  module")
+    slowest = sorted(imports, key=lambda item: item[2], reverse=True)[:top]
+    for name, self_us, cumulative_us, depth in slowest:
+        click.echo(
+            f"{cumulative_us / 1000:9.1f} ms {self_us / 1000:7.1f} ms  "
+            f"{'  ' * depth}{name}"
+        )
+
+
+def parse_import_times(stderr: str) -> list[tuple[str, int, int, int]]:
+    """Parse `-X importtime` output into (module, self us, cumulative us, depth)."""
+    imports = []
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)", line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return imports
+
+
+BENCH_SCENARIOS = {}
+
+
+def bench_scenario(name: str, unit: str):
+    """Register a benchmark scenario for `rb bench`.
+
+    A scenario is called with an ExitStack for cleanup, a scratch directory
+    and the BenchOptions, does its (untimed) setup and returns the number of
+    `unit`s each run processes and a function running one timed repetition.
+    """
+
+    def register(f):
+        BENCH_SCENARIOS[name] = (f, unit)
+        return f
+
+    return register
+
+
+class BenchOptions(NamedTuple):
+    scale: float
+    repeat: int
+    latency: float
+    rate_limit: int
+
+
+@bench_scenario("extract-links", unit="MB")
+def bench_extract_links(stack, workdir: str, options: BenchOptions):
+    import random
+
+    rng = random.Random(0)
+    size = int(4 * 1024 * 1024 * options.scale)
+    words = ["parser", "fast", "library", "for", "the", "async", "web", "and"]
+    parts = []
+    written = 0
+    while written < size:
+        if rng.random() < 0.3:
+            owner, repo = rng.randrange(5000), rng.randrange(20)
+            suffix = rng.choice(["", ".git", "/tree/main", "#readme", "/"])
+            line = (
+                f"- [repo {owner}](https://github.com/Owner{owner}/Repo{repo}{suffix})"
+            )
+        else:
+            line = " ".join(rng.choices(words, k=12))
+        parts.append(line + "\n")
+        written += len(line) + 1
+    readme = os.path.join(workdir, "README.md")
+    with open(readme, "w") as f:
+        f.writelines(parts)
+    return round(written / 1024 / 1024, 3), lambda: extract_links_from_readme(readme)
+
+
+class FakeGitHubAPI:
+    """A local stand-in for GitHub's /repos/{owner}/{repo} endpoint.
+
+    Every repo named repo<N> of owner bench exists. Each response waits
+    `latency` seconds first, and with a `rate_limit` the server allows that
+    many requests per one-second window, answering the rest with GitHub's
+    rate limited 403 and X-RateLimit-* headers.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limit: int = 0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        api = self
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.window = (0, 0)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(api.latency)
+                status, headers, body = api.respond(self.path)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def respond(self, path: str) -> tuple[int, dict, bytes]:
+        headers = {}
+        if self.rate_limit:
+            second = int(time.time())
+            with self.lock:
+                window, used = self.window
+                used = used + 1 if window == second else 1
+                self.window = (second, used)
+            remaining = max(self.rate_limit - used, 0)
+            headers = {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(remaining),
+                "X-RateLimit-Reset": str(second + 1),
+            }
+            if used > self.rate_limit:
+                return 403, headers, b'{"message": "API rate limit exceeded"}'
+        match = re.fullmatch(r"/repos/bench/repo(\d+)", path)
+        if not match:
+            return 404, headers, b'{"message": "Not Found"}'
+        repo_id = int(match.group(1))
+        repo = {
+            "id": repo_id,
+            "name": f"repo{repo_id}",
+            "full_name": f"bench/repo{repo_id}",
+            "html_url": f"https://github.com/bench/repo{repo_id}",
+            "description": f"Benchmark repository number {repo_id}",
+            "owner": {
+                "id": 1 + repo_id % 50,
+                "login": f"owner{repo_id % 50}",
+                "html_url": f"https://github.com/owner{repo_id % 50}",
+                "type": "User",
+            },
+            "license": None,
+            "topics": ["bench", f"topic{repo_id % 7}"],
+            "stargazers_count": repo_id * 7 % 1000,
+            "forks_count": repo_id % 30,
+            "size": repo_id * 13 % 5000,
+            "language": ["Python", "Go", "Rust"][repo_id % 3],
+            "pushed_at": "2025-01-01T00:00:00Z",
+        }
+        return 200, headers, json.dumps(repo).encode()
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@bench_scenario("process-links", unit="repos")
+def bench_process_links(stack, workdir: str, options: BenchOptions):
+    api = stack.enter_context(FakeGitHubAPI(options.latency, options.rate_limit))
+    count = max(int(500 * options.scale), 1)
+    links = os.path.join(workdir, "links.json")
+    with open(links, "w") as f:
+        json.dump([f"https://github.com/bench/repo{i}" for i in range(count)], f)
+    runs = itertools.count()
+
+    def run():
+        db = os.path.join(workdir, f"github-{next(runs)}.db")
+        args = ["process-links", "--json-path", links, "--db", db]
+        args += ["--workers", "8", "--api-url", api.url]
+        with (
+            open(os.devnull, "w") as devnull,
+            contextlib.redirect_stdout(devnull),
+            contextlib.redirect_stderr(devnull),
+        ):
+            _run_command(args)
+
+    return count, run
+
+
+def _run_command(args: list[str]):
+    """Run an rb command in-process, as part of the caller's trace.
+
+    The cli group's callback is skipped: it would start a new --trace, which
+    truncates the caller's trace file and ends it when the command returns.
+    """
+    name, *rest = args
+    cli.commands[name].main(rest, prog_name=f"rb {name}", standalone_mode=False)
+
+
+def start_bench_datasette(stack, workdir: str, db_path: str) -> tuple[str, str]:
+    """Serve db_path from a local Datasette; return its URL and a root token."""
+    import socket
+
+    import requests
+
+    secret = "rb-bench"
+    config = os.path.join(workdir, "datasette.json")
+    with open(config, "w") as f:
+        actions = ["create-table", "insert-row", "update-row", "delete-row"]
+        json.dump({"permissions": {a: {"id": "root"} for a in actions}}, f)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "datasette", "serve", db_path, "--port", str(port)]
+        + ["--secret", secret, "--config", config],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    stack.callback(process.wait)
+    stack.callback(process.terminate)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/-/versions.json", timeout=1).raise_for_status()
+            break
+        except requests.RequestException:
+            time.sleep(0.1)
+    else:
+        raise click.ClickException("Datasette didn't start for the benchmark")
+    return url, sign_datasette_token(secret, {"a": "root"})
+
+
+def bench_rows(stack, workdir: str, options: BenchOptions, operation: str):
+    import sqlite_utils
+
+    count = max(int(20_000 * options.scale), 1)
+    db_path = os.path.join(workdir, "bench.db")
+    db = sqlite_utils.Database(db_path)
+    db["rows"].create({"id": int, "name": str, "score": float}, pk="id")
+    if operation == "upsert":
+        # Upserts update every row that is already there
+        db["rows"].insert_all(
+            {"id": i, "name": "old", "score": 0} for i in range(count)
+        )
+    db.close()
+    url, token = start_bench_datasette(stack, workdir, db_path)
+    stack.enter_context(_environ(DATASETTE_AUTH_TOKEN=token))
+    # Inserts need fresh ids on every run; upserts rewrite the same rows
+    payloads = []
+    for run_number in range(options.repeat if operation == "insert" else 1):
+        payload = os.path.join(workdir, f"rows-{run_number}.jsonl")
+        with open(payload, "w") as f:
+            for i in range(run_number * count, (run_number + 1) * count):
+                f.write(json.dumps({"id": i, "name": f"row {i}", "score": i / 7}))
+                f.write("\n")
+        payloads.append(payload)
+    runs = itertools.count()
+
+    def run():
+        payload = payloads[next(runs) % len(payloads)]
+        args = ["datasette", f"{operation}-rows", "--database", "bench"]
+        args += ["--table", "rows", "--payload-file", payload, "--base-url", url]
+        args += ["--batch-size", "100", "--pipeline", "4"]
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+            _run_command(args)
+
+    return count, run
+
+
+@contextlib.contextmanager
+def _environ(**values: str):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@bench_scenario("insert-rows", unit="rows")
+def bench_insert_rows(stack, workdir: str, options: BenchOptions):
+    return bench_rows(stack, workdir, options, "insert")
+
+
+@bench_scenario("upsert-rows", unit="rows")
+def bench_upsert_rows(stack, workdir: str, options: BenchOptions):
+    return bench_rows(stack, workdir, options, "upsert")
+
+
+@bench_scenario("survey", unit="files")
+def bench_survey(stack, workdir: str, options: BenchOptions):
+    import random
+
+    rng = random.Random(0)
+    count = max(int(2000 * options.scale), 1)
+    extensions = [".py", ".js", ".go", ".rs", ".md", ".c"]
+    for i in range(count):
+        directory = os.path.join(workdir, f"pkg{i % 40}", f"mod{i % 7}")
+        os.makedirs(directory, exist_ok=True)
+        name = f"test_{i}" if i % 5 == 0 else f"file_{i}"
+        lines = rng.randrange(10, 400)
+        with open(os.path.join(directory, name + rng.choice(extensions)), "w") as f:
+            f.writelines(f"line {n} of file {i}\n" for n in range(lines))
+    return count, lambda: survey_tree(workdir, workers=os.cpu_count() or 1)
+
+
+@cli.command()
+@click.option(
+    "scenarios",
+    "--scenario",
+    "-s",
+    multiple=True,
+    type=click.Choice(list(BENCH_SCENARIOS)),
+    help="Scenario to run; repeat for several. Defaults to all of them.",
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Timed runs per scenario; the fastest counts.",
+)
+@click.option(
+    "--scale",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1.0,
+    show_default=True,
+    help="Multiply the size of every scenario's input.",
+)
+@click.option(
+    "--latency",
+    type=click.FloatRange(min=0),
+    default=0.005,
+    show_default=True,
+    help="Seconds the fake GitHub API waits before each response.",
+)
+@click.option(
+    "--rate-limit",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Requests per second the fake GitHub API allows; 0 for no limit.",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(dir_okay=False),
+    default="bench-baseline.json",
+    show_default=True,
+    help="JSON file of earlier results to compare against.",
+)
+@click.option("--save", is_flag=True, help="Save the results to --baseline.")
+@click.option(
+    "--threshold",
+    type=click.FloatRange(min=0, max=1),
+    default=0.2,
+    show_default=True,
+    help="Flag scenarios whose rate falls more than this fraction below baseline.",
+)
+def bench(
+    scenarios: tuple[str, ...],
+    repeat: int,
+    scale: float,
+    latency: float,
+    rate_limit: int,
+    baseline: str,
+    save: bool,
+    threshold: float,
+):
+    """Benchmark rb's hot paths against local stand-ins for GitHub and Datasette.
+
+    \b
+    extract-links  link extraction from a synthetic multi-MB README
+    process-links  ingestion from a fake GitHub API with latency/rate limits
+    insert-rows    streaming inserts into a local Datasette
+    upsert-rows    streaming upserts into a local Datasette
+    survey         surveying a generated source tree
+
+    Inputs are generated from a fixed seed, so runs are comparable. Each
+    scenario's best rate is compared with --baseline, and the command fails
+    if any regressed by more than --threshold. --save records the results as
+    the new baseline.
+    """
+    options = BenchOptions(scale, repeat, latency, rate_limit)
+    try:
+        with open(baseline) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {}
+    previous.setdefault("scenarios", {})
+    results = {}
+    for name in scenarios or BENCH_SCENARIOS:
+        scenario, unit = BENCH_SCENARIOS[name]
+        with (
+            tempfile.TemporaryDirectory(prefix=f"rb-bench-{name}-") as workdir,
+            contextlib.ExitStack() as stack,
+        ):
+            items, run = scenario(stack, workdir, options)
+            durations = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                durations.append(time.perf_counter() - start)
+        best = min(durations)
+        results[name] = {
+            "unit": unit,
+            "items": items,
+            "seconds": round(best, 6),
+            "median_seconds": round(sorted(durations)[len(durations) // 2], 6),
+            "rate": round(items / best, 3),
+            "options": options._asdict(),
+        }
+
+    click.echo(
+        f"{'scenario':<15} {'items':>10} {'best':>9} {'rate':>19} "
+        f"{'baseline':>12} {'change':>8}"
+    )
+    regressions = []
+    for name, result in results.items():
+        old = previous["scenarios"].get(name)
+        comparable = (
+            old
+            and old["items"] == result["items"]
+            and old["options"] == result["options"]
+        )
+        if comparable:
+            change = result["rate"] / old["rate"] - 1
+            status = f"{change:+7.1%}"
+            if change < -threshold:
+                regressions.append(name)
+                status += " REGRESSION"
+            baseline_rate = f"{old['rate']:>12.1f}"
+        else:
+            status = "     new" if not old else " not comparable"
+            baseline_rate = f"{'-':>12}"
+        click.echo(
+            f"{name:<15} {result['items']:>10} {result['seconds']:>8.3f}s "
+            f"{result['rate']:>10.1f} {result['unit'] + '/s':<8} {baseline_rate} "
+            f"{status}"
+        )
+    if save:
+        import platform
+
+        previous["scenarios"].update(results)
+        previous["environment"] = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        }
+        with open(baseline, "w") as f:
+            json.dump(previous, f, indent=2)
+            f.write("\n")
+        click.echo(f"Saved baseline to {baseline}", err=True)
+    if regressions:
+        raise click.ClickException(
+            f"{', '.join(regressions)} regressed more than {threshold:.0%} "
+            f"against {baseline}"
+        )
+
+
+def parse_repo(repo_path: str) -> list[str]:
+    """Parse a repository and extract all links from its README file.
+
+    Args:
+        repo_path: Path to the local repository
+
+    Returns:
+        List of unique URLs found in the README
+
+    Raises:
+        click.ClickException: If no README is found
+    """
+    with trace_span("readme.find", repo=repo_path):
+        readme_path = find_readme(repo_path)
+    if not readme_path:
+        raise click.ClickException("No README file found in the repository")
+
+    with trace_span("readme.parse", readme=readme_path):
+        return extract_links_from_readme(readme_path)
+
+
+README_VARIANTS = ["README.md", "README.MD", "Readme.md", "readme.md"]
+
+
+def find_readme(repo_path: str) -> Optional[str]:
+    """Find the README file in the repository."""
+    for variant in README_VARIANTS:
+        path = os.path.join(repo_path, variant)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# Only include github.com URLs that follow the pattern username/repo without
+# additional paths, e.g. https://github.com/skydoves/landscapist
+# Links end at whitespace or at quotes, brackets and commas around them, so
+# HTML attributes, <...> autolinks and lists of links split cleanly
+GITHUB_LINK_PATTERN = re.compile(
+    r"https:\/\/github\.com\/[^\/\s\"'<>]+\/[^\/\s)\"'<>\],]+"
+)
+
+
+def extract_links_from_readme(readme_path: str) -> list[str]:
+    """Extract all markdown and regular URLs from the README file."""
+
+    with open(readme_path, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    return extract_links_from_text(content)
+
+
+def extract_links_from_text(content: str) -> list[str]:
+    """Extract the unique GitHub repository URLs in some README text.
+
+    URLs are canonicalized, so links to the same repo in different forms
+    (case, .git, /tree/main, fragments) come back once, in order of first
+    appearance.
+    """
+    repos = links_to_repos(GITHUB_LINK_PATTERN.findall(content))
+    return [f"https://github.com/{repo}" for repo in repos]
+
+
+@cli.command()
+@click.option(
+    "--json-path",
+    help="Path to a JSON file containing GitHub repository links.",
+)
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of repositories to fetch concurrently.",
+)
+@click.option(
+    "--batch-size",
+    default=100,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of repositories to write per database transaction.",
+)
+@click.option(
+    "--api-url",
+    default=os.getenv("GITHUB_API_URL", GITHUB_API_URL),
+    show_default=True,
+    help="GitHub REST API base URL",
+)
+@click.option(
+    "--max-age",
+    type=DURATION,
+    help="Skip repos fetched more recently than this, e.g. 3600, 30m, 12h or 7d.",
+)
+@click.option(
+    "--token",
+    "tokens",
+    multiple=True,
+    help="GitHub token to rotate through; repeat for several tokens. "
+    "Defaults to the comma separated GITHUB_TOKENS, or GITHUB_TOKEN.",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Retries per repo after a rate limited (403/429) response.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue the previous run from its journal instead of a JSON file.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch repos that are already in the database again.",
+)
+def process_links(
+    json_path: Optional[str],
+    db: str,
+    workers: int,
+    batch_size: int,
+    api_url: str,
+    max_age: Optional[float],
+    tokens: tuple[str, ...],
+    max_retries: int,
+    resume: bool,
+    refresh: bool,
+):
+    """Process a JSON file containing GitHub repository links.
+
+    Each repository is fetched from the GitHub API and written to the SQLite
+    database using the same schema as github-to-sqlite. Set GITHUB_TOKEN to
+    authenticate requests.
+
+    With --workers N, up to N repositories are fetched concurrently while a
+    single writer saves them to the database, so that concurrent fetches
+    never contend for the SQLite write lock.
+
+    The ETag and Last-Modified validators of every fetch are cached next to
+    the database, so later runs send conditional requests and skip the
+    write when GitHub answers 304 Not Modified.
+
+    Requests are paced by GitHub's X-RateLimit headers, rotate between
+    tokens and back off on rate limited responses. Progress is journaled
+    next to the database; after a crash or an abandoned run, --resume
+    fetches every repo that was not completed.
+
+    Links are canonicalized to lower-case owner/repo names and repos that
+    are already in the database are skipped before any request is made,
+    unless --refresh is given.
+    """
+    import sqlite_utils
+
+    journal = FetchJournal(state_path(db))
+    if resume:
+        repos = journal.unfinished()
+        click.echo(f"Resuming: {len(repos)} repos left to process")
+    else:
+        if not json_path:
+            raise click.UsageError("Provide --json-path, or --resume a previous run")
+        if not os.path.exists(json_path):
+            raise click.BadParameter(f"JSON file does not exist: {json_path}")
+
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                links = json.load(f)
+        except json.JSONDecodeError as exc:
+            raise click.ClickException("Invalid JSON file") from exc
+
+        if not isinstance(links, list):
+            raise click.ClickException("JSON file must contain a list of URLs")
+
+        repos = links_to_repos(links)
+        if not refresh:
+            known = known_repos(sqlite_utils.Database(db), repos)
+            if known:
+                click.echo(f"Skipping {len(known)} repos already in {db}")
+                repos = [name for name in repos if name not in known]
+        journal.start(repos)
+
+    if not tokens:
+        tokens = github_tokens_from_env()
+    client = GitHubClient(
+        tokens=tokens, api_url=api_url, pool_size=workers, max_retries=max_retries
+    )
+    validators = ValidatorCache(state_path(db))
+    start = time.monotonic()
+    try:
+        stats = ingest_repos(
+            repos,
+            sqlite_utils.Database(db),
+            client,
+            workers,
+            batch_size,
+            validators=validators,
+            max_age=max_age,
+            journal=journal,
+        )
+    finally:
+        client.close()
+    elapsed = time.monotonic() - start
+    rate = len(repos) / elapsed if elapsed > 0 else 0.0
+    click.echo(
+        f"Processed {len(repos)} repos in {elapsed:.1f}s "
+        f"({rate:.2f} repos/sec): {stats['updated']} updated, "
+        f"{stats['not_modified']} not modified, {stats['skipped']} skipped, "
+        f"{stats['failed']} failures"
+    )
+
+
+@cli.command()
+@click.argument("seeds", nargs=-1, required=True)
+@click.option("--db", default="github.db", help="Path to SQLite database")
+@click.option(
+    "--depth",
+    default=2,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="How many levels of lists to follow from the seeds.",
+)
+@click.option(
+    "--max-repos",
+    default=1000,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Stop discovering repos after this many.",
+)
+@click.option(
+    "--follow",
+    default="awesome",
+    show_default=True,
+    help="Regular expression a repo's name must match for its README to be "
+    "crawled in turn. Use . to follow every repo.",
+)
+@click.option(
+    "--workers",
+    default=8,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="READMEs and repositories to fetch concurrently.",
+)
+@click.option(
+    "--per-host",
+    type=click.IntRange(min=1),
+    show_default="--workers",
+    help="Most requests in flight to any one host. Every GitHub API request "
+    "goes to one host, so a lower value also caps --workers.",
+)
+@click.option(
+    "--batch-size",
+    default=100,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of repositories to write per database transaction.",
+)
+@click.option(
+    "--api-url",
+    default=os.getenv("GITHUB_API_URL", GITHUB_API_URL),
+    show_default=True,
+    help="GitHub REST API base URL",
+)
+@click.option(
+    "--token",
+    "tokens",
+    multiple=True,
+    help="GitHub token to rotate through; repeat for several tokens. "
+    "Defaults to the comma separated GITHUB_TOKENS, or GITHUB_TOKEN.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch repos that are already in the database again.",
+)
+def crawl(
+    seeds: tuple[str, ...],
+    db: str,
+    depth: int,
+    max_repos: int,
+    follow: str,
+    workers: int,
+    per_host: Optional[int],
+    batch_size: int,
+    api_url: str,
+    tokens: tuple[str, ...],
+    refresh: bool,
+):
+    """Crawl awesome lists from SEEDS and ingest every repo they link to.
+
+    SEEDS are GitHub repo URLs or owner/repo names. Their READMEs are
+    fetched and every repo they link to is ingested as process-links would.
+    Linked repos whose name matches --follow are crawled in turn, breadth
+    first, up to --depth levels from the seeds. Discovered repos are
+    ingested while the crawl continues rather than at the end; repos
+    already in the database are still crawled but not fetched again unless
+    --refresh is given.
+    """
+    try:
+        follow_pattern = re.compile(follow, re.IGNORECASE)
+    except re.error as exc:
+        raise click.BadParameter(f"Invalid --follow pattern: {exc}")
+    client = GitHubClient(
+        tokens=tokens or github_tokens_from_env(),
+        api_url=api_url,
+        pool_size=workers * 2,
+        host_limiter=HostLimiter(per_host or workers),
+    )
+    start = time.monotonic()
+    try:
+        crawled, stats = crawl_lists(
+            links_to_repos(seeds),
+            db,
+            client,
+            depth=depth,
+            max_repos=max_repos,
+            follow=follow_pattern,
+            workers=workers,
+            batch_size=batch_size,
+            refresh=refresh,
+        )
+    finally:
+        client.close()
+    elapsed = time.monotonic() - start
+    click.echo(
+        f"Crawled {crawled} lists and found {sum(stats.values())} repos "
+        f"in {elapsed:.1f}s: {stats['updated']} updated, "
+        f"{stats['not_modified']} not modified, {stats['skipped']} already known, "
+        f"{stats['failed']} failures"
+    )
+
+
+def crawl_lists(
+    seeds: list[str],
+    db_path: str,
+    client: "GitHubClient",
+    depth: int = 2,
+    max_repos: int = 1000,
+    follow: Optional[re.Pattern] = None,
+    workers: int = 8,
+    batch_size: int = 100,
+    refresh: bool = False,
+) -> tuple[int, collections.Counter]:
+    """Breadth first crawl of READMEs, ingesting repos as they are found.
+
+    READMEs are fetched on a pool of `workers` threads. Each newly seen repo
+    is put on a queue for an ingestion thread, which fetches and saves them
+    in chunks of up to `batch_size` with ingest_repos while the crawl goes
+    on. Unless refresh is set, repos already in the database are counted as
+    skipped instead. Returns the number of READMEs crawled and the counts.
+    """
+    import concurrent.futures
+
+    import requests
+    import sqlite_utils
+
+    visited = set()
+    to_ingest = queue.Queue()
+    stats = collections.Counter(updated=0, not_modified=0, skipped=0, failed=0)
+    done = object()
+    # An ingestion error stops discovery and is re-raised once the crawl ends
+    errors = []
+    stop = threading.Event()
+
+    def ingest():
+        try:
+            ingest_chunks()
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+
+    def ingest_chunks():
+        db = sqlite_utils.Database(db_path)
+        validators = ValidatorCache(state_path(db_path))
+        finished = False
+        while not finished:
+            chunk = [to_ingest.get()]
+            while len(chunk) < batch_size:
+                try:
+                    chunk.append(to_ingest.get(timeout=0.2))
+                except queue.Empty:
+                    break
+            if done in chunk:
+                chunk.remove(done)
+                finished = True
+            if chunk and not refresh:
+                known = known_repos(db, chunk)
+                stats["skipped"] += len(known)
+                chunk = [name for name in chunk if name not in known]
+            if chunk:
+                result = ingest_repos(
+                    chunk,
+                    db,
+                    client,
+                    workers,
+                    batch_size,
+                    validators=validators,
+                )
+                stats.update(
+                    {key: result[key] for key in ("updated", "not_modified", "failed")}
+                )
+
+    def discover(name: str) -> bool:
+        """Queue a canonical repo name for ingestion unless seen or over budget."""
+        if name in visited or len(visited) >= max_repos:
+            return False
+        visited.add(name)
+        to_ingest.put(name)
+        return True
+
+    ingester = threading.Thread(target=ingest)
+    ingester.start()
+    crawled = 0
+    try:
+        level = [name for name in seeds if discover(name)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for current_depth in range(1, depth + 1):
+                futures = {
+                    executor.submit(fetch_readme, client, name): name for name in level
+                }
+                level = []
+                for future in concurrent.futures.as_completed(futures):
+                    if stop.is_set():
+                        for pending in futures:
+                            pending.cancel()
+                        break
+                    name = futures[future]
+                    try:
+                        readme = future.result()
+                    except requests.RequestException as e:
+                        click.echo(f"✗ Error crawling {name}: {e}", err=True)
+                        continue
+                    crawled += 1
+                    found = links_to_repos(GITHUB_LINK_PATTERN.findall(readme or ""))
+                    for linked in found:
+                        if discover(linked) and (
+                            follow is None or follow.search(linked)
+                        ):
+                            level.append(linked)
+                    click.echo(
+                        f"Crawled {name} (depth {current_depth}): "
+                        f"{len(found)} links, {len(visited)} repos found"
+                    )
+                if not level or len(visited) >= max_repos or stop.is_set():
+                    break
+    finally:
+        to_ingest.put(done)
+        ingester.join()
+    if errors:
+        raise errors[0]
+    return crawled, stats
+
+
+# owner/repo at the start of a github.com URL, a git@github.com: remote or a
+# bare name. Owners are alphanumeric with dashes; repo names also allow . and _
+GITHUB_REPO_PATTERN = re.compile(
+    r"(?:(?:https?://)?(?:www\.)?github\.com/|git@github\.com:)?"
+    r"([a-z0-9](?:[a-z0-9-]*[a-z0-9])?)/([a-z0-9._-]+)",
+    re.IGNORECASE,
+)
+
+# github.com paths that look like owner/repo but aren't repositories
+GITHUB_RESERVED_OWNERS = {
+    "about",
+    "apps",
+    "collections",
+    "customer-stories",
+    "enterprise",
+    "events",
+    "explore",
+    "features",
+    "login",
+    "marketplace",
+    "orgs",
+    "pricing",
+    "settings",
+    "site",
+    "sponsors",
+    "topics",
+    "trending",
+    "users",
+}
+
+
+def canonical_repo(link: str) -> Optional[str]:
+    """The canonical lower-case owner/repo a GitHub link points at, or None.
+
+    Accepts repository URLs with or without a scheme, including deeper paths
+    like /tree/main/docs, query strings and fragments, git@github.com:
+    remotes and bare owner/repo names. Only a trailing .git is dropped, so
+    names like x/django.git-helpers survive.
+    """
+    # Sentence punctuation after a link isn't part of it
+    link = link.strip().rstrip(".,;:")
+    match = GITHUB_REPO_PATTERN.match(link)
+    if match is None or link[match.end() : match.end() + 1] not in ("", "/", "#", "?"):
+        return None
+    owner, repo = match.group(1).lower(), match.group(2).lower()
+    repo = repo.removesuffix(".git")
+    if owner in GITHUB_RESERVED_OWNERS or repo in ("", ".", ".."):
+        return None
+    return f"{owner}/{repo}"
+
+
+REPO_FTS_COLUMNS = ["name", "description", "topics"]
+
+
+def ensure_repo_search(db: sqlite_utils.Database):
+    """Index repos for search, list-repos pagination and the stars plot.
+
+    github-to-sqlite indexes only name and description; this replaces that
+    FTS5 index with one that includes topics, kept in sync by triggers.
+    Datasette picks up the same index for the table's search box, and the
+    stars_binned canned query range-scans the (size, stargazers_count) index.
+    """
+    if not db["repos"].exists():
+        return
+    columns = [c for c in REPO_FTS_COLUMNS if c in db["repos"].columns_dict]
+    fts = db["repos_fts"]
+    if not fts.exists() or set(columns) - set(fts.columns_dict):
+        db["repos"].enable_fts(columns, create_triggers=True, replace=True)
+    db.executescript(
+        """CREATE INDEX IF NOT EXISTS repos_full_name_nocase
+            ON repos (full_name COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS repos_stargazers_count
+            ON repos (coalesce(stargazers_count, 0) DESC, id);
+        CREATE INDEX IF NOT EXISTS repos_size_stargazers_count
+            ON repos (size, stargazers_count);"""
+    )
+
+
+def links_to_repos(links: list[str]) -> list[str]:
+    """Convert GitHub links to unique canonical owner/repo names, in order."""
+    repos = {}
+    for link in links:
+        repo = canonical_repo(link)
+        if repo:
+            repos.setdefault(repo, None)
+    return list(repos)
+
+
+def known_repos(db: sqlite_utils.Database, names: list[str]) -> set[str]:
+    """The canonical names among names that are already in the repos table.
+
+    One query checks the whole set, through a case-insensitive index on
+    repos.full_name.
+    """
+    if not db["repos"].exists():
+        return set()
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS repos_full_name_nocase "
+        "ON repos (full_name COLLATE NOCASE)"
+    )
+    return {
+        row[0].lower()
+        for row in db.execute(
+            "SELECT full_name FROM repos WHERE full_name COLLATE NOCASE IN "
+            "(SELECT value FROM json_each(?))",
+            [json.dumps(names)],
+        )
+    }
+
+
+class RepoFetch(NamedTuple):
+    """The outcome of a (possibly conditional) repository fetch."""
+
+    full_name: str
+    # None when the server answered 304 Not Modified
+    repo: Optional[dict]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+def github_tokens_from_env() -> list[str]:
+    """GitHub tokens from GITHUB_TOKENS (comma separated) or GITHUB_TOKEN."""
+    tokens = os.getenv("GITHUB_TOKENS") or os.getenv("GITHUB_TOKEN") or ""
+    return [token.strip() for token in tokens.split(",") if token.strip()]
+
+
+class HostLimiter:
+    """Caps the number of requests in flight to each host."""
+
+    def __init__(self, per_host: int):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    @contextlib.contextmanager
+    def slot(self, url: str):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = self.semaphores[host] = threading.BoundedSemaphore(
+                    self.per_host
+                )
+        with semaphore:
+            yield
+
+
+class RateLimiter:
+    """Token buckets for one or more GitHub tokens.
+
+    Each bucket starts out unknown and is then kept in step with the
+    X-RateLimit-Remaining and X-RateLimit-Reset headers of responses made
+    with its token. Requests are spent locally as they are issued so that
+    concurrent workers cannot overdraw a bucket between responses. acquire()
+    rotates to the token with the most budget left, and blocks until the
+    earliest reset when every bucket is empty.
+    """
+
+    def __init__(self, tokens: list[Optional[str]]):
+        self.lock = threading.Lock()
+        self.buckets = {
+            token: {"remaining": None, "reset_at": 0.0, "blocked_until": 0.0}
+            for token in tokens
+        }
+
+    def acquire(self) -> Optional[str]:
+        while True:
+            with self.lock:
+                now = time.time()
+                available = []
+                for token, bucket in self.buckets.items():
+                    if bucket["remaining"] is not None and bucket["reset_at"] <= now:
+                        # The window has reset; the next response refills it
+                        bucket["remaining"] = None
+                    if bucket["blocked_until"] > now:
+                        continue
+                    if bucket["remaining"] is None or bucket["remaining"] > 0:
+                        available.append(token)
+                if available:
+                    token = max(available, key=self._budget)
+                    if self.buckets[token]["remaining"] is not None:
+                        self.buckets[token]["remaining"] -= 1
+                    return token
+                wait = min(
+                    max(bucket["reset_at"], bucket["blocked_until"])
+                    for bucket in self.buckets.values()
+                )
+                wait -= now
+            click.echo(f"Rate limited, waiting {wait:.0f}s", err=True)
+            time.sleep(max(wait, 0.05))
+
+    def _budget(self, token: Optional[str]) -> float:
+        remaining = self.buckets[token]["remaining"]
+        return math.inf if remaining is None else remaining
+
+    def update(self, token: Optional[str], headers):
+        """Follow the rate limit headers of a response made with token."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            bucket = self.buckets[token]
+            bucket["remaining"] = int(remaining)
+            bucket["reset_at"] = float(reset)
+
+    def block(self, token: Optional[str], seconds: float):
+        """Stop handing out token for the next `seconds`."""
+        with self.lock:
+            bucket = self.buckets[token]
+            bucket["blocked_until"] = max(
+                bucket["blocked_until"], time.time() + seconds
+            )
+
+
+class GitHubClient:
+    """Minimal GitHub REST API client.
+
+    All requests share one keep-alive session, so repeated calls reuse pooled
+    TLS connections instead of paying for a new handshake each time. The
+    session may be shared between worker threads.
+
+    Requests are scheduled through a RateLimiter across all of the given
+    tokens. Rate limited 403 and 429 responses are retried up to
+    `max_retries` times, honouring Retry-After and otherwise backing off
+    exponentially from `backoff` seconds. A HostLimiter caps how many
+    requests are in flight at once.
+    """
+
+    def __init__(
+        self,
+        tokens: Optional[list[str]] = None,
+        api_url: str = GITHUB_API_URL,
+        pool_size: int = 10,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        host_limiter: Optional[HostLimiter] = None,
+    ):
+        import requests
+
+        self.api_url = api_url.rstrip("/")
+        self.host_limiter = host_limiter
+        self.limiter = RateLimiter(list(tokens or []) or [None])
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # The mercy preview media type includes repository topics
+        self.session.headers["Accept"] = "application/vnd.github.mercy-preview+json"
+
+    def get(self, path: str, headers: Optional[dict] = None) -> requests.Response:
+        """GET an API path, waiting out and retrying rate limited responses."""
+        attempt = 0
+        while True:
+            token = self.limiter.acquire()
+            request_headers = dict(headers or {})
+            if token:
+                request_headers["Authorization"] = f"token {token}"
+            url = f"{self.api_url}{path}"
+            slot = self.host_limiter.slot(url) if self.host_limiter else None
+            with slot or contextlib.nullcontext():
+                with trace_span("github.get", path=path, attempt=attempt):
+                    response = self.session.get(
+                        url, headers=request_headers, timeout=30
+                    )
+            trace_count("bytes_in", len(response.content))
+            self.limiter.update(token, response.headers)
+            if attempt < self.max_retries and _is_rate_limited(response):
+                trace_count("retries")
+                retry_after = _retry_after_seconds(response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    self.limiter.block(token, retry_after)
+                elif response.headers.get("X-RateLimit-Remaining") != "0":
+                    # Secondary rate limit without a hint: back off
+                    self.limiter.block(token, self.backoff * 2**attempt)
+                attempt += 1
+                continue
+            response.raise_for_status()
+            return response
+
+    def fetch_repo(
+        self,
+        full_name: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> RepoFetch:
+        """Fetch a repository's metadata by its owner/repo name.
+
+        If validators from an earlier fetch are given the request is made
+        conditional, and an unchanged repository comes back with repo=None.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        response = self.get(f"/repos/{full_name}", headers)
+        if response.status_code == 304:
+            return RepoFetch(full_name, None, etag, last_modified)
+        return RepoFetch(
+            full_name,
+            response.json(),
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+
+    def close(self):
+        self.session.close()
+
+
+def _is_rate_limited(response: requests.Response) -> bool:
+    """Whether a response is GitHub's primary or secondary rate limit."""
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    return (
+        "Retry-After" in response.headers
+        or response.headers.get("X-RateLimit-Remaining") == "0"
+        or "rate limit" in response.text.lower()
+    )
+
+
+def _retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given as seconds or a date.
+
+    Returns None if the header is missing or can't be parsed.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def state_path(db_path: str) -> str:
+    """Path of the file holding rb's bookkeeping for the database at db_path."""
+    root, _ = os.path.splitext(db_path)
+    return f"{root}.state.db"
+
+
+class ValidatorCache:
+    """Persistent per-repo HTTP validators (ETag, Last-Modified, fetch time)."""
+
+    def __init__(self, path: str):
+        import sqlite_utils
+
+        self.db = sqlite_utils.Database(path)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS http_validators (
+                full_name TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL
+            )"""
+        )
+
+    def load(self, names: list[str]) -> dict[str, tuple]:
+        """Return {full_name: (etag, last_modified, fetched_at)} for names."""
+        rows = self.db.execute(
+            "SELECT full_name, etag, last_modified, fetched_at FROM http_validators "
+            "WHERE full_name IN (SELECT value FROM json_each(?))",
+            [json.dumps(names)],
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    def save(self, fetches: list[RepoFetch], fetched_at: float):
+        with self.db.conn:
+            self.db.conn.executemany(
+                "INSERT OR REPLACE INTO http_validators "
+                "(full_name, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?)",
+                [
+                    (fetch.full_name, fetch.etag, fetch.last_modified, fetched_at)
+                    for fetch in fetches
+                ],
+            )
+
+
+class FetchJournal:
+    """On-disk record of which repos in a run are pending, done or failed."""
+
+    def __init__(self, path: str):
+        import sqlite_utils
+
+        self.db = sqlite_utils.Database(path)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS fetch_journal (
+                position INTEGER PRIMARY KEY,
+                full_name TEXT UNIQUE,
+                status TEXT NOT NULL,
+                error TEXT
+            )"""
+        )
+
+    def start(self, names: list[str]):
+        """Replace the journal with a new run in which every repo is pending."""
+        with self.db.conn:
+            self.db.execute("DELETE FROM fetch_journal")
+            self.db.conn.executemany(
+                "INSERT OR IGNORE INTO fetch_journal (full_name, status) "
+                "VALUES (?, 'pending')",
+                [(name,) for name in names],
+            )
+
+    def unfinished(self) -> list[str]:
+        """Repos that are still pending or failed, in their original order."""
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT full_name FROM fetch_journal WHERE status != 'done' "
+                "ORDER BY position"
+            )
+        ]
+
+    def mark(self, names: list[str], status: str, error: Optional[str] = None):
+        with self.db.conn:
+            self.db.conn.executemany(
+                "UPDATE fetch_journal SET status = ?, error = ? WHERE full_name = ?",
+                [(status, error, name) for name in names],
+            )
+
+
+class ResultCache:
+    """Command results keyed by repo and commit SHA, evicted least recently used."""
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024**2):
+        import sqlite_utils
+
+        self.max_bytes = max_bytes
+        self.db = sqlite_utils.Database(path)
+        self.db.executescript(
+            """CREATE TABLE IF NOT EXISTS result_cache (
+                command TEXT,
+                repo TEXT,
+                sha TEXT,
+                result TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_used REAL,
+                hits INTEGER DEFAULT 0,
+                PRIMARY KEY (command, repo, sha)
+            );
+            CREATE INDEX IF NOT EXISTS result_cache_last_used
+                ON result_cache (last_used);
+            CREATE TABLE IF NOT EXISTS result_cache_counters (
+                command TEXT PRIMARY KEY,
+                hits INTEGER DEFAULT 0,
+                misses INTEGER DEFAULT 0,
+                evictions INTEGER DEFAULT 0
+            );"""
+        )
+
+    def _count(self, command: str, counter: str, n: int = 1):
+        self.db.execute(
+            "INSERT INTO result_cache_counters (command) VALUES (?) "
+            "ON CONFLICT (command) DO NOTHING",
+            [command],
+        )
+        self.db.execute(
+            f"UPDATE result_cache_counters SET {counter} = {counter} + ? "
+            "WHERE command = ?",
+            [n, command],
+        )
+
+    def get(self, command: str, repo: str, sha: str):
+        """Return the cached result, or None, marking it as recently used."""
+        with self.db.conn:
+            row = self.db.execute(
+                "SELECT result FROM result_cache "
+                "WHERE command = ? AND repo = ? AND sha = ?",
+                [command, repo, sha],
+            ).fetchone()
+            if row is None:
+                self._count(command, "misses")
+                return None
+            self.db.execute(
+                "UPDATE result_cache SET last_used = ?, hits = hits + 1 "
+                "WHERE command = ? AND repo = ? AND sha = ?",
+                [time.time(), command, repo, sha],
+            )
+            self._count(command, "hits")
+        return json.loads(row[0])
+
+    def put(self, command: str, repo: str, sha: str, result):
+        """Cache a result, replacing older commits of the same repo."""
+        encoded = json.dumps(result)
+        now = time.time()
+        with self.db.conn:
+            self.db.execute(
+                "DELETE FROM result_cache WHERE command = ? AND repo = ?",
+                [command, repo],
+            )
+            self.db.execute(
+                "INSERT INTO result_cache "
+                "(command, repo, sha, result, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [command, repo, sha, encoded, len(encoded), now, now],
+            )
+            self._evict()
+
+    def _evict(self):
+        # Keep the most recently used entries that fit within max_bytes
+        evicted = self.db.execute(
+            """DELETE FROM result_cache WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, SUM(size) OVER (
+                        ORDER BY last_used DESC, rowid DESC
+                    ) AS running
+                    FROM result_cache
+                ) WHERE running > ?
+            ) RETURNING command""",
+            [self.max_bytes],
+        ).fetchall()
+        for command, n in collections.Counter(row[0] for row in evicted).items():
+            self._count(command, "evictions", n)
+
+    def stats(self) -> dict:
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache"
+        ).fetchone()
+        commands = {
+            command: {"hits": hits, "misses": misses, "evictions": evictions}
+            for command, hits, misses, evictions in self.db.execute(
+                "SELECT command, hits, misses, evictions FROM result_cache_counters "
+                "ORDER BY command"
+            )
+        }
+        for command, count in self.db.execute(
+            "SELECT command, COUNT(*) FROM result_cache GROUP BY command"
+        ):
+            commands.setdefault(command, {})["entries"] = count
+        return {"entries": entries, "bytes": size, "commands": commands}
+
+    def clear(self):
+        with self.db.conn:
+            self.db.execute("DELETE FROM result_cache")
+            self.db.execute("DELETE FROM result_cache_counters")
+
+
+def ingest_repos(
+    repos: list[str],
+    db: sqlite_utils.Database,
+    client: GitHubClient,
+    workers: int = 1,
+    batch_size: int = 100,
+    validators: Optional[ValidatorCache] = None,
+    max_age: Optional[float] = None,
+    journal: Optional[FetchJournal] = None,
+) -> collections.Counter:
+    """Fetch repos on a pool of worker threads and save them from this thread.
+
+    Fetching is network bound, so it is spread across `workers` threads. Every
+    result is handed back to the calling thread, which is the only one that
+    writes to SQLite, committing `batch_size` repos per transaction.
+
+    With a validator cache, repos fetched within `max_age` seconds are skipped
+    without a request and the rest are fetched conditionally.
+
+    With a journal, each repo is marked done or failed as soon as its outcome
+    is committed.
+
+    Returns:
+        Counts of "updated", "not_modified", "skipped" and "failed" repos
+    """
+    import concurrent.futures
+
+    import requests
+    from github_to_sqlite import utils
+
+    stats = collections.Counter(updated=0, not_modified=0, skipped=0, failed=0)
+    known = validators.load(repos) if validators else {}
+    if max_age is not None:
+        cutoff = time.time() - max_age
+        fresh = {
+            name for name, (*_, fetched_at) in known.items() if fetched_at > cutoff
+        }
+        for name in fresh:
+            click.echo(f"- Skipped (fetched recently): {name}")
+        if journal:
+            journal.mark(list(fresh), "done")
+        stats["skipped"] = len(fresh)
+        repos = [name for name in repos if name not in fresh]
+    batch = []
+
+    def flush():
+        changed = [fetch for fetch in batch if fetch.repo is not None]
+        try:
+            with trace_span("db.save", table="repos", rows=len(changed)):
+                with db.conn:
+                    save_repos(db, [fetch.repo for fetch in changed])
+            trace_count("rows", len(changed))
+        except sqlite3.Error as e:
+            stats["failed"] += len(batch)
+            for fetch in batch:
+                click.echo(f"✗ Error processing {fetch.full_name}: {e}", err=True)
+            if journal:
+                journal.mark([fetch.full_name for fetch in batch], "failed", str(e))
+        else:
+            if validators:
+                validators.save(batch, time.time())
+            if journal:
+                journal.mark([fetch.full_name for fetch in batch], "done")
+            for fetch in batch:
+                if fetch.repo is None:
+                    stats["not_modified"] += 1
+                    click.echo(f"✓ Not modified: {fetch.full_name}")
+                else:
+                    stats["updated"] += 1
+                    click.echo(f"✓ Processed: {fetch.full_name}")
+            # The repos are already committed, so a failed rollup only stays
+            # stale until those owners' repos are next written
+            owner_ids = {
+                fetch.repo["owner"]["id"]
+                for fetch in changed
+                if fetch.repo.get("owner")
+            }
+            try:
+                refresh_owner_stats(db, list(owner_ids))
+            except sqlite3.Error as e:
+                click.echo(f"✗ Error refreshing owner stats: {e}", err=True)
+        batch.clear()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(client.fetch_repo, name, *known.get(name, ())[:2]): name
+            for name in repos
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                batch.append(future.result())
+            except requests.RequestException as e:
+                stats["failed"] += 1
+                click.echo(f"✗ Error processing {name}: {e}", err=True)
+                if journal:
+                    journal.mark([name], "failed", str(e))
+                continue
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    utils.ensure_db_shape(db)
+    ensure_repo_search(db)
+    ensure_repo_scores(db)
+    return stats
+
+
+def save_repos(db: sqlite_utils.Database, repos: list[dict]):
+    """Save GitHub API repository payloads to the database.
+
+    Produces the same users, licenses and repos tables as github-to-sqlite's
+    save_repo, but writes each table with a single executemany call. The
+    caller is responsible for the surrounding transaction.
+    """
+    users = {}
+    licenses = {}
+    rows = []
+    for repo in repos:
+        # Remove all url fields except html_url
+        row = {
+            key: value
+            for key, value in repo.items()
+            if key == "html_url" or not key.endswith("url")
+        }
+        for key in ("owner", "organization"):
+            user = row.get(key)
+            if user is not None:
+                users[user["id"]] = _user_row(user)
+                row[key] = user["id"]
+            else:
+                row[key] = None
+        if row.get("license") is not None:
+            licenses[row["license"]["key"]] = row["license"]
+            row["license"] = row["license"]["key"]
+        rows.append(row)
+
+    if users:
+        _write_rows(db, "users", list(users.values()), pk="id", mode="upsert")
+    if licenses:
+        _write_rows(db, "licenses", list(licenses.values()), pk="key")
+    _write_rows(
+        db,
+        "repos",
+        rows,
+        pk="id",
+        columns={"organization": int, "topics": str, "name": str, "description": str},
+        foreign_keys=[("owner", "users", "id"), ("organization", "users", "id")],
+    )
+
+
+def _user_row(user: dict) -> dict:
+    """Prepare a GitHub user payload the way github-to-sqlite does."""
+    # Remove all url fields except avatar_url and html_url
+    row = {
+        key: value
+        for key, value in user.items()
+        if key in ("avatar_url", "html_url") or not key.endswith("url")
+    }
+    # Users nested in a repo are missing several fields, so fill in 'name'
+    # from 'login' so Datasette foreign keys display
+    if row.get("name") is None:
+        row["name"] = row["login"]
+    return row
+
+
+def _write_rows(
+    db: sqlite_utils.Database,
+    table_name: str,
+    rows: list[dict],
+    pk,
+    mode: str = "replace",
+    columns: Optional[dict] = None,
+    foreign_keys: Optional[list] = None,
+):
+    """Write rows with one executemany per distinct set of row keys.
+
+    mode is one of "insert", "ignore", "replace" or "upsert", matching the
+    SQLite conflict handling of the same name; pk is a column name, a list
+    of them, or None for a rowid table. The table is created, or altered to
+    add missing columns, to fit the rows.
+    """
+    from sqlite_utils.db import jsonify_if_needed
+    from sqlite_utils.utils import suggest_column_types
+
+    pks = [pk] if isinstance(pk, str) else list(pk or [])
+    table = db[table_name]
+    if not table.exists():
+        column_types = suggest_column_types(rows)
+        column_types.update(
+            {
+                key: value
+                for key, value in (columns or {}).items()
+                if key in column_types
+            }
+        )
+        table.create(column_types, pk=pk, foreign_keys=foreign_keys)
+    else:
+        table.add_missing_columns(rows)
+
+    shapes = {}
+    for row in rows:
+        shapes.setdefault(tuple(row), []).append(
+            tuple(jsonify_if_needed(value) for value in row.values())
+        )
+    verb = {
+        "insert": "INSERT",
+        "ignore": "INSERT OR IGNORE",
+        "replace": "INSERT OR REPLACE",
+        "upsert": "INSERT",
+    }[mode]
+    for keys, values in shapes.items():
+        names = ", ".join(f"[{key}]" for key in keys)
+        placeholders = ", ".join("?" for _ in keys)
+        sql = f"{verb} INTO [{table_name}] ({names}) VALUES ({placeholders})"
+        if mode == "upsert":
+            updates = ", ".join(
+                f"[{key}] = excluded.[{key}]" for key in keys if key not in pks
+            )
+            action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+            conflict = ", ".join(f"[{key}]" for key in pks)
+            sql = f"{sql} ON CONFLICT({conflict}) {action}"
+        db.conn.executemany(sql, values)
 
 
 if __name__ == "__main__":
@@ -1,71 +1,190 @@
 import * as Plot from "https://cdn.jsdelivr.net/npm/@observablehq/plot@0.6/+esm";
 
-(async () => {
-  try {
-    // Fetch data from the "stars" canned query.
-    // We ask for the array shape to get a clean array of objects.
-    const res = await fetch("/github/stars.json?_shape=array");
-    if (!res.ok) {
-      const errorText = await res.text();
-      console.error("Failed to fetch data:", res.status, errorText);
-      const div = document.querySelector("#myplot");
-      div.innerHTML = `<div class="p-4 bg-red-100 text-red-800 rounded">Failed to load plot data. See console for details.</div>`;
-      return;
-    }
-    const data = await res.json();
+// Ranges holding at most this many repositories are plotted as individual
+// dots; anything larger is drawn from the server-side binned counts, so the
+// payload stays bounded however large the repos table grows. Datasette
+// returns at most max_returned_rows (default 1000) rows per query, which
+// bounds both the row limit and the number of grid cells, BINS * BINS.
+const ROW_LIMIT = 1000;
+const BINS = 30;
+
+function showError(div, message) {
+  div.innerHTML = `<div class="p-4 bg-red-100 text-red-800 rounded">${message}</div>`;
+}
+
+// Resolves to {rows, truncated}; truncated is set when the query matched
+// more than Datasette's max_returned_rows.
+async function fetchQuery(database, query, params, signal) {
+  const search = new URLSearchParams(params);
+  const res = await fetch(`/${database}/${query}.json?${search}`, { signal });
+  if (!res.ok) {
+    throw new Error(`${res.status} ${await res.text()}`);
+  }
+  const { rows, truncated } = await res.json();
+  return { rows, truncated: Boolean(truncated) };
+}
 
-    // Create the plot
-    const plot = Plot.plot({
-      title: "Repository Stars vs. Size",
-      subtitle:
-        "A scatter plot of GitHub repositories, with a linear regression trend line.",
-      marginLeft: 80,
-      grid: true,
-      x: {
-        type: "log",
-        label: "Repository Size (KB) →",
-        labelAnchor: "right",
-        transform: (d) => d + 1, // Add 1 to avoid log(0) for repos with 0 size
+// Values are shifted by one so repositories with 0 KB or 0 stars still have
+// a position on the log scales.
+function binnedMarks(bins) {
+  return [
+    Plot.rect(bins, {
+      x1: (d) => d.size_lo + 1,
+      x2: (d) => d.size_hi + 1,
+      y1: (d) => d.stars_lo + 1,
+      y2: (d) => d.stars_hi + 1,
+      fill: "count",
+      tip: {
+        format: {
+          x1: (d) => `${Math.round(d - 1).toLocaleString()} KB`,
+          x2: (d) => `${Math.round(d - 1).toLocaleString()} KB`,
+          y1: (d) => `${Math.round(d - 1).toLocaleString()} stars`,
+          y2: (d) => `${Math.round(d - 1).toLocaleString()} stars`,
+          fill: (d) => `${d.toLocaleString()} repos`,
+        },
       },
-      y: {
-        type: "log",
-        label: "↑ Star Count",
-        labelAnchor: "top",
-        transform: (d) => d + 1, // Add 1 to avoid log(0) for repos with 0 stars
+    }),
+  ];
+}
+
+function rowMarks(rows) {
+  const data = rows.map((d) => ({
+    full_name: d.full_name,
+    size: d.size + 1,
+    stars: d.stargazers_count + 1,
+    url: `https://github.com/${d.full_name}`,
+  }));
+  return [
+    Plot.dot(data, {
+      x: "size",
+      y: "stars",
+      href: "url",
+      target: "_blank",
+      stroke: "steelblue",
+      fill: "steelblue",
+      fillOpacity: 0.3,
+      r: 4,
+      tip: {
+        format: {
+          y: (d) => `${(d - 1).toLocaleString()} stars`,
+          x: (d) => `${(d - 1).toLocaleString()} KB`,
+          title: (d) => d,
+        },
       },
-      marks: [
-        Plot.dot(data, {
-          x: "size",
-          y: "stargazers_count",
-          title: "full_name", // Use full_name for the tooltip
-          stroke: "steelblue",
-          fill: "steelblue",
-          fillOpacity: 0.3,
-          r: 4,
-          tip: {
-            format: {
-              y: (d) => `${d.toLocaleString()} stars`,
-              x: (d) => `${d.toLocaleString()} KB`,
-              title: (d) => d,
-            },
-          },
-        }),
-        Plot.linearRegressionY(data, {
-          x: "size",
-          y: "stargazers_count",
-          stroke: "red",
-          strokeWidth: 2,
-        }),
-      ],
-    });
+      title: "full_name",
+    }),
+    Plot.linearRegressionY(data, {
+      x: "size",
+      y: "stars",
+      stroke: "red",
+      strokeWidth: 2,
+    }),
+  ];
+}
+
+/**
+ * Render the stars vs. size plot into `div` and keep it in sync with the
+ * optional range `inputs` ({sizeMin, sizeMax, starsMin, starsMax} elements).
+ *
+ * Each range change asks the stars_binned canned query for log-binned
+ * counts; once the range holds few enough repositories the individual rows
+ * are fetched from the stars canned query instead. Clicking a bin zooms into
+ * it.
+ */
+export function mountStarsPlot(div, { database = "github", inputs = {} } = {}) {
+  let controller;
+
+  function readRange() {
+    const range = {};
+    for (const [key, param] of [
+      ["sizeMin", "size_min"],
+      ["sizeMax", "size_max"],
+      ["starsMin", "stars_min"],
+      ["starsMax", "stars_max"],
+    ]) {
+      const value = parseInt(inputs[key]?.value);
+      range[param] = Number.isFinite(value) ? Math.max(0, value) : "";
+    }
+    return range;
+  }
+
+  function zoomTo(bin) {
+    if (!inputs.sizeMin) return;
+    inputs.sizeMin.value = Math.floor(bin.size_lo);
+    inputs.sizeMax.value = Math.ceil(bin.size_hi);
+    inputs.starsMin.value = Math.floor(bin.stars_lo);
+    inputs.starsMax.value = Math.ceil(bin.stars_hi);
+    update();
+  }
+
+  async function update() {
+    controller?.abort();
+    controller = new AbortController();
+    const { signal } = controller;
+    const range = readRange();
+    try {
+      const { rows: bins, truncated } = await fetchQuery(
+        database,
+        "stars_binned",
+        { ...range, bins: BINS },
+        signal
+      );
+      if (truncated) {
+        throw new Error("More bins than max_returned_rows; lower BINS");
+      }
+      const total = bins.reduce((sum, d) => sum + d.count, 0);
+      let rows = null;
+      if (total <= ROW_LIMIT) {
+        const result = await fetchQuery(database, "stars", range, signal);
+        // Never plot a partial set of rows; keep the bins instead
+        if (!result.truncated) rows = result.rows;
+      }
+      const detailed = rows !== null;
+      const marks = detailed ? rowMarks(rows) : binnedMarks(bins);
+      const domain = (lo, hi) =>
+        bins.length ? [Math.min(...lo) + 1, Math.max(...hi) + 1] : undefined;
+      const plot = Plot.plot({
+        title: "Repository Stars vs. Size",
+        subtitle: detailed
+          ? `${total.toLocaleString()} repositories, with a linear regression trend line.`
+          : `${total.toLocaleString()} repositories in log-scaled bins; narrow the ranges or click a bin to see individual repositories.`,
+        marginLeft: 80,
+        grid: true,
+        color: { type: "log", scheme: "blues", legend: !detailed },
+        x: {
+          type: "log",
+          label: "Repository Size (KB) →",
+          labelAnchor: "right",
+          domain: domain(
+            bins.map((d) => d.size_lo),
+            bins.map((d) => d.size_hi)
+          ),
+        },
+        y: {
+          type: "log",
+          label: "↑ Star Count",
+          labelAnchor: "top",
+          domain: domain(
+            bins.map((d) => d.stars_lo),
+            bins.map((d) => d.stars_hi)
+          ),
+        },
+        marks,
+      });
+      if (!detailed) {
+        plot.addEventListener("click", () => plot.value && zoomTo(plot.value));
+      }
+      div.innerHTML = "";
+      div.append(plot);
+    } catch (error) {
+      if (error.name === "AbortError") return;
+      console.error("Error creating plot:", error);
+      showError(div, "Failed to load plot data. See console for details.");
+    }
+  }
 
-    // Append the plot to the div
-    const div = document.querySelector("#myplot");
-    div.innerHTML = ""; // Clear previous content
-    div.append(plot);
-  } catch (error) {
-    console.error("Error creating plot:", error);
-    const div = document.querySelector("#myplot");
-    div.innerHTML = `<div class="p-4 bg-red-100 text-red-800 rounded">An error occurred while rendering the plot.</div>`;
+  for (const input of Object.values(inputs)) {
+    input.addEventListener("change", update);
   }
-})();
+  return update();
+}
@@ -3,16 +3,23 @@
 import json
 import os
 import socket
+import sqlite3
 import subprocess
+import sys
 import tempfile
+import threading
 import time
 from contextlib import closing
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import click
 import pytest
 import requests
+import sqlite_utils
 from click.testing import CliRunner
 
-from rb import cli
+from rb import cli, save_repos, tilde_decode, tilde_encode
 
 
 def find_free_port():
@@ -176,3 +183,1707 @@ def test_create_insert_and_verify(datasette_instance):
     assert data["Cleo"] == {"name": "Cleo", "age": 5}
 
     del os.environ["DATASETTE_AUTH_TOKEN"]
+
+
+def fake_repo(full_name, repo_id):
+    """Build a minimal GitHub API repository payload."""
+    owner, name = full_name.split("/")
+    return {
+        "id": repo_id,
+        "name": name,
+        "full_name": full_name,
+        "html_url": f"https://github.com/{full_name}",
+        "url": f"https://api.github.com/repos/{full_name}",
+        "description": f"The {name} project",
+        "owner": {
+            "id": 1000 + repo_id,
+            "login": owner,
+            "html_url": f"https://github.com/{owner}",
+            "avatar_url": f"https://avatars.githubusercontent.com/{owner}",
+            "type": "User",
+        },
+        "license": None,
+        "topics": ["example"],
+        "stargazers_count": repo_id * 10,
+        "forks_count": repo_id,
+        "size": repo_id * 100,
+        "language": "Python",
+        "pushed_at": "2025-01-01T00:00:00Z",
+    }
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    """Serves /repos/{owner}/{repo} from the server's `repos` dict.
+
+    /repos/{owner}/{repo}/readme serves raw text from `readmes`.
+
+    Responses carry an ETag and honour If-None-Match with a 304. Tokens
+    listed in `rate_limits` get that many requests before a 403, and repos
+    in `throttle_once` answer their first request with a 429.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        full_name = self.path.removeprefix("/repos/")
+        if full_name.endswith("/readme"):
+            readme = self.server.readmes.get(full_name.removesuffix("/readme"))
+            body = (readme or "").encode()
+            self.send_response(404 if readme is None else 200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        token = self.headers.get("Authorization", "").removeprefix("token ")
+        if full_name in self.server.throttle_once:
+            self.server.throttle_once.remove(full_name)
+            self.send_response(429)
+            # Retry-After may be an HTTP-date as well as a number of seconds
+            self.send_header("Retry-After", formatdate(time.time(), usegmt=True))
+            self.end_headers()
+            return
+        if token in self.server.rate_limits:
+            if self.server.rate_limits[token] <= 0:
+                body = b'{"message": "API rate limit exceeded"}'
+                self.send_response(403)
+                self.send_header("X-RateLimit-Remaining", "0")
+                self.send_header("X-RateLimit-Reset", str(int(time.time()) + 60))
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.server.rate_limits[token] -= 1
+        repo = self.server.repos.get(full_name)
+        if repo is None:
+            self.send_response(404)
+            body = b'{"message": "Not Found"}'
+        else:
+            body = json.dumps(repo).encode()
+            etag = f'"{hash(body)}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+        if token in self.server.rate_limits:
+            remaining = self.server.rate_limits[token]
+            self.send_header("X-RateLimit-Remaining", str(remaining))
+            self.send_header("X-RateLimit-Reset", str(int(time.time()) + 60))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def github_api():
+    """A local stand-in for the GitHub repos API."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGitHubHandler)
+    server.repos = {}
+    server.readmes = {}
+    server.requests = []
+    server.rate_limits = {}
+    server.throttle_once = set()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_process_links_workers(tmp_path, github_api):
+    """Concurrent fetches are saved by a single writer and summarized."""
+    names = [f"octo/repo{i}" for i in range(1, 7)]
+    for i, name in enumerate(names, start=1):
+        if name != "octo/repo3":
+            github_api.repos[name] = fake_repo(name, i)
+    links_path = tmp_path / "links.json"
+    links_path.write_text(json.dumps([f"https://github.com/{n}" for n in names]))
+    db_path = tmp_path / "github.db"
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "process-links",
+            "--json-path",
+            str(links_path),
+            "--db",
+            str(db_path),
+            "--workers",
+            "4",
+            "--batch-size",
+            "2",
+            "--api-url",
+            github_api.base_url,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.count("✓ Processed:") == 5
+    assert "✗ Error processing octo/repo3" in result.output
+    assert "Processed 6 repos" in result.output
+    assert "1 failures" in result.output
+
+    db = sqlite_utils.Database(db_path)
+    assert db["repos"].count == 5
+    assert db["users"].count == 5
+    row = db["repos"].get(2)
+    assert row["owner"] == 1002
+    assert json.loads(row["topics"]) == ["example"]
+
+
+def test_trace_spans_and_summary(tmp_path, github_api, monkeypatch):
+    """--trace records per-item spans, counters, a summary and a profile."""
+    import pstats
+
+    names = [f"octo/repo{i}" for i in range(1, 5)]
+    for i, name in enumerate(names, start=1):
+        github_api.repos[name] = fake_repo(name, i)
+    links_path = tmp_path / "links.json"
+    links_path.write_text(json.dumps([f"https://github.com/{n}" for n in names]))
+    trace_path = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("RB_TRACE", str(trace_path))
+
+    result = CliRunner().invoke(
+        cli,
+        ["--trace-profile", "db.save", "process-links"]
+        + ["--json-path", str(links_path), "--db", str(tmp_path / "github.db")]
+        + ["--batch-size", "2", "--api-url", github_api.base_url],
+    )
+    assert result.exit_code == 0, result.output
+    assert f"spans written to {trace_path}" in result.output
+    assert "Counters: " in result.output and "rows=4" in result.output
+
+    records = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    spans = [r for r in records if r["type"] == "span"]
+    fetched = sorted(r["path"] for r in spans if r["stage"] == "github.get")
+    assert fetched == [f"/repos/{name}" for name in names]
+    assert [r["rows"] for r in spans if r["stage"] == "db.save"] == [2, 2]
+    (counters,) = [r for r in records if r["type"] == "counters"]
+    assert counters["rows"] == 4 and counters["bytes_in"] > 0
+    summary = {r["stage"]: r for r in records if r["type"] == "summary"}
+    assert summary["github.get"]["count"] == 4
+    assert summary["db.save"]["p50_ms"] <= summary["db.save"]["p99_ms"]
+    stats = pstats.Stats(f"{trace_path}.prof")
+    assert any(func[2] == "save_repos" for func in stats.stats)
+
+    monkeypatch.delenv("RB_TRACE")
+    result = CliRunner().invoke(cli, ["--trace-profile", "x", "list-repos"])
+    assert result.exit_code == 2 and "--trace-profile needs --trace" in result.output
+
+
+def test_save_repos_matches_github_to_sqlite_schema(tmp_path):
+    """The in-process writer produces github-to-sqlite's table shapes."""
+    from github_to_sqlite import utils
+
+    repos = [fake_repo("octo/repo1", 1), fake_repo("octo/repo2", 2)]
+    repos[1]["license"] = {"key": "mit", "name": "MIT License", "spdx_id": "MIT"}
+    expected = sqlite_utils.Database(tmp_path / "expected.db")
+    for repo in repos:
+        utils.save_repo(expected, repo)
+    actual = sqlite_utils.Database(tmp_path / "actual.db")
+    with actual.conn:
+        save_repos(actual, repos)
+
+    for table in ("repos", "users", "licenses"):
+        assert actual[table].columns_dict == expected[table].columns_dict
+        assert list(actual[table].rows) == list(expected[table].rows)
+    assert actual["repos"].foreign_keys == expected["repos"].foreign_keys
+
+
+def test_process_links_conditional_refresh(tmp_path, github_api):
+    """Unchanged repos answer 304 and fresh ones are skipped entirely."""
+    for i in (1, 2):
+        github_api.repos[f"octo/repo{i}"] = fake_repo(f"octo/repo{i}", i)
+    links_path = tmp_path / "links.json"
+    links_path.write_text(
+        json.dumps([f"https://github.com/octo/repo{i}" for i in (1, 2)])
+    )
+    args = [
+        "process-links",
+        "--json-path",
+        str(links_path),
+        "--db",
+        str(tmp_path / "github.db"),
+        "--api-url",
+        github_api.base_url,
+    ]
+    runner = CliRunner()
+
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert "2 updated" in result.output
+    assert (tmp_path / "github.state.db").exists()
+
+    # Known repos are skipped without a request unless refreshed
+    result = runner.invoke(cli, args)
+    assert "Skipping 2 repos already in" in result.output
+    assert "Processed 0 repos" in result.output
+    args.append("--refresh")
+
+    github_api.repos["octo/repo2"]["stargazers_count"] = 999
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert "✓ Not modified: octo/repo1" in result.output
+    assert "1 updated, 1 not modified" in result.output
+    assert "If-None-Match" in github_api.requests[-1][1]
+    db = sqlite_utils.Database(tmp_path / "github.db")
+    assert db["repos"].get(2)["stargazers_count"] == 999
+
+    requests_before = len(github_api.requests)
+    result = runner.invoke(cli, args + ["--max-age", "1h"])
+    assert result.exit_code == 0, result.output
+    assert "2 skipped" in result.output
+    assert len(github_api.requests) == requests_before
+
+
+def test_process_links_rotates_tokens_and_retries(tmp_path, github_api):
+    """Rate limit headers steer requests across tokens; 429s are retried."""
+    names = [f"octo/repo{i}" for i in range(1, 5)]
+    for i, name in enumerate(names, start=1):
+        github_api.repos[name] = fake_repo(name, i)
+    github_api.rate_limits.update({"token-a": 3, "token-b": 3})
+    github_api.throttle_once.add("octo/repo4")
+    links_path = tmp_path / "links.json"
+    links_path.write_text(json.dumps([f"https://github.com/{n}" for n in names]))
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "process-links",
+            "--json-path",
+            str(links_path),
+            "--db",
+            str(tmp_path / "github.db"),
+            "--api-url",
+            github_api.base_url,
+            "--token",
+            "token-a",
+            "--token",
+            "token-b",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "4 updated" in result.output
+    assert "0 failures" in result.output
+    # Both tokens were used, and no request went over either budget
+    assert all(remaining < 3 for remaining in github_api.rate_limits.values())
+    assert sum(github_api.rate_limits.values()) == 2
+    repo4_requests = [path for path, _ in github_api.requests if "repo4" in path]
+    assert len(repo4_requests) == 2
+
+
+def test_process_links_resume(tmp_path, github_api):
+    """--resume only fetches the repos the journal has not marked done."""
+    from rb import FetchJournal
+
+    names = [f"octo/repo{i}" for i in range(1, 4)]
+    for i, name in enumerate(names, start=1):
+        github_api.repos[name] = fake_repo(name, i)
+    journal = FetchJournal(str(tmp_path / "github.state.db"))
+    journal.start(names)
+    journal.mark(["octo/repo1"], "done")
+    journal.mark(["octo/repo3"], "failed", "403 Forbidden")
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "process-links",
+            "--resume",
+            "--db",
+            str(tmp_path / "github.db"),
+            "--api-url",
+            github_api.base_url,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Resuming: 2 repos left to process" in result.output
+    assert sorted(path for path, _ in github_api.requests) == [
+        "/repos/octo/repo2",
+        "/repos/octo/repo3",
+    ]
+    assert journal.unfinished() == []
+
+
+def test_json_stream_small_chunks():
+    """Values split across chunk boundaries decode correctly."""
+    from rb import read_rows_payload
+
+    rows = [{"id": i, "n": 10**i, "s": "x" * i} for i in range(20)]
+    payload = json.dumps({"pk": "id", "rows": rows, "alter": True}, indent=1)
+    with tempfile.NamedTemporaryFile("w+", suffix=".json") as f:
+        f.write(payload)
+        f.flush()
+        f.seek(0)
+        extras, streamed = read_rows_payload(f)
+        streamed = list(streamed)
+    assert extras == {"pk": "id", "alter": True}
+    assert streamed == rows
+
+    import io
+
+    from rb import _JSONStream
+
+    stream = _JSONStream(io.StringIO(json.dumps(rows)), chunk_size=3)
+    assert list(stream.iter_array()) == rows
+
+
+def test_datasette_client_retries_only_safe_inserts(monkeypatch):
+    """Inserts that may have been applied are not retried; upserts are."""
+    from rb import DatasetteClient
+
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    statuses = []
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            requests_seen.append(self.path)
+            status = statuses.pop(0)
+            body = json.dumps({"ok": status < 400, "errors": ["boom"]}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/db/t/-/"
+    client = DatasetteClient("token", retries=2)
+    try:
+        # A 502 may come after the insert committed, so it isn't retried
+        statuses[:] = [502, 201]
+        with pytest.raises(click.ClickException):
+            client.post(url + "insert", {"rows": [{}]}, idempotent=False)
+        assert len(requests_seen) == 1
+        # A 503 or 429 means the insert wasn't applied
+        requests_seen.clear()
+        statuses[:] = [503, 429, 201]
+        assert client.post(url + "insert", {"rows": [{}]}, idempotent=False)["ok"]
+        assert len(requests_seen) == 3
+        # Upserts can be repeated safely
+        requests_seen.clear()
+        statuses[:] = [502, 200]
+        assert client.post(url + "upsert", {"rows": [{}]})["ok"]
+        assert len(requests_seen) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Nothing is listening any more, so the insert never reached a server
+    attempts = []
+    real_post = client.session.post
+
+    def counting_post(*args, **kwargs):
+        attempts.append(1)
+        return real_post(*args, **kwargs)
+
+    monkeypatch.setattr(client.session, "post", counting_post)
+    with pytest.raises(click.ClickException):
+        client.post(url + "insert", {"rows": [{}]}, idempotent=False)
+    assert len(attempts) == 3
+    client.close()
+
+
+def test_insert_rows_streaming(datasette_instance, tmp_path, monkeypatch):
+    """JSONL and JSON payloads stream to Datasette in pipelined batches."""
+    base_url = datasette_instance["base_url"]
+    db_name = datasette_instance["db_name"]
+    monkeypatch.setenv("DATASETTE_AUTH_TOKEN", datasette_instance["token"])
+    runner = CliRunner()
+    response = requests.post(
+        f"{base_url}/{db_name}/-/create",
+        headers={"Authorization": f"Bearer {datasette_instance['token']}"},
+        json={
+            "table": "streamed",
+            "columns": [
+                {"name": "id", "type": "integer"},
+                {"name": "name", "type": "text"},
+            ],
+            "pk": "id",
+        },
+    )
+    assert response.status_code == 201, response.text
+
+    jsonl_path = tmp_path / "rows.jsonl"
+    with open(jsonl_path, "w") as f:
+        for i in range(250):
+            f.write(json.dumps({"id": i, "name": f"row {i}"}) + "\n")
+    result = runner.invoke(
+        cli,
+        [
+            "datasette",
+            "insert-rows",
+            "--database",
+            db_name,
+            "--table",
+            "streamed",
+            "--payload-file",
+            str(jsonl_path),
+            "--base-url",
+            base_url,
+            "--pipeline",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Wrote 250 rows" in result.output
+
+    # Upsert a JSON object whose options come after the rows
+    payload_path = tmp_path / "upsert.json"
+    payload_path.write_text(
+        json.dumps(
+            {"rows": [{"id": i, "name": f"updated {i}"} for i in range(0, 250, 50)]}
+        )
+    )
+    result = runner.invoke(
+        cli,
+        [
+            "datasette",
+            "upsert-rows",
+            "--database",
+            db_name,
+            "--table",
+            "streamed",
+            "--payload-file",
+            str(payload_path),
+            "--base-url",
+            base_url,
+            "--batch-size",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Wrote 5 rows" in result.output
+
+    response = requests.get(
+        f"{base_url}/{db_name}/streamed.json?_shape=array&_size=max"
+    )
+    rows = response.json()
+    assert len(rows) == 250
+    assert rows[50]["name"] == "updated 50"
+    assert rows[51]["name"] == "row 51"
+
+
+def test_direct_backend(tmp_path):
+    """--direct applies write API payloads straight to a SQLite file."""
+    runner = CliRunner()
+    db_path = str(tmp_path / "direct.db")
+
+    def run(*args, payload=None):
+        command = ["datasette", *args, "--database", "direct", "--direct", db_path]
+        if payload is not None:
+            payload_path = tmp_path / "payload.json"
+            payload_path.write_text(json.dumps(payload))
+            command += ["--payload-file", str(payload_path)]
+        result = runner.invoke(cli, command)
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    output = run(
+        "create-table",
+        payload={
+            "table": "people",
+            "columns": [
+                {"name": "name", "type": "text"},
+                {"name": "age", "type": "integer"},
+            ],
+            "pk": "name",
+        },
+    )
+    assert json.loads(output)["table"] == "people"
+
+    output = run(
+        "insert-rows",
+        "--table",
+        "people",
+        "--return",
+        payload={"rows": [{"name": "Cleo", "age": 5}, {"name": "Pancakes", "age": 4}]},
+    )
+    assert json.loads(output)["rows"] == [
+        {"name": "Cleo", "age": 5},
+        {"name": "Pancakes", "age": 4},
+    ]
+
+    jsonl_path = tmp_path / "upserts.jsonl"
+    jsonl_path.write_text(
+        "\n".join(
+            json.dumps(row) for row in [{"name": "Cleo", "age": 6}, {"name": "Rex"}]
+        )
+    )
+    result = runner.invoke(
+        cli,
+        [
+            "datasette",
+            "upsert-rows",
+            "--database",
+            "direct",
+            "--table",
+            "people",
+            "--payload-file",
+            str(jsonl_path),
+            "--direct",
+            db_path,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Wrote 2 rows" in result.output
+
+    output = run(
+        "update-row",
+        "--table",
+        "people",
+        "--pks",
+        "Pancakes",
+        "--return",
+        payload={"update": {"age": 5}},
+    )
+    assert json.loads(output)["row"] == {"name": "Pancakes", "age": 5}
+    run("delete-row", "--table", "people", "--pks", "Rex")
+
+    db = sqlite_utils.Database(db_path)
+    assert db.journal_mode == "wal"
+    assert list(db["people"].rows) == [
+        {"name": "Cleo", "age": 6},
+        {"name": "Pancakes", "age": 5},
+    ]
+
+    # Unknown columns are rejected unless the payload asks to alter the table
+    payload_path = tmp_path / "bad.json"
+    payload_path.write_text(json.dumps({"rows": [{"name": "Tom", "colour": "grey"}]}))
+    result = runner.invoke(
+        cli,
+        [
+            "datasette",
+            "insert-rows",
+            "--database",
+            "direct",
+            "--table",
+            "people",
+            "--payload-file",
+            str(payload_path),
+            "--direct",
+            db_path,
+        ],
+    )
+    assert result.exit_code == 1
+    assert "invalid columns: colour" in result.output
+
+    run("drop-table", "--table", "people", "--confirm")
+    assert not db["people"].exists()
+
+
+def test_update_and_delete_rows_batch(datasette_instance, tmp_path, monkeypatch):
+    """Batch mutations run concurrently and report per-row failures."""
+    base_url = datasette_instance["base_url"]
+    db_name = datasette_instance["db_name"]
+    token = datasette_instance["token"]
+    monkeypatch.setenv("DATASETTE_AUTH_TOKEN", token)
+    response = requests.post(
+        f"{base_url}/{db_name}/-/create",
+        headers={"Authorization": f"Bearer {token}"},
+        json={
+            "table": "batch",
+            "rows": [{"id": i, "name": f"row {i}"} for i in range(20)],
+            "pk": "id",
+        },
+    )
+    assert response.status_code == 201, response.text
+    runner = CliRunner()
+
+    updates_path = tmp_path / "updates.jsonl"
+    updates_path.write_text(
+        "\n".join(
+            json.dumps({"pks": str(i), "update": {"name": f"new {i}"}})
+            for i in [*range(10), 99]
+        )
+    )
+    result = runner.invoke(
+        cli,
+        [
+            "datasette",
+            "update-rows",
+            "--database",
+            db_name,
+            "--table",
+            "batch",
+            "--payload-file",
+            str(updates_path),
+            "--base-url",
+            base_url,
+            "--concurrency",
+            "4",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "✗ 99: Error: 404" in result.output
+    assert "Updated 10 rows, 1 failed" in result.output
+    assert "p95" in result.output
+
+    pks_path = tmp_path / "pks.txt"
+    pks_path.write_text("\n".join(str(i) for i in range(15, 20)))
+    result = runner.invoke(
+        cli,
+        [
+            "datasette",
+            "delete-rows",
+            "--database",
+            db_name,
+            "--table",
+            "batch",
+            "--pks-file",
+            str(pks_path),
+            "--base-url",
+            base_url,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Deleted 5 rows, 0 failed" in result.output
+
+    rows = requests.get(f"{base_url}/{db_name}/batch.json?_shape=array").json()
+    assert len(rows) == 15
+    assert rows[9]["name"] == "new 9"
+    assert rows[10]["name"] == "row 10"
+
+
+def test_tilde_encoding_matches_datasette():
+    """Like Datasette, spaces encode as + and a literal + as ~2B."""
+    from datasette.utils import tilde_decode as datasette_decode
+    from datasette.utils import tilde_encode as datasette_encode
+
+    for value in ["plain", "a b", "a+b", "c++ / 100%", "~tilde", "naïve,pk"]:
+        assert tilde_encode(value) == datasette_encode(value)
+        assert tilde_decode(tilde_encode(value)) == value
+    # So an unencoded + in a path decodes to a space, as it does in Datasette
+    assert tilde_decode("a+b") == datasette_decode("a+b") == "a b"
+    assert tilde_decode("a~2Bb") == "a+b"
+
+
+def make_survey_tree(root):
+    """Write a small project with ignored, binary and test files."""
+    files = {
+        ".gitignore": "build/\n*.log\n!keep.log\n",
+        "README.md": "# Demo\n\nA demo project.\n",
+        "LICENSE": "MIT\n",
+        "pyproject.toml": "[project]\nname = 'demo'\n",
+        "web/package.json": "{}\n",
+        "docs/index.md": "Docs\n",
+        "demo/__init__.py": "",
+        "demo/core.py": "def add(a, b):\n    return a + b\n",
+        "demo/util.py": "X = 1\nY = 2\nZ = 3",
+        "tests/test_core.py": "from demo.core import add\n\n\ndef test_add():\n"
+        "    assert add(1, 2) == 3\n",
+        "web/app.js": "console.log(1);\n",
+        "web/app.test.js": "test('x', () => {});\n",
+        "build/out.py": "ignored = True\n",
+        "debug.log": "ignored\n",
+        "keep.log": "kept\n",
+    }
+    for path, content in files.items():
+        full = root / path
+        full.parent.mkdir(parents=True, exist_ok=True)
+        full.write_text(content)
+    (root / "demo" / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\n\0\0\0data")
+
+
+@pytest.mark.parametrize("use_git", [False, True])
+def test_survey_local_tree(tmp_path, use_git):
+    """survey counts languages, tests, docs and manifests, skipping ignored files."""
+    from rb import _survey_chunk, survey_tree
+
+    root = tmp_path / "project"
+    make_survey_tree(root)
+    if use_git:
+        subprocess.run(["git", "init", "-q", str(root)], check=True)
+
+    result = survey_tree(str(root), workers=2, chunk_size=2)
+    assert result["languages"]["Python"] == {"files": 4, "lines": 10}
+    assert result["languages"]["JavaScript"] == {"files": 2, "lines": 2}
+    assert result["binary_file_count"] == 1
+    assert result["code_file_count"] == 6
+    assert result["test_file_count"] == 2
+    assert result["test_ratio"] == round(2 / 6, 4)
+    assert result["has_readme"] and result["has_docs"] and result["has_license"]
+    assert not result["has_changelog"]
+    assert result["manifests"] == ["pyproject.toml", "web/package.json"]
+    # 15 text files written, minus build/out.py and debug.log
+    assert result["file_count"] == 13
+    assert result["unreadable_file_count"] == 0
+    # A file that vanishes or can't be opened is neither text nor binary
+    partial = _survey_chunk(str(root), ["demo/core.py", "demo/gone.py"])
+    assert partial["files"] == 1
+    assert partial["binary_files"] == 0
+    assert partial["unreadable_files"] == 1
+
+    db_path = tmp_path / "github.db"
+    output = CliRunner(mix_stderr=False).invoke(
+        cli, ["survey", "--repo-path", str(root), "--db", str(db_path)]
+    )
+    assert output.exit_code == 0, output.stderr
+    # Progress goes to stderr so stdout is just the JSON
+    assert json.loads(output.stdout)["file_count"] == 13
+    row = sqlite_utils.Database(db_path)["surveys"].get(str(root))
+    assert json.loads(row["languages"])["Python"]["files"] == 4
+    assert json.loads(row["manifests"]) == ["pyproject.toml", "web/package.json"]
+
+
+def test_survey_cache_by_head_sha(tmp_path, monkeypatch):
+    """Remote surveys are reused until HEAD moves, and evicted LRU."""
+    from rb import ResultCache, state_path
+
+    monkeypatch.setenv("RB_CLONE_CACHE", str(tmp_path / "clones"))
+    root = tmp_path / "origin"
+    make_survey_tree(root)
+    git = ["git", "-C", str(root), "-c", "user.name=t", "-c", "user.email=t@t"]
+    subprocess.run(["git", "init", "-q", str(root)], check=True)
+    subprocess.run([*git, "add", "-A"], check=True)
+    subprocess.run([*git, "commit", "-qm", "first"], check=True)
+    url = root.as_uri()
+    db_path = str(tmp_path / "github.db")
+    runner = CliRunner()
+
+    def survey(*extra):
+        result = runner.invoke(
+            cli, ["survey", "--repo-path", url, "--db", db_path, *extra]
+        )
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    assert "Cloning" in survey()
+    assert "Using cached survey" in survey()
+    assert "Fetching" in survey("--no-cache")
+
+    (root / "demo" / "more.py").write_text("A = 1\n")
+    subprocess.run([*git, "add", "-A"], check=True)
+    subprocess.run([*git, "commit", "-qm", "second"], check=True)
+    assert "Using cached survey" not in survey()
+    row = sqlite_utils.Database(db_path)["surveys"].get(url)
+    assert json.loads(row["languages"])["Python"]["files"] == 5
+
+    result = runner.invoke(cli, ["extract-links", "--repo-path", url, "--db", db_path])
+    assert result.exit_code == 0, result.output
+
+    stats = json.loads(runner.invoke(cli, ["cache-stats", "--db", db_path]).output)
+    assert stats["entries"] == 2
+    assert stats["commands"]["survey"]["hits"] == 1
+    assert stats["commands"]["survey"]["entries"] == 1
+
+    cache = ResultCache(state_path(db_path), max_bytes=100)
+    cache.put("test", "a", "1", "x" * 40)
+    cache.put("test", "b", "1", "x" * 40)
+    assert cache.get("test", "a", "1") is not None
+    cache.put("test", "c", "1", "x" * 40)
+    assert cache.get("test", "b", "1") is None
+    assert cache.get("test", "a", "1") is not None
+    stats = cache.stats()
+    assert stats["commands"]["test"]["evictions"] == 1
+    assert stats["entries"] == 2
+
+
+def test_clone_cache_sparse_checkout_and_quota(tmp_path):
+    """Clones are reused, sparse checkouts skip other blobs, old clones evicted."""
+    from rb import CloneCache
+
+    origins = []
+    for name in ("one", "two"):
+        root = tmp_path / name
+        make_survey_tree(root)
+        git = ["git", "-C", str(root), "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(["git", "init", "-q", str(root)], check=True)
+        subprocess.run([*git, "config", "uploadpack.allowFilter", "true"], check=True)
+        subprocess.run([*git, "add", "-A"], check=True)
+        subprocess.run([*git, "commit", "-qm", "first"], check=True)
+        origins.append(root.as_uri())
+
+    clones = CloneCache(str(tmp_path / "clones"), max_bytes=1024**3)
+    with clones.checkout(origins[0], sparse=["/README.md"]) as (work_tree, sha):
+        assert sorted(os.listdir(work_tree)) == [".git", "README.md"]
+        assert len(sha) == 40
+    mirror = clones.path(origins[0])
+    missing = subprocess.run(
+        ["git", "-C", mirror, "rev-list", "--objects", "--missing=print", "HEAD"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert missing.count("\n?") >= 10
+
+    with clones.checkout(origins[0]) as (work_tree, _):
+        assert os.path.exists(os.path.join(work_tree, "demo", "core.py"))
+
+    clones.max_bytes = 1
+    with clones.checkout(origins[1]):
+        pass
+    assert not os.path.exists(mirror)
+    assert os.path.exists(clones.path(origins[1]))
+
+
+def test_similar_top_k(tmp_path):
+    """similar ranks stored float32 embeddings by cosine similarity."""
+    import numpy as np
+
+    from rb import EmbeddingMatrix, save_embeddings
+
+    db_path = str(tmp_path / "github.db")
+    db = sqlite_utils.Database(db_path)
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 16)).astype(np.float32)
+    names = [f"octo/repo{i:03}" for i in range(200)]
+    save_embeddings(db, "test-model", [(n, v, None) for n, v in zip(names, vectors)])
+    blob = db.execute("SELECT embedding FROM repo_embeddings LIMIT 1").fetchone()[0]
+    assert len(blob) == 16 * 4
+
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ normalized[7]
+    scores[7] = -np.inf
+    expected = [names[i] for i in np.argsort(-scores)[:5]]
+
+    store = EmbeddingMatrix.load(db, "test-model")
+    matches = store.top_k(store.vectors[[7]], 5, exclude=[7], block=32)
+    assert [name for name, _ in matches[0]] == expected
+
+    result = CliRunner().invoke(
+        cli,
+        ["similar", "--repo-name", names[7], "-k", "5", "--db", db_path, "--json"],
+    )
+    assert result.exit_code == 0, result.output
+    output = json.loads(result.output)[names[7]]
+    assert [match["repo"] for match in output] == expected
+
+    result = CliRunner().invoke(
+        cli, ["inspect", "--repo-name", names[7], "--embeddings", "--db", db_path]
+    )
+    assert "test-model: 16 dims" in result.output
+
+
+def test_ann_index(tmp_path):
+    """The IVF index finds true neighbours and stays current as embeddings land."""
+    import numpy as np
+
+    from rb import AnnIndex, ann_index_path, save_embeddings
+
+    db_path = str(tmp_path / "github.db")
+    db = sqlite_utils.Database(db_path)
+    rng = np.random.default_rng(1)
+    # Clustered data, like real embeddings, so a few lists hold the neighbours
+    centres = rng.normal(size=(20, 32))
+    vectors = centres[rng.integers(0, 20, 2000)] + rng.normal(size=(2000, 32)) * 0.3
+    names = [f"octo/repo{i:04}" for i in range(2000)]
+    save_embeddings(db, "test-model", [(n, v, None) for n, v in zip(names, vectors)])
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["ann", "build", "--db", db_path])
+    assert result.exit_code == 0, result.output
+    path = ann_index_path(db_path, "test-model")
+    index = AnnIndex(path)
+    assert index.count == 2000
+    assert isinstance(index.vectors, np.memmap)
+
+    result = runner.invoke(
+        cli, ["ann", "bench", "--db", db_path, "--queries", "20", "--nprobe", "1,64"]
+    )
+    assert result.exit_code == 0, result.output
+    recall = float(result.output.split("nprobe=64: recall@10 ")[1].split(",")[0])
+    assert recall > 0.95
+
+    def similar(name, *extra):
+        result = runner.invoke(
+            cli, ["similar", "--repo-name", name, "--db", db_path, "--json", *extra]
+        )
+        assert result.exit_code == 0, result.output
+        return [match["repo"] for match in json.loads(result.output)[name]]
+
+    # A new repo and a re-embedded one go to the delta segment
+    save_embeddings(
+        db,
+        "test-model",
+        [("new/repo", vectors[5] * 2, None), (names[6], vectors[5] * 3, None)],
+    )
+    index = AnnIndex(path)
+    assert index.delta_names == ["new/repo", names[6]]
+    neighbours = similar(names[5], "--nprobe", "4")
+    # Both point the same way as repo0005, so they tie for first place
+    assert set(neighbours[:2]) == {"new/repo", names[6]}
+    assert set(similar(names[5], "--exact")[:2]) == {"new/repo", names[6]}
+    assert neighbours.count(names[6]) == 1
+
+    index.compact()
+    assert index.delta_names == [] and index.count == 2001
+    assert set(similar(names[5])[:2]) == {"new/repo", names[6]}
+
+
+def test_ann_index_duplicate_vectors(tmp_path):
+    """Identical embeddings, as forks get, leave clusters empty without failing."""
+    import numpy as np
+
+    from rb import _kmeans, save_embeddings
+
+    for seed in range(5):
+        centroids = _kmeans(np.ones((10, 4), dtype=np.float32), 4, 3, seed=seed)
+        assert centroids.shape == (4, 4)
+        assert np.allclose(np.linalg.norm(centroids, axis=1), 1)
+
+    db_path = str(tmp_path / "github.db")
+    vectors = [[1.0, 0.0, 0.0]] * 30 + [[0.0, 1.0, 0.0]] * 6
+    save_embeddings(
+        sqlite_utils.Database(db_path),
+        "test-model",
+        [(f"octo/fork{i:02}", v, None) for i, v in enumerate(vectors)],
+    )
+    result = CliRunner().invoke(cli, ["ann", "build", "--db", db_path])
+    assert result.exit_code == 0, result.output
+
+
+def test_embed_skips_unchanged_and_reuses_vectors(tmp_path, github_api):
+    """embed only sends new or changed texts, deduplicated, to the model."""
+    import rb
+
+    db_path = str(tmp_path / "github.db")
+    db = sqlite_utils.Database(db_path)
+    repos = [fake_repo(f"octo/repo{i}", i) for i in range(1, 6)]
+    save_repos(db, repos)
+    for i in range(1, 5):
+        github_api.readmes[f"octo/repo{i}"] = f"# repo{i}\n\nParses JSON quickly."
+
+    calls = []
+
+    class CountingModel(rb.HashEmbeddingModel):
+        def embed_batch(self, items):
+            items = list(items)
+            calls.append(items)
+            return super().embed_batch(items)
+
+    def run():
+        calls.clear()
+        stats = rb.embed_repos(
+            db,
+            [
+                {
+                    "full_name": r["full_name"],
+                    "description": r["description"],
+                    "topics": json.dumps(r["topics"]),
+                }
+                for r in repos
+            ],
+            CountingModel(),
+            "rb-hash",
+            client=rb.GitHubClient(api_url=github_api.base_url),
+            batch_size=2,
+            workers=3,
+            queue_size=2,
+        )
+        return stats, sum(len(batch) for batch in calls)
+
+    stats, sent = run()
+    assert stats["embedded"] == 5 and sent == 5
+    row = db.execute(
+        "SELECT dims, content_hash FROM repo_embeddings WHERE repo = 'octo/repo1'"
+    ).fetchone()
+    assert row[0] == 256 and len(row[1]) == 64
+
+    stats, sent = run()
+    assert stats["unchanged"] == 5 and sent == 0
+
+    # repo2's README changes; a new fork has exactly repo2's old text
+    fork = {**repos[1], "id": 6, "full_name": "fork/repo2"}
+    github_api.readmes["fork/repo2"] = github_api.readmes["octo/repo2"]
+    github_api.readmes["octo/repo2"] = "Something else entirely."
+    repos.append(fork)
+    stats, sent = run()
+    assert stats["unchanged"] == 4
+    assert stats["embedded"] == 1 and stats["reused"] == 1 and sent == 1
+
+    result = CliRunner().invoke(
+        cli,
+        ["embed", "-m", "rb-hash", "--db", db_path, "--no-readme"],
+    )
+    assert result.exit_code == 0, result.output
+    # Without READMEs only repo5, which never had one, keeps its text
+    assert "Embedded 4 repos in" in result.output
+    assert "1 unchanged" in result.output
+    a, b = rb.get_embedding_model("rb-hash").embed_multi(["json parser", "JSON parser"])
+    assert a == b
+
+    # A worker failing outside the README fetch is raised, not left hanging
+    broken = [{"full_name": f"octo/ok{i}", "topics": "[]"} for i in range(10)]
+    broken.insert(3, {"full_name": "octo/broken", "topics": "not json"})
+    with pytest.raises(json.JSONDecodeError):
+        rb.embed_repos(db, broken, CountingModel(), "rb-hash", workers=3, queue_size=1)
+
+
+def test_crawl_awesome_lists(tmp_path, github_api):
+    """crawl follows lists of lists breadth first within depth and budget."""
+    lists = {
+        "octo/awesome-lists": ["octo/awesome-python", "octo/awesome-go", "octo/a"],
+        "octo/awesome-python": ["octo/b", "octo/c", "octo/awesome-deep"],
+        "octo/awesome-go": ["octo/c", "octo/d"],
+        "octo/awesome-deep": ["octo/e"],
+    }
+    for list_name, links in lists.items():
+        github_api.readmes[list_name] = "\n".join(
+            f"- [{link}](https://github.com/{link})" for link in links
+        )
+    names = list(lists) + ["octo/a", "octo/b", "octo/c", "octo/d", "octo/e"]
+    for i, name in enumerate(names, start=1):
+        github_api.repos[name] = fake_repo(name, i)
+    db_path = tmp_path / "github.db"
+
+    def crawl(*args):
+        result = CliRunner().invoke(
+            cli,
+            [
+                "crawl",
+                "https://github.com/octo/awesome-lists",
+                "--db",
+                str(db_path),
+                "--api-url",
+                github_api.base_url,
+                "--per-host",
+                "2",
+                *args,
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    output = crawl("--depth", "2")
+    assert "Crawled 3 lists and found 8 repos" in output
+    db = sqlite_utils.Database(db_path)
+    assert db["repos"].count == 8
+    assert "octo/e" not in {row["full_name"] for row in db["repos"].rows}
+    readme_requests = [p for p, _ in github_api.requests if p.endswith("/readme")]
+    assert len(readme_requests) == 3
+
+    db_path = tmp_path / "budget.db"
+    output = crawl("--depth", "5", "--max-repos", "5")
+    assert "found 5 repos" in output
+    assert sqlite_utils.Database(db_path)["repos"].count == 5
+
+
+def test_crawl_ingestion_error_fails(tmp_path, github_api, monkeypatch):
+    """An error in the ingestion thread stops the crawl and fails it."""
+    import rb
+
+    github_api.readmes["octo/awesome-lists"] = "https://github.com/octo/a"
+
+    def broken_ingest(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(rb, "ingest_repos", broken_ingest)
+    result = CliRunner().invoke(
+        cli,
+        ["crawl", "octo/awesome-lists", "--db", str(tmp_path / "github.db")]
+        + ["--api-url", github_api.base_url],
+    )
+    assert result.exit_code != 0
+    assert isinstance(result.exception, sqlite3.OperationalError)
+    assert "lists and found" not in result.output
+
+
+def test_canonical_repo_links(tmp_path, github_api):
+    """Links normalize to one owner/repo name and known repos are skipped."""
+    from rb import canonical_repo, extract_links_from_text
+
+    assert canonical_repo("https://github.com/Octo/Repo.git") == "octo/repo"
+    assert canonical_repo("https://github.com/octo/repo/tree/main?x=1#y") == (
+        "octo/repo"
+    )
+    assert canonical_repo("git@github.com:octo/repo.git") == "octo/repo"
+    assert canonical_repo("https://github.com/foo/.github-tools") == (
+        "foo/.github-tools"
+    )
+    assert canonical_repo("x/django.git-helpers") == "x/django.git-helpers"
+    assert canonical_repo("https://github.com/topics/python") is None
+    assert canonical_repo("https://gitlab.com/octo/repo") is None
+    readme = (
+        "[a](https://github.com/Octo/Repo) https://github.com/octo/repo.git "
+        "https://github.com/octo/other/tree/main"
+    )
+    assert extract_links_from_text(readme) == [
+        "https://github.com/octo/repo",
+        "https://github.com/octo/other",
+    ]
+    # HTML hrefs, autolinks and links followed by punctuation
+    for text in [
+        '<a href="https://github.com/octo/repo">repo</a>',
+        "<a href='https://github.com/octo/repo'>repo</a>",
+        "<https://github.com/octo/repo>",
+        "https://github.com/octo/repo, and more",
+        "see https://github.com/octo/repo.",
+        "(https://github.com/octo/repo); or https://github.com/octo/repo:",
+    ]:
+        assert extract_links_from_text(text) == ["https://github.com/octo/repo"], text
+    assert canonical_repo("https://github.com/octo/repo.git.") == "octo/repo"
+
+    for i in (1, 2, 3):
+        github_api.repos[f"octo/repo{i}"] = fake_repo(f"octo/repo{i}", i)
+    db_path = tmp_path / "github.db"
+    db = sqlite_utils.Database(db_path)
+    with db.conn:
+        save_repos(db, [fake_repo("Octo/Repo1", 1)])
+    links_path = tmp_path / "links.json"
+    links_path.write_text(
+        json.dumps(
+            [
+                "https://github.com/octo/repo1",
+                "https://github.com/OCTO/repo2.git",
+                "https://github.com/octo/repo2#readme",
+                "https://github.com/octo/repo3/tree/main",
+            ]
+        )
+    )
+    result = CliRunner().invoke(
+        cli,
+        [
+            "process-links",
+            "--json-path",
+            str(links_path),
+            "--db",
+            str(db_path),
+            "--api-url",
+            github_api.base_url,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Skipping 1 repos already in" in result.output
+    assert sorted(path for path, _ in github_api.requests) == [
+        "/repos/octo/repo2",
+        "/repos/octo/repo3",
+    ]
+
+
+def test_list_repos_search_and_keyset_pages(tmp_path):
+    """list-repos searches topics through FTS5 and pages with --after."""
+    from rb import ensure_repo_search
+
+    db_path = str(tmp_path / "github.db")
+    db = sqlite_utils.Database(db_path)
+    repos = [fake_repo(f"octo/repo{i:02}", i) for i in range(1, 26)]
+    for repo in repos[:10]:
+        repo["topics"] = ["parsing", "json"]
+    with db.conn:
+        save_repos(db, repos)
+    ensure_repo_search(db)
+    runner = CliRunner()
+
+    def list_repos(*args):
+        result = runner.invoke(
+            cli, ["list-repos", "--db", db_path, "--format", "jsonl", *args]
+        )
+        assert result.exit_code == 0, result.output
+        lines = result.output.splitlines()
+        cursor = None
+        if lines and lines[-1].startswith("Next page: --after "):
+            cursor = lines.pop().removeprefix("Next page: --after ")
+        return [json.loads(line)["full_name"] for line in lines], cursor
+
+    names, cursor = list_repos("--filter", "parsing", "--limit", "4")
+    assert names == ["octo/repo01", "octo/repo02", "octo/repo03", "octo/repo04"]
+    names, cursor = list_repos("--filter", "parsing", "--limit", "4", "--after", cursor)
+    assert names == ["octo/repo05", "octo/repo06", "octo/repo07", "octo/repo08"]
+
+    seen = []
+    cursor = None
+    while True:
+        args = ["--sort", "stars", "--limit", "7"]
+        page, cursor = list_repos(*args, *(["--after", cursor] if cursor else []))
+        seen += page
+        if cursor is None:
+            break
+    assert seen == [repo["full_name"] for repo in reversed(repos)]
+    plan = db.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM repos ORDER BY "
+        "coalesce(stargazers_count, 0) DESC, id LIMIT 7"
+    ).fetchall()
+    assert "repos_stargazers_count" in str(plan)
+    plan = db.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM repos WHERE full_name COLLATE NOCASE > ? "
+        "ORDER BY full_name COLLATE NOCASE LIMIT 7",
+        ["octo/repo05"],
+    ).fetchall()
+    assert "repos_full_name_nocase" in str(plan)
+    indexes = {index.name for index in db["repos"].indexes}
+    assert "repos_full_name" not in indexes
+
+    # Repos without a star count page as if they had 0 stars
+    with db.conn:
+        db.execute("UPDATE repos SET stargazers_count = NULL WHERE id IN (1, 3, 4, 6)")
+    seen = []
+    cursor = None
+    while True:
+        args = ["--sort", "stars", "--limit", "3"]
+        page, cursor = list_repos(*args, *(["--after", cursor] if cursor else []))
+        seen += page
+        if cursor is None:
+            break
+    order = [*range(25, 6, -1), 5, 2, 1, 3, 4, 6]
+    assert seen == [f"octo/repo{i:02}" for i in order]
+
+    # Triggers keep the index current as repos are re-saved
+    repos[0]["topics"] = ["yaml"]
+    repos[20]["topics"] = ["parsing"]
+    with db.conn:
+        save_repos(db, [repos[0], repos[20]])
+    names, _ = list_repos("--filter", "parsing", "--limit", "50")
+    assert len(names) == 10 and "octo/repo21" in names and "octo/repo01" not in names
+    # Raises if the index has drifted from the repos table
+    db.execute("INSERT INTO repos_fts(repos_fts) VALUES('integrity-check')")
+
+    result = runner.invoke(cli, ["list-repos", "--db", db_path, "--limit", "2"])
+    assert "octo/repo01" in result.output and "The repo01 project" in result.output
+
+
+def test_stars_binned_canned_query(tmp_path):
+    """The plot's binned counts match the raw rows and use the size index."""
+    import yaml
+
+    from rb import ensure_repo_search
+
+    with open(os.path.join(os.path.dirname(__file__), "datasette.yaml")) as f:
+        queries = yaml.safe_load(f)["databases"]["github"]["queries"]
+    db = sqlite_utils.Database(str(tmp_path / "github.db"))
+    repos = [fake_repo(f"octo/repo{i:03}", i) for i in range(1, 201)]
+    repos[0]["size"] = repos[0]["stargazers_count"] = 0
+    with db.conn:
+        save_repos(db, repos)
+    ensure_repo_search(db)
+
+    def run(name, **params):
+        sql = queries[name]["sql"]
+        names = ["size_min", "size_max", "stars_min", "stars_max", "bins"]
+        params = {k: str(params.get(k, "")) for k in names if f":{k}" in sql}
+        return list(db.query(sql, params)), db.execute(
+            "EXPLAIN QUERY PLAN " + sql, params
+        ).fetchall()
+
+    bins, plan = run("stars_binned", bins=10)
+    assert sum(b["count"] for b in bins) == 200
+    assert {b["x_bin"] for b in bins} <= set(range(10))
+    assert any("repos_size_stargazers_count" in row[-1] for row in plan)
+    for b in bins:
+        assert b["size_lo"] < b["size_hi"] and b["stars_lo"] < b["stars_hi"]
+
+    # A zoomed-in range: bins and rows agree, every row falls inside its bin
+    rng = {"size_min": 1000, "size_max": 5000, "stars_min": 100, "stars_max": 450}
+    bins, _ = run("stars_binned", bins=5, **rng)
+    rows, _ = run("stars", **rng)
+    assert sum(b["count"] for b in bins) == len(rows) == 36
+    assert all(
+        1000 <= r["size"] <= 5000 and 100 <= r["stargazers_count"] <= 450 for r in rows
+    )
+    assert len(run("stars")[0]) == 200
+    # Capped so every cell fits in Datasette's default max_returned_rows
+    bins, _ = run("stars_binned", bins=100)
+    assert max(max(b["x_bin"], b["y_bin"]) for b in bins) == 30
+
+
+def test_get_auth_token_in_process(tmp_path):
+    """Tokens are signed without Datasette, accepted by it and cached."""
+    import asyncio
+
+    from datasette.app import Datasette
+
+    cache = str(tmp_path / "tokens.json")
+    runner = CliRunner()
+
+    def get_token(*args):
+        result = runner.invoke(
+            cli,
+            ["datasette", "get-auth-token", "--username", "root", "--secret", "s3"]
+            + ["--token-cache", cache, *args],
+        )
+        assert result.exit_code == 0, result.output
+        return result.output.strip()
+
+    args = ["--expires-after", "1h", "--all", "view-table"]
+    args += ["--resource", "github", "repos", "insert-row"]
+    token = get_token(*args)
+    assert token.startswith("dstok_")
+    assert get_token(*args) == token
+    assert get_token("--expires-after", "2h") != token
+    assert os.stat(cache).st_mode & 0o777 == 0o600
+    assert "s3" not in open(cache).read()
+
+    async def check():
+        ds = Datasette(secret="s3")
+        await ds.invoke_startup()
+        expected = ds.create_token(
+            "root",
+            expires_after=3600,
+            restrict_all=["view-table"],
+            restrict_resource={"github": {"repos": ["insert-row"]}},
+        )
+        ours = ds.unsign(token.removeprefix("dstok_"), "token")
+        theirs = ds.unsign(expected.removeprefix("dstok_"), "token")
+        assert ours.pop("t") <= theirs.pop("t")
+        assert ours == theirs
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": f"Bearer {token}"}
+        )
+        actor = response.json()["actor"]
+        assert actor["id"] == "root"
+        assert actor["_r"] == {"a": ["vt"], "r": {"github": {"repos": ["ir"]}}}
+
+    asyncio.run(check())
+
+
+def test_response_cache_plugin(tmp_path):
+    """JSON responses are cached until the database is written, with ETags."""
+    import asyncio
+
+    from datasette.app import Datasette
+
+    db_path = str(tmp_path / "github.db")
+    db = sqlite_utils.Database(db_path)
+    with db.conn:
+        save_repos(db, [fake_repo("octo/one", 1)])
+    plugins_dir = os.path.join(os.path.dirname(__file__), "plugins")
+
+    async def run():
+        ds = Datasette([db_path], plugins_dir=plugins_dir)
+        url = "/github/repos.json?_shape=array&_col=full_name"
+        first = await ds.client.get(url)
+        assert first.headers["x-rb-cache"] == "miss"
+        second = await ds.client.get(url)
+        assert second.headers["x-rb-cache"] == "hit"
+        assert second.json() == first.json() == [{"id": 1, "full_name": "octo/one"}]
+        etag = second.headers["etag"]
+        assert second.headers["cache-control"] == "no-cache"
+
+        revalidated = await ds.client.get(url, headers={"If-None-Match": etag})
+        assert revalidated.status_code == 304 and revalidated.content == b""
+
+        # A write from another connection invalidates the cached response
+        with db.conn:
+            save_repos(db, [fake_repo("octo/two", 2)])
+        after = await ds.client.get(url, headers={"If-None-Match": etag})
+        assert after.status_code == 200
+        assert after.headers["x-rb-cache"] == "miss"
+        assert after.headers["etag"] != etag
+        assert len(after.json()) == 2
+
+        # Errors and other formats pass straight through
+        missing = await ds.client.get("/github/nope.json")
+        assert missing.status_code == 404 and "x-rb-cache" not in missing.headers
+        html = await ds.client.get("/github/repos")
+        assert "x-rb-cache" not in html.headers
+
+    asyncio.run(run())
+
+
+def test_repo_scores_percentiles(tmp_path):
+    """Scores rank repos overall and by language, recomputed only on change."""
+    from rb import percentile_ranks, save_survey, update_repo_scores
+
+    assert list(percentile_ranks([10, 20, 20, 40, float("nan")])[:4]) == [
+        12.5,
+        50.0,
+        50.0,
+        87.5,
+    ]
+
+    db_path = str(tmp_path / "github.db")
+    db = sqlite_utils.Database(db_path)
+    repos = [fake_repo(f"octo/repo{i}", i) for i in range(1, 9)]
+    for repo in repos[4:]:
+        repo["language"] = "Go"
+    with db.conn:
+        save_repos(db, repos)
+    save_survey(db, {"repo": "octo/repo1", "test_ratio": 0.5})
+    save_survey(db, {"repo": "octo/repo2", "test_ratio": 0.1})
+
+    assert update_repo_scores(db) == 8
+    assert update_repo_scores(db) == 0
+    row = db["repo_scores"].get(8)
+    assert row["stars_percentile"] == 93.75
+    assert row["stars_language_percentile"] == 87.5
+    assert row["peers"] == 4
+    assert db["repo_scores"].get(1)["test_ratio_percentile"] == 75.0
+    assert db["repo_scores"].get(3)["test_ratio_percentile"] is None
+
+    # Changing one repo's stars marks the scores dirty
+    repos[0]["stargazers_count"] = 1000
+    with db.conn:
+        save_repos(db, [repos[0]])
+    assert update_repo_scores(db) > 0
+    assert db["repo_scores"].get(1)["stars_percentile"] == 93.75
+
+    result = CliRunner().invoke(
+        cli, ["inspect", "--repo-name", "OCTO/repo1", "--stats", "--db", db_path]
+    )
+    assert result.exit_code == 0, result.output
+    assert "- stars: 1000 (94th percentile, 88th in Python)" in result.output
+    assert "- test_ratio: 0.5 (75th percentile" in result.output
+
+
+def test_owner_stats_rollup(tmp_path, github_api, monkeypatch):
+    """Ingestion keeps owner_stats current; inspect-user ranks owners."""
+    import rb
+    from rb import refresh_owner_stats
+
+    names = ["alice/a", "alice/b", "alice/c", "bob/x"]
+    for i, name in enumerate(names, start=1):
+        repo = fake_repo(name, i)
+        repo["owner"]["id"] = 1 if name.startswith("alice") else 2
+        repo["language"] = "Go" if name == "alice/c" else "Python"
+        github_api.repos[name] = repo
+    links_path = tmp_path / "links.json"
+    links_path.write_text(json.dumps([f"https://github.com/{n}" for n in names]))
+    db_path = str(tmp_path / "github.db")
+    runner = CliRunner()
+    args = ["process-links", "--json-path", str(links_path), "--db", db_path]
+    result = runner.invoke(cli, [*args, "--api-url", github_api.base_url])
+    assert result.exit_code == 0, result.output
+
+    db = sqlite_utils.Database(db_path)
+    alice = db["owner_stats"].get(1)
+    assert alice["repo_count"] == 3
+    assert alice["total_stars"] == 60 and alice["median_stars"] == 20
+    assert json.loads(alice["languages"]) == {"Python": 2, "Go": 1}
+    assert alice["top_language"] == "Python"
+    assert db["owner_stats"].get(2)["total_stars"] == 40
+
+    github_api.repos["bob/x"]["stargazers_count"] = 500
+    result = runner.invoke(cli, [*args, "--api-url", github_api.base_url, "--refresh"])
+    assert result.exit_code == 0, result.output
+    assert db["owner_stats"].get(2)["total_stars"] == 500
+    before = list(db["owner_stats"].rows)
+    refresh_owner_stats(db)
+    assert [
+        {k: v for k, v in row.items() if k != "updated_at"}
+        for row in db["owner_stats"].rows
+    ] == [{k: v for k, v in row.items() if k != "updated_at"} for row in before]
+
+    result = runner.invoke(cli, ["inspect-user", "--login", "ALICE", "--db", db_path])
+    assert result.exit_code == 0, result.output
+    assert "- Total stars: 60 (#2 of 2 owners)" in result.output
+    assert "- Repositories: 3 (#1 of 2 owners)" in result.output
+    assert "- Languages: Python 2, Go 1" in result.output
+
+    # A failing rollup doesn't fail repos that were already committed
+    def broken_rollup(db, owner_ids=None):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(rb, "refresh_owner_stats", broken_rollup)
+    github_api.repos["bob/x"]["stargazers_count"] = 700
+    result = runner.invoke(cli, [*args, "--api-url", github_api.base_url, "--refresh"])
+    assert result.exit_code == 0, result.output
+    assert "1 updated" in result.output and "0 failures" in result.output
+    assert "✗ Error refreshing owner stats: database is locked" in result.output
+    assert db["repos"].get(4)["stargazers_count"] == 700
+
+
+# Modules that must not load for commands that don't need them
+HEAVY_MODULES = {"numpy", "requests", "sqlite_utils", "llm", "httpx", "asyncio"}
+# Cumulative `import rb` budget in milliseconds; it was ~1s before imports
+# were made lazy
+IMPORT_BUDGET_MS = float(os.environ.get("RB_IMPORT_BUDGET_MS", 400))
+
+
+@pytest.mark.parametrize(
+    "args",
+    [["--help"], ["datasette", "delete-row", "--help"], ["list-repos", "--help"]],
+)
+def test_lightweight_commands_start_fast(args):
+    """Cold startup skips heavy dependencies and stays within budget."""
+    from rb import parse_import_times
+
+    script = (
+        "import json, sys, rb\n"
+        "try:\n    rb.cli()\nexcept SystemExit:\n    pass\n"
+        f"print(json.dumps(sorted(set(sys.modules) & {HEAVY_MODULES!r})))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script, *args],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.splitlines()[-1]) == []
+    (rb_import,) = [
+        cumulative
+        for name, _, cumulative, depth in parse_import_times(result.stderr)
+        if name == "rb" and depth == 0
+    ]
+    assert rb_import / 1000 < IMPORT_BUDGET_MS
+
+
+def test_bench_baselines_and_regressions(tmp_path):
+    """rb bench saves JSON baselines and flags rates that fall below them."""
+    baseline = tmp_path / "baseline.json"
+    runner = CliRunner()
+    args = ["bench", "--scale", "0.01", "--repeat", "1", "--baseline", str(baseline)]
+    args += ["-s", "extract-links", "-s", "survey", "-s", "process-links"]
+    args += ["-s", "insert-rows", "--rate-limit", "3", "--latency", "0"]
+
+    result = runner.invoke(cli, [*args, "--save"])
+    assert result.exit_code == 0, result.output
+    saved = json.loads(baseline.read_text())
+    assert set(saved["scenarios"]) == {
+        "extract-links",
+        "survey",
+        "process-links",
+        "insert-rows",
+    }
+    assert saved["scenarios"]["process-links"]["items"] == 5
+    assert saved["scenarios"]["insert-rows"]["items"] == 200
+    assert saved["scenarios"]["survey"]["unit"] == "files"
+    assert all(s["rate"] > 0 for s in saved["scenarios"].values())
+    assert "new" in result.output
+
+    # Pretend the survey used to be far faster
+    saved["scenarios"]["survey"]["rate"] *= 1000
+    baseline.write_text(json.dumps(saved))
+    result = runner.invoke(
+        cli,
+        ["bench", "-s", "survey", "--scale", "0.01", "--repeat", "1"]
+        + ["--baseline", str(baseline), "--rate-limit", "3", "--latency", "0"],
+    )
+    assert result.exit_code == 1
+    assert "REGRESSION" in result.output
+    assert "survey regressed more than 20%" in result.output
+
+    # Different options aren't compared
+    result = runner.invoke(
+        cli,
+        ["bench", "-s", "survey", "--scale", "0.02", "--repeat", "1"]
+        + ["--baseline", str(baseline)],
+    )
+    assert result.exit_code == 0, result.output
+    assert "not comparable" in result.output
+
+    # Nested commands add to the bench's own trace instead of replacing it
+    trace = tmp_path / "trace.jsonl"
+    baseline.write_text("{}")
+    result = runner.invoke(
+        cli,
+        ["--trace", str(trace), "bench", "-s", "process-links", "--scale", "0.01"]
+        + ["--repeat", "2", "--baseline", str(baseline), "--latency", "0"],
+    )
+    assert result.exit_code == 0, result.output
+    records = [json.loads(line) for line in trace.read_text().splitlines()]
+    stages = [r["stage"] for r in records if r["type"] == "span"]
+    assert stages.count("github.get") == 10
+    assert f"Trace: {len(stages)} spans" in result.output
+
+
+def test_survey_history_incremental(tmp_path, monkeypatch):
+    """Weekly activity is built from git log and extended with new commits."""
+    from rb import iter_git_log
+
+    monkeypatch.setenv("RB_CLONE_CACHE", str(tmp_path / "clones"))
+    root = tmp_path / "origin"
+    root.mkdir()
+    subprocess.run(["git", "init", "-q", str(root)], check=True)
+
+    def commit(author, date, path, lines):
+        (root / path).write_text("".join(f"line {i}\n" for i in range(lines)))
+        env = {
+            **os.environ,
+            "GIT_AUTHOR_DATE": date,
+            "GIT_COMMITTER_DATE": date,
+        }
+        subprocess.run(["git", "-C", str(root), "add", "-A"], check=True)
+        subprocess.run(
+            ["git", "-C", str(root), "-c", f"user.name={author}"]
+            + ["-c", f"user.email={author}@example.com", "commit", "-qm", path],
+            check=True,
+            env=env,
+        )
+
+    # Monday 2025-03-03 starts the first week, Monday 2025-03-10 the second
+    commit("ann", "2025-03-03T10:00:00Z", "a.py", 10)
+    commit("bob", "2025-03-05T10:00:00Z", "b.py", 5)
+    commit("ann", "2025-03-12T10:00:00Z", "a.py", 12)
+    (root / "logo.png").write_bytes(b"\x89PNG\0\1\2")
+    commit("Ann", "2025-03-13T10:00:00Z", "c.py", 1)
+
+    commits = list(iter_git_log(str(root), ["HEAD"]))
+    assert [c.author for c in commits] == [
+        "ann@example.com",
+        "ann@example.com",
+        "bob@example.com",
+        "ann@example.com",
+    ]
+    assert (commits[0].additions, commits[1].additions) == (1, 2)
+
+    db_path = str(tmp_path / "github.db")
+    runner = CliRunner()
+
+    def survey(repo_path):
+        result = runner.invoke(
+            cli, ["survey", "--repo-path", repo_path, "--db", db_path]
+        )
+        assert result.exit_code == 0, result.output
+        return json.loads(result.output[result.output.index("{") :])["history"]
+
+    history = survey(str(root))
+    assert history["commits"] == 4 and history["contributors"] == 2
+    assert history["new_commits"] == 4
+    assert history["first_commit_at"].startswith("2025-03-03")
+    assert history["last_commit_at"].startswith("2025-03-13")
+    db = sqlite_utils.Database(db_path)
+    activity = [
+        (row["week"], row["commits"], row["contributors"], row["additions"])
+        for row in db.query("SELECT * FROM repo_activity ORDER BY week")
+    ]
+    assert activity == [("2025-03-03", 2, 2, 15), ("2025-03-10", 2, 1, 3)]
+
+    # Only the new commit is read, and it lands in its own week
+    commit("cy", "2025-03-17T10:00:00Z", "d.py", 3)
+    history = survey(str(root))
+    assert history["new_commits"] == 1
+    assert history["commits"] == 5 and history["contributors"] == 3
+    assert db["repo_history"].get(str(root))["last_sha"] == history["last_sha"]
+    assert db.execute("SELECT count(*) FROM repo_activity").fetchone()[0] == 3
+
+    # Rewritten history is analyzed afresh
+    subprocess.run(["git", "-C", str(root), "reset", "-q", "--hard", "HEAD~2"])
+    history = survey(str(root))
+    assert history["commits"] == 3 and history["new_commits"] == 3
+
+    # Remote repos are read from a blob-less clone; a file:// origin only
+    # honours --filter=blob:none when it allows filters
+    subprocess.run(["git", "-C", str(root), "config", "uploadpack.allowFilter", "1"])
+    for day in range(14, 22):
+        commit("dee", f"2025-03-{day}T10:00:00Z", "e.py", day)
+    trace = tmp_path / "git-trace.log"
+    monkeypatch.setenv("GIT_TRACE", str(trace))
+
+    def git_calls(*commands):
+        calls = [
+            line.split("trace: built-in: git ", 1)[1]
+            for line in trace.read_text().splitlines()
+            if "trace: built-in: git " in line
+        ]
+        trace.write_text("")
+        return {c: sum(call.startswith(c) for call in calls) for c in commands}
+
+    history = survey(root.as_uri())
+    assert history["commits"] == 11 and history["contributors"] == 3
+    # The checkout's blobs and then the history's blobs, each in one fetch,
+    # however many commits there are
+    assert git_calls("ls-remote", "fetch") == {"ls-remote": 1, "fetch": 2}
+    history = survey(root.as_uri())
+    assert "new_commits" not in history and history["commits"] == 11
+    assert git_calls("ls-remote", "fetch") == {"ls-remote": 1, "fetch": 0}
+
+    # A new commit: one fetch brings the clone up to date for both the
+    # survey and the history, whose new blobs come in one more
+    commit("dee", "2025-03-24T10:00:00Z", "e.py", 30)
+    history = survey(root.as_uri())
+    assert history["new_commits"] == 1 and history["commits"] == 12
+    assert git_calls("ls-remote", "fetch --quiet --filter", "fetch") == {
+        "ls-remote": 1,
+        "fetch --quiet --filter": 1,
+        "fetch": 3,
+    }